@@ -0,0 +1,125 @@
+"""Inverted-file (IVF) index for approximate nearest-neighbour search.
+
+Exact search scores every row of an index for every question, which is
+fine for a few thousand chunks but not for collections of 20k-200k. For
+indexes of at least ``ANN_MIN_ROWS`` rows, ingestion clusters the unit rows
+with spherical k-means into ``nlist`` lists around unit centroids (the
+coarse quantizer). A question is scored against the centroids first and
+then only against the rows of the ``nprobe`` closest lists, about
+``nprobe / nlist`` of the index; raising ``nprobe`` trades latency for
+recall, ``nprobe = nlist`` is exact. Smaller indexes are not clustered and
+are always searched exactly.
+
+Sections, stored in the session index file (see vector_index):
+
+    ivf_centroids  float32 nlist x dim, unit rows
+    ivf_offsets    uint64, nlist + 1 offsets into ivf_rows
+    ivf_rows       uint32 row numbers grouped by list, ascending in a list
+
+The ``ivf_centroids`` section info holds ``nlist`` and the default
+``nprobe``. Rows without an embedding are in no list. Training is seeded,
+so a document always gets the same lists.
+"""
+import heapq
+import math
+import struct
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy is in requirements.txt
+    np = None
+
+ANN_VERSION = 'ivf-kmeans-1'
+# Indexes with fewer rows are searched exactly
+ANN_MIN_ROWS = 10000
+DEFAULT_NPROBE = 32
+KMEANS_ITERATIONS = 10
+# k-means is trained on a sample of this many rows per list
+TRAIN_ROWS_PER_LIST = 40
+SECTIONS = ('ivf_centroids', 'ivf_offsets', 'ivf_rows')
+_ASSIGN_BLOCK = 8192
+
+
+def default_nlist(count):
+    return max(1, round(math.sqrt(count)))
+
+
+def assign(rows, centroids):
+    """Closest centroid of each unit row (blocked to bound the score matrix)"""
+    labels = np.empty(len(rows), dtype=np.int64)
+    for start in range(0, len(rows), _ASSIGN_BLOCK):
+        labels[start:start + _ASSIGN_BLOCK] = np.argmax(rows[start:start + _ASSIGN_BLOCK] @ centroids.T, axis=1)
+    return labels
+
+
+def train(rows, nlist, iterations=KMEANS_ITERATIONS, seed=0):
+    """Unit centroids from spherical k-means over a sample of the unit ``rows``"""
+    rng = np.random.default_rng(seed)
+    sample = rows[rng.choice(len(rows), min(len(rows), nlist * TRAIN_ROWS_PER_LIST), replace=False)]
+    nlist = min(nlist, len(sample))
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+    for _ in range(iterations):
+        labels = assign(sample, centroids)
+        order = np.argsort(labels, kind='stable')
+        counts = np.bincount(labels, minlength=nlist)
+        filled = counts > 0
+        sums = np.empty_like(centroids)
+        sums[filled] = np.add.reduceat(sample[order], (np.cumsum(counts) - counts)[filled], axis=0)
+        # an empty list restarts from a random sample row
+        sums[~filled] = sample[rng.choice(len(sample), int((~filled).sum()))]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = sums / np.where(norms > 0, norms, 1.0)
+    return centroids
+
+
+def encode(unit_rows, norms, nlist=None, nprobe=DEFAULT_NPROBE):
+    """``(info, {section: bytes})`` of an IVF index over ``unit_rows``"""
+    rows = np.asarray(unit_rows, dtype=np.float32)
+    present = np.flatnonzero(np.asarray(norms) > 0)
+    centroids = train(rows[present], nlist or default_nlist(len(present)))
+    labels = assign(rows[present], centroids)
+    order = np.argsort(labels, kind='stable')
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(labels, minlength=len(centroids)))))
+    info = {'version': ANN_VERSION, 'nlist': len(centroids), 'nprobe': min(nprobe, len(centroids))}
+    return info, {
+        'ivf_centroids': centroids.astype('<f4').tobytes(),
+        'ivf_offsets': offsets.astype('<u8').tobytes(),
+        'ivf_rows': present[order].astype('<u4').tobytes(),
+    }
+
+
+class IVFIndex:
+    """Candidate selection over the sections written by ``encode``"""
+
+    def __init__(self, info, sections, dim):
+        self.nlist = info['nlist']
+        self.nprobe = info['nprobe']
+        self.dim = dim
+        if np is not None:
+            self._centroids = np.frombuffer(sections['ivf_centroids'], dtype='<f4').reshape(self.nlist, dim)
+            self._offsets = np.frombuffer(sections['ivf_offsets'], dtype='<u8')
+            self._rows = np.frombuffer(sections['ivf_rows'], dtype='<u4')
+        else:
+            flat = struct.unpack_from(f'<{self.nlist * dim}f', sections['ivf_centroids'])
+            self._centroids = [flat[i * dim:(i + 1) * dim] for i in range(self.nlist)]
+            self._offsets = struct.unpack_from(f'<{self.nlist + 1}Q', sections['ivf_offsets'])
+            self._rows = memoryview(sections['ivf_rows']).cast('I')
+
+    def probe(self, q_unit, nprobe=None):
+        """The ``nprobe`` lists whose centroids are closest to ``q_unit``"""
+        nprobe = min(self.nprobe if nprobe is None else nprobe, self.nlist)
+        if np is not None:
+            scores = self._centroids @ np.asarray(q_unit, dtype=np.float32)
+            if nprobe >= self.nlist:
+                return np.arange(self.nlist)
+            return np.argpartition(-scores, nprobe - 1)[:nprobe]
+        scores = [sum(c * x for c, x in zip(centroid, q_unit)) for centroid in self._centroids]
+        return heapq.nlargest(nprobe, range(self.nlist), key=scores.__getitem__)
+
+    def candidates(self, q_unit, nprobe=None):
+        """Rows in the lists closest to ``q_unit``, ascending"""
+        lists = self.probe(q_unit, nprobe)
+        if np is not None:
+            parts = [self._rows[self._offsets[i]:self._offsets[i + 1]] for i in lists]
+            return np.sort(np.concatenate(parts)) if parts else np.empty(0, dtype=np.int64)
+        return sorted(row for i in lists for row in self._rows[self._offsets[i]:self._offsets[i + 1]])
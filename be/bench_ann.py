@@ -0,0 +1,73 @@
+"""
+Recall and latency of IVF approximate search vs exact search
+Run with: python bench_ann.py [index.idx|index.json] [--rows N] [--dim D] [--noise X] [--nlist N]
+
+Without an index argument a synthetic, clustered corpus is used; raise
+--noise to blur the clusters (IVF needs more probes as clusters overlap),
+and prefer a real index when one is at hand. Recall@k is measured against
+the exact ranking for each ``nprobe``; pick the smallest one whose recall
+is acceptable and set ANN_NPROBE for the deployment. ANN_MIN_ROWS should
+sit about where the exact scan gets slower than the IVF scan at that
+``nprobe``.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from ann_index import default_nlist
+from bench_quantization import load_corpus, make_queries
+from vector_index import load_index_bytes, serialize_index
+
+NPROBES = (1, 2, 4, 8, 16, 32, 64)
+
+
+def synthetic_corpus(n, dim, clusters, noise, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim))
+    return centers[rng.integers(0, clusters, size=n)] + noise * rng.normal(size=(n, dim))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('index', nargs='?', help='existing index to take embeddings from')
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--dim', type=int, default=1536)
+    parser.add_argument('--clusters', type=int, default=2000)
+    parser.add_argument('--noise', type=float, default=1.0)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--k', type=int, default=3)
+    parser.add_argument('--nlist', type=int, default=None)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.index) if args.index else synthetic_corpus(args.rows, args.dim, args.clusters, args.noise)
+    queries = make_queries(corpus, args.queries).tolist()
+
+    start = time.perf_counter()
+    blob = serialize_index([''] * len(corpus), corpus.tolist(), ann_min_rows=0, ann_nlist=args.nlist)
+    built = time.perf_counter() - start
+    index = load_index_bytes(blob)
+    nlist = index.ann().nlist
+    print(f"{len(corpus)} vectors x {corpus.shape[1]} dims, {nlist} lists "
+          f"(default {default_nlist(len(corpus))}), serialized in {built:.1f}s, recall@{args.k}")
+
+    def run(nprobe):
+        found, start = [], time.perf_counter()
+        for query in queries:
+            found.append({i for i, _ in index.search(query, args.k, nprobe=nprobe)})
+        return found, (time.perf_counter() - start) * 1000 / len(queries)
+
+    truth, exact_ms = run(0)
+    print(f"{'nprobe':>8}{'scanned':>9}{'recall':>9}{'ms/query':>10}")
+    print(f"{'exact':>8}{1:>9.1%}{1:>9.3f}{exact_ms:>10.2f}")
+    for nprobe in NPROBES:
+        if nprobe > nlist:
+            break
+        scanned = np.mean([len(index.ann_candidates(q, nprobe)) for q in queries[:20]]) / len(corpus)
+        found, ms = run(nprobe)
+        recall = sum(len(f & t) for f, t in zip(found, truth)) / (len(queries) * args.k)
+        print(f"{nprobe:>8}{scanned:>9.1%}{recall:>9.3f}{ms:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
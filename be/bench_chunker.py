@@ -0,0 +1,91 @@
+"""
+Chunking time and chunk sizes: the old character splitter vs chunker.py
+Run with: python bench_chunker.py [--mb 1 4 16] [--tokens N] [--overlap N]
+
+The input is synthetic Vietnamese/English prose with decimals and
+abbreviations, fed to the new chunker in 64 KB blocks like an uploaded text
+file. Time per MB should stay flat as the input grows (one linear pass).
+The token columns show how evenly each splitter fills the embedding budget.
+"""
+import argparse
+import random
+import re
+import statistics
+import time
+
+import chunker
+from chunker import estimate_tokens
+
+WORDS = ('tài liệu hợp đồng điều khoản thanh toán giao hàng bảo hành trách nhiệm thông báo phụ lục '
+         'document contract clause payment delivery warranty liability notice schedule annex').split()
+EXTRAS = ['giá 3.14 triệu', 'ông Dr. Smith', 'TP. HCM', 'v.v.', 'e.g. this', 'version 2.0.1']
+BLOCK = 64 * 1024
+
+
+def synthetic_text(size, seed=0):
+    rng = random.Random(seed)
+    parts, length = [], 0
+    while length < size:
+        words = [rng.choice(WORDS) for _ in range(rng.randint(4, 40))]
+        if rng.random() < 0.2:
+            words.insert(rng.randrange(len(words)), rng.choice(EXTRAS))
+        sentence = ' '.join(words).capitalize() + rng.choice(['. ', '. ', '? ', '!\n', '.\n\n'])
+        parts.append(sentence)
+        length += len(sentence)
+    return ''.join(parts)
+
+
+def legacy_split(text, chunk_size=800):
+    """BedrockRAG._split_text before chunker.py, kept verbatim for comparison"""
+    sentences = re.split(r'[.!?]+', text)
+    chunks = []
+    current_chunk = ""
+
+    for sentence in sentences:
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+
+        if len(current_chunk) + len(sentence) < chunk_size:
+            current_chunk += sentence + ". "
+        else:
+            if current_chunk:
+                chunks.append({"page_content": current_chunk.strip()})
+            current_chunk = sentence + ". "
+
+    if current_chunk:
+        chunks.append({"page_content": current_chunk.strip()})
+
+    return chunks
+
+
+def _report(name, mb, elapsed, chunks):
+    tokens = [estimate_tokens(chunk['page_content']) for chunk in chunks]
+    print(f"{name:>8}{mb:>6}{elapsed:>9.2f}{mb / elapsed:>8.1f}{len(chunks):>9}"
+          f"{statistics.mean(tokens):>8.0f}{statistics.pstdev(tokens):>7.0f}{max(tokens):>6}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mb', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--tokens', type=int, default=200)
+    parser.add_argument('--overlap', type=int, default=30)
+    args = parser.parse_args()
+
+    print(f"new chunker: {args.tokens} tokens, {args.overlap} overlap; old: 800 characters, no overlap")
+    print(f"{'splitter':>8}{'MB':>6}{'seconds':>9}{'MB/s':>8}{'chunks':>9}{'tokens':>8}{'stdev':>7}{'max':>6}")
+    for mb in args.mb:
+        text = synthetic_text(mb * 1024 * 1024)
+
+        start = time.perf_counter()
+        chunks = legacy_split(text)
+        _report('old', mb, time.perf_counter() - start, chunks)
+
+        start = time.perf_counter()
+        blocks = (text[i:i + BLOCK] for i in range(0, len(text), BLOCK))
+        chunks = list(chunker.iter_chunks(blocks, args.tokens, args.overlap))
+        _report('new', mb, time.perf_counter() - start, chunks)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Embedding throughput vs worker count against a simulated Bedrock endpoint
+Run with: python bench_embedding.py [--chunks N] [--latency MS] [--jitter MS]
+
+The simulated client sleeps for a latency drawn around --latency per
+invoke_model call (network + model time dominate real embedding calls, so
+threads scale until the account's TPS limit, which is not modelled here).
+"""
+import argparse
+import io
+import json
+import random
+import threading
+import time
+
+from rag_bedrock import BedrockRAG
+
+WORKER_COUNTS = [1, 2, 4, 8, 16, 32]
+
+
+class SimulatedBedrock:
+    """Stand-in for the bedrock-runtime client with fixed per-call latency"""
+
+    def __init__(self, latency, jitter, dim=1536, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.dim = dim
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def invoke_model(self, modelId, body):
+        with self._lock:
+            self.calls += 1
+            delay = max(0.0, self._rng.gauss(self.latency, self.jitter))
+        time.sleep(delay)
+        text = json.loads(body)['inputText']
+        # deterministic fake embedding so order can be checked
+        embedding = [float(len(text))] + [0.0] * (self.dim - 1)
+        return {'body': io.BytesIO(json.dumps({'embedding': embedding}).encode('utf-8'))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chunks', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=60.0, help='mean ms per call')
+    parser.add_argument('--jitter', type=float, default=15.0, help='ms standard deviation')
+    args = parser.parse_args()
+
+    # distinct texts so neither the embedding cache nor in-batch dedup kicks in
+    texts = [f"chunk {i}" + ' x' * (i % 97) for i in range(args.chunks)]
+    print(f"{args.chunks} chunks, simulated latency {args.latency:.0f}±{args.jitter:.0f} ms")
+    print(f"{'workers':>8}{'seconds':>10}{'chunks/s':>10}{'speedup':>9}")
+
+    baseline = None
+    for workers in WORKER_COUNTS:
+        client = SimulatedBedrock(args.latency / 1000, args.jitter / 1000)
+        rag = BedrockRAG(bedrock_runtime=client, embed_concurrency=workers, embed_max_concurrency=workers)
+        start = time.perf_counter()
+        embeddings = rag.embed_texts(texts)
+        elapsed = time.perf_counter() - start
+
+        assert [e[0] for e in embeddings] == [float(len(t)) for t in texts], "order not preserved"
+        throughput = len(texts) / elapsed
+        baseline = baseline or throughput
+        print(f"{workers:>8}{elapsed:>10.2f}{throughput:>10.1f}{throughput / baseline:>8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+PDF text extraction time vs worker process count on a synthetic PDF
+Run with: python bench_pdf_extract.py [--pages N] [--lines N] [--max-processes N]
+
+The PDF has --pages pages of --lines lines of plain Helvetica text, which
+is the text-heavy case where pypdf's pure-Python extraction dominates.
+Speedup needs real cores: on the 3008 MB Lambda (2 vCPUs) expect up to ~2x,
+minus the fixed cost of starting the worker interpreters.
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from pypdf import PdfWriter
+from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject
+
+import pdf_extract
+
+WORDS = ('tài liệu hợp đồng điều khoản thanh toán document contract clause payment '
+         'delivery warranty liability notice schedule annex party').split()
+
+
+def write_synthetic_pdf(path, pages, lines_per_page=60, seed=0):
+    """Text-only PDF (ASCII-folded words so the standard font can show them)"""
+    rng = random.Random(seed)
+    words = [w.encode('ascii', 'ignore').decode() or 'x' for w in WORDS]
+    writer = PdfWriter()
+    font = writer._add_object(DictionaryObject({
+        NameObject('/Type'): NameObject('/Font'),
+        NameObject('/Subtype'): NameObject('/Type1'),
+        NameObject('/BaseFont'): NameObject('/Helvetica'),
+    }))
+    for number in range(pages):
+        lines = [f"Page {number + 1}."]
+        for _ in range(lines_per_page):
+            lines.append(' '.join(rng.choice(words) for _ in range(12)) + '.')
+        body = ' T* '.join(f"({line}) Tj" for line in lines)
+        stream = DecodedStreamObject()
+        stream.set_data(f"BT /F1 9 Tf 11 TL 36 756 Td {body} ET".encode('ascii'))
+        page = writer.add_blank_page(612, 792)
+        page[NameObject('/Contents')] = writer._add_object(stream)
+        page[NameObject('/Resources')] = DictionaryObject({
+            NameObject('/Font'): DictionaryObject({NameObject('/F1'): font})})
+    with open(path, 'wb') as f:
+        writer.write(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=400)
+    parser.add_argument('--lines', type=int, default=60)
+    parser.add_argument('--max-processes', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'synthetic.pdf')
+        write_synthetic_pdf(path, args.pages, args.lines)
+        print(f"{args.pages} pages x {args.lines} lines ({os.path.getsize(path) / 1e6:.1f} MB), "
+              f"{os.cpu_count()} CPUs")
+        print(f"{'processes':>10}{'seconds':>10}{'pages/s':>10}{'speedup':>9}")
+
+        reference, baseline = None, None
+        for processes in range(1, max(args.max_processes, 1) + 1):
+            start = time.perf_counter()
+            pages = list(pdf_extract.iter_pdf_pages(path, processes=processes, min_pages=0))
+            elapsed = time.perf_counter() - start
+
+            reference = reference or pages
+            assert pages == reference, "page order not preserved"
+            throughput = len(pages) / elapsed
+            baseline = baseline or throughput
+            print(f"{processes:>10}{elapsed:>10.2f}{throughput:>10.1f}{throughput / baseline:>8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""Token-aware sentence chunking in one pass over streamed text.
+
+The previous splitter ended a sentence at every ``[.!?]+`` (so "3.14",
+"Dr." and "v.v." were sentence ends), dropped the punctuation, measured
+chunks in characters and never applied ``chunk_overlap``. This one:
+
+* ends sentences at terminal punctuation followed by whitespace, unless the
+  next word starts lowercase or the period follows a known abbreviation or
+  a single capital (an initial), and at blank lines. The text is kept as is;
+* sizes chunks in estimated tokens (``estimate_tokens``), the unit the
+  embedding model's input limit and price are counted in;
+* starts each chunk with up to ``overlap_tokens`` worth of whole sentences
+  from the end of the previous one;
+* records each chunk's character offsets ``[start, end)`` in the document
+  (its pages concatenated, so ``text[start:end] == page_content``) and, for
+  paged sources, the page numbers it covers.
+
+Pages or text blocks stream through it. Only the unfinished sentence and
+the sentences of the current chunk are held, and each sentence is scanned,
+added and dropped once, so the work is linear in the document size. The
+output does not depend on where the pieces were cut.
+"""
+import bisect
+import itertools
+import re
+from collections import deque
+
+SPLITTER = 'sentence-tokens-1'
+# Rough size of a token: words cost one token per started 4 characters,
+# each punctuation mark one (errs on the high side for Vietnamese syllables)
+CHARS_PER_TOKEN = 4
+
+_TOKEN = re.compile(r'\w+|[^\w\s]')
+# one match per estimated token (see _token_cost)
+_TOKEN_UNIT = re.compile(r'\w{1,%d}|[^\w\s]' % CHARS_PER_TOKEN)
+_BOUNDARY = re.compile(r'[.!?…]+["\'”’)\]]*\s+|\n\s*\n\s*')
+_LAST_WORD = re.compile(r'(\w+(?:\.\w+)*)$')
+# characters a boundary is made of: a piece ending in them may continue one
+_BOUNDARY_CHARS = frozenset('.!?…"\'”’)]')
+ABBREVIATIONS = frozenset((
+    'mr', 'mrs', 'ms', 'dr', 'prof', 'sr', 'jr', 'st', 'vs', 'e.g', 'i.e', 'fig', 'vol', 'inc', 'ltd',
+    'corp', 'tp', 'ths', 'ts', 'pgs', 'gs', 'v.v', 'tr',
+))
+
+
+def _token_cost(length):
+    return 1 + (length - 1) // CHARS_PER_TOKEN
+
+
+def estimate_tokens(text):
+    return len(_TOKEN_UNIT.findall(text))
+
+
+def iter_chunks(pieces, max_tokens, overlap_tokens=0, paged=False):
+    """Chunks of at most ``max_tokens`` estimated tokens.
+
+    Each chunk is ``{"page_content", "start", "end", "tokens"}``, plus
+    ``"pages"`` (1-based page numbers) when ``paged``: then every piece is
+    one page.
+    """
+    page_starts = [] if paged else None
+    window, window_tokens = deque(), 0
+    for sentence in iter_sentences(pieces, max_tokens * CHARS_PER_TOKEN, page_starts):
+        for part in _fit(sentence, max_tokens):
+            tokens = part[2]
+            if window_tokens and window_tokens + tokens > max_tokens:
+                yield _chunk(window, window_tokens, page_starts)
+                # keep whole sentences from the end as overlap, leaving room for this one
+                keep = min(overlap_tokens, max_tokens - tokens)
+                while window_tokens > keep:
+                    window_tokens -= window.popleft()[2]
+            window.append(part)
+            window_tokens += tokens
+    if window_tokens:
+        yield _chunk(window, window_tokens, page_starts)
+
+
+def iter_sentences(pieces, max_chars=None, page_starts=None):
+    """``(text, offset)`` of each sentence of the text streamed as ``pieces``.
+
+    ``text`` runs from the end of the previous sentence to the end of this
+    one's trailing whitespace, so the texts concatenate back to the
+    document; ``offset`` is where it starts in the document. Sentences
+    longer than ``max_chars`` are cut at a space. The document offset of
+    each piece is appended to ``page_starts``.
+    """
+    tail, base = '', 0  # unfinished sentence and its document offset
+    for piece in itertools.chain(pieces, (None,)):
+        final = piece is None
+        if final:
+            work = tail
+        else:
+            if page_starts is not None:
+                page_starts.append(base + len(tail))
+            work = tail + piece
+        start = 0
+        for m in _BOUNDARY.finditer(work):
+            while max_chars and m.start() - start > max_chars:
+                cut = _cut(work, start, max_chars)
+                yield work[start:cut], base + start
+                start = cut
+            if m.end() == len(work) and not final:
+                break  # the whitespace may go on in the next piece
+            if _ends_sentence(work, m, start):
+                yield work[start:m.end()], base + start
+                start = m.end()
+
+        # no boundary can start before ``safe`` any more
+        safe = len(work)
+        while not final and safe > start and (work[safe - 1] in _BOUNDARY_CHARS or work[safe - 1].isspace()):
+            safe -= 1
+        while max_chars and safe - start > max_chars:
+            cut = _cut(work, start, max_chars)
+            yield work[start:cut], base + start
+            start = cut
+        if final:
+            if start < len(work):
+                yield work[start:], base + start
+        else:
+            tail, base = work[start:], base + start
+
+
+def _ends_sentence(work, m, start):
+    mark = m.group()
+    if mark[0] != '.' or mark.count('\n') > 1:
+        return True  # ! ? … or a blank line
+    if m.end() < len(work) and work[m.end()].islower():
+        return False
+    word = _LAST_WORD.search(work, max(start, m.start() - 32), m.start())
+    if word:
+        word = word.group(1)
+        if word.lower() in ABBREVIATIONS or (len(word) == 1 and word.isupper()):
+            return False
+    return True
+
+
+def _cut(work, start, max_chars):
+    """End of an overlong sentence: the last space within ``max_chars``"""
+    limit = start + max_chars
+    cut = max(work.rfind(' ', start + 1, limit), work.rfind('\n', start + 1, limit))
+    return cut + 1 if cut > start else limit
+
+
+def _fit(sentence, max_tokens):
+    """``(text, offset, tokens)`` parts of a sentence, split between tokens if too long"""
+    text, offset = sentence
+    tokens = estimate_tokens(text)
+    if tokens <= max_tokens:
+        yield text, offset, tokens
+        return
+    begin = count = 0
+    for m in _TOKEN.finditer(text):
+        cost = _token_cost(m.end() - m.start())
+        if count and count + cost > max_tokens:
+            yield text[begin:m.start()], offset + begin, count
+            begin, count = m.start(), 0
+        count += cost
+    yield text[begin:], offset + begin, count
+
+
+def _chunk(window, tokens, page_starts):
+    joined = ''.join(part[0] for part in window)
+    text = joined.strip()
+    start = window[0][1] + len(joined) - len(joined.lstrip())
+    chunk = {'page_content': text, 'start': start, 'end': start + len(text), 'tokens': tokens}
+    if page_starts is not None:
+        first = bisect.bisect_right(page_starts, start)
+        last = bisect.bisect_right(page_starts, max(start, chunk['end'] - 1))
+        chunk['pages'] = list(range(max(first, 1), last + 1))
+    return chunk
@@ -0,0 +1,238 @@
+"""Questions across a collection of documents, routed to a few of them.
+
+A session holds the handful of documents one user uploaded. A collection
+holds every document a team uploads under its ``collection_id`` and is kept
+until its item is deleted. Searching every chunk index of a collection for
+each question would make a question cost as much as the collection is
+large, so a question is answered in two steps:
+
+1. routing: each document is summarised by the centroid of its chunk
+   embeddings (their normalised mean), and the collection keeps a routing
+   index with one row per document. The question embedding is scored
+   against it and only the ``candidates`` closest documents go on; a
+   question that cannot be embedded is routed by keywords over the rows'
+   text (the filename and the document's first chunk);
+2. search: the chunk indexes of those documents are loaded in parallel and
+   searched as a session index would be. Cosine scores of different
+   indexes are on one scale and are merged as they are; BM25 scores are
+   merged the same way (approximate, as each index has its own IDF), and
+   the two rankings are fused with RRF as in search_engine.hybrid_search.
+
+Routing costs one dot product per document; loading and searching scale
+with the candidates, not with the collection.
+
+Collections live in ``DocQASessions`` under ``session_id =
+collection#<collection_id>``. The item only points at the routing index
+(``s3_key``, under vector_stores/collections/<collection_id>/); the
+document list (document_id, filename, chunks_count, index_key[, doc_key])
+is that index's ``documents`` metadata, so a collection is not bounded by
+DynamoDB's item size. Additions are serialized on ``documents_version`` as
+for sessions (see session_store), and document indexes are shared through
+the document registry with the collection item as the holder.
+"""
+import logging
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+import search_engine
+from session_store import MAX_ATTEMPTS, NEW_VERSION_CONDITION, VERSION_CONDITION, holds_document
+from vector_index import load_index_bytes, merge_indexes, serialize_index
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy is in requirements.txt
+    np = None
+
+logger = logging.getLogger(__name__)
+
+COLLECTION_PREFIX = 'collection#'
+ROUTING_INDEX_PREFIX = 'vector_stores/collections/'
+COLLECTION_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,64}')
+# Documents whose chunk indexes are searched for a question
+COLLECTION_CANDIDATES = 8
+# Chunk indexes loaded at once
+LOAD_WORKERS = 8
+# Characters of a document's first chunk kept on its routing row
+ROUTING_TEXT_CHARS = 500
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def collection_key(collection_id):
+    """``session_id`` of a collection's item"""
+    return COLLECTION_PREFIX + collection_id
+
+
+def is_collection(session_id):
+    return bool(session_id) and session_id.startswith(COLLECTION_PREFIX)
+
+
+def valid_collection_id(collection_id):
+    return isinstance(collection_id, str) and COLLECTION_ID_PATTERN.fullmatch(collection_id) is not None
+
+
+def _is_condition_failure(error):
+    return error.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException'
+
+
+# -- routing rows ------------------------------------------------------
+
+def centroid(index):
+    """Normalised mean of the unit chunk embeddings of ``index`` (None without any)"""
+    if not index.has_vectors or not len(index):
+        return None
+    norms = index.norms()
+    if np is not None:
+        rows = np.asarray(index.matrix(), dtype=np.float64)[np.asarray(norms) > 0]
+        if not len(rows):
+            return None
+        rows /= np.linalg.norm(rows, axis=1, keepdims=True)
+        return search_engine.unit_vector(rows.mean(axis=0).tolist())
+    units = [search_engine.unit_vector(index.vector(i)) for i in range(len(index)) if norms[i]]
+    if not units:
+        return None
+    return search_engine.unit_vector([sum(column) / len(units) for column in zip(*units)])
+
+
+def routing_row(index, filename):
+    """(text, centroid) summarising a document's chunk index on the routing index"""
+    text = filename
+    if len(index):
+        text += '\n' + index.text(0)[:ROUTING_TEXT_CHARS]
+    return text, centroid(index)
+
+
+def append_routing(previous, document, row, metadata=None):
+    """Bytes of the routing index ``previous`` (None when empty) plus one row for ``document``"""
+    documents = (previous.documents if previous is not None else []) + [
+        dict(document, start=len(previous) if previous is not None else 0, count=1)]
+    metadata = dict(metadata or {}, documents=documents)
+    text, vector = row
+    if previous is None or not previous.dim:
+        texts = (previous.texts if previous is not None else []) + [text]
+        return serialize_index(texts, [[]] * (len(texts) - 1) + [vector or []], metadata, lexical=True)
+    # the stored rows are copied as they are; only the new one is encoded
+    added = load_index_bytes(serialize_index([text], [vector or [0.0] * previous.dim]))
+    return merge_indexes([previous, added], metadata, lexical=True)
+
+
+# -- collection items --------------------------------------------------
+
+class CollectionStore:
+    """Collection items in ``DocQASessions`` plus their routing indexes"""
+
+    def __init__(self, table, s3, bucket, clock=time.time):
+        self.table = table
+        self.s3 = s3
+        self.bucket = bucket
+        self.clock = clock
+
+    def get(self, collection_id):
+        return self.table.get_item(Key={'session_id': collection_key(collection_id)},
+                                   ConsistentRead=True).get('Item')
+
+    def routing(self, item):
+        """The routing index of a collection item (None while it has no documents)"""
+        if not item or not item.get('s3_key'):
+            return None
+        return load_index_bytes(self.s3.get_object(Bucket=self.bucket, Key=item['s3_key'])['Body'].read())
+
+    def add(self, collection_id, document, row):
+        """Add ``document``, summarised by its routing ``row``, creating the collection if needed.
+
+        Returns the updated item. A document the collection already holds
+        (same index or content) changes nothing.
+        """
+        for _ in range(MAX_ATTEMPTS):
+            item = self.get(collection_id) or {'session_id': collection_key(collection_id),
+                                               'collection_id': collection_id}
+            previous = self.routing(item)
+            if previous is not None and holds_document(previous.documents, document):
+                return item
+
+            version = int(item.get('documents_version', 0))
+            index_key = f"{ROUTING_INDEX_PREFIX}{collection_id}/{version + 1}-{uuid.uuid4().hex[:8]}.idx"
+            self.s3.put_object(Bucket=self.bucket, Key=index_key, ContentType='application/octet-stream',
+                               Body=append_routing(previous, document, row, {'collection_id': collection_id}))
+
+            updated = dict(item, s3_key=index_key, documents_version=version + 1,
+                           documents_count=len(previous or ()) + 1,
+                           chunks_count=int(item.get('chunks_count', 0)) + int(document['chunks_count']),
+                           updated_at=int(self.clock()))
+            condition = {'ConditionExpression': NEW_VERSION_CONDITION}
+            if version:
+                condition = {'ConditionExpression': VERSION_CONDITION,
+                             'ExpressionAttributeValues': {':version': version}}
+            try:
+                self.table.put_item(Item=updated, **condition)
+            except ClientError as e:
+                self.s3.delete_object(Bucket=self.bucket, Key=index_key)
+                if not _is_condition_failure(e):
+                    raise
+                logger.info(f"Collection {collection_id} changed while adding {document['filename']}, retrying")
+                continue
+
+            if item.get('s3_key'):
+                self.s3.delete_object(Bucket=self.bucket, Key=item['s3_key'])
+            logger.info(f"🗂️ Collection {collection_id} now holds {updated['documents_count']} documents")
+            return updated
+        raise RuntimeError(f"Collection {collection_id} kept changing while adding {document['filename']}")
+
+
+# -- questions ---------------------------------------------------------
+
+def _executor():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=LOAD_WORKERS, thread_name_prefix='collection-load')
+        return _pool
+
+
+def route(routing, question, query_emb, n=COLLECTION_CANDIDATES):
+    """Routing rows of the ``n`` documents closest to the question, best first"""
+    hits = []
+    if query_emb:
+        hits = [(i, score) for i, score in routing.search(query_emb, n) if score > -1]
+    if not hits:
+        hits = routing.lexical_search(question, n)
+    return [i for i, _ in hits]
+
+
+def search(routing, load_index, question, query_emb, k=3, candidates=COLLECTION_CANDIDATES,
+           weights=(1.0, 1.0), per_document=search_engine.HYBRID_CANDIDATES, rrf_k=search_engine.RRF_K,
+           nprobe=None):
+    """Top ``k`` (document, index, row, score) hits of a collection, best first.
+
+    ``load_index(index_key)`` returns a document's chunk index; the
+    candidates are loaded and searched on worker threads. ``weights`` are
+    the (vector, keyword) RRF weights; a ranking with weight 0 is skipped.
+    """
+    vector_weight, lexical_weight = weights
+    if not query_emb:
+        vector_weight = 0
+
+    def search_document(row):
+        index = load_index(routing.document(row)['index_key'])
+        vector = search_engine.search(index, query_emb, per_document, nprobe=nprobe) if vector_weight else []
+        lexical = index.lexical_search(question, per_document) if lexical_weight else []
+        return index, [(i, score) for i, score in vector if score > -1], lexical
+
+    rows = route(routing, question, query_emb, candidates)
+    results = list(_executor().map(search_document, rows))
+    logger.info(f"Routed to {len(rows)} of {len(routing)} documents")
+
+    indexes, vector, lexical = {}, [], []
+    for row, (index, vector_hits, lexical_hits) in zip(rows, results):
+        indexes[row] = index
+        vector.extend(((row, i), score) for i, score in vector_hits)
+        lexical.extend(((row, i), score) for i, score in lexical_hits)
+    rankings = [sorted(hits, key=lambda hit: -hit[1])[:max(k, per_document)] for hits in (vector, lexical)]
+    fused = search_engine.fuse(rankings, k, [vector_weight, lexical_weight], rrf_k)
+    return [(routing.document(row), indexes[row], i, score) for (row, i), score in fused]
@@ -0,0 +1,36 @@
+"""
+Fixtures shared by the test modules
+"""
+import pytest
+
+import handler
+import ingestion
+import session_store
+from collection_search import CollectionStore
+from document_registry import DocumentRegistry
+from embedding_cache import EmbeddingCache
+from fakes import NO_SLEEP, FakeBedrock, FakeDocumentTable, FakeJobTable, SessionTable, UploadS3
+from fanout import LocalQueue
+from rag_bedrock import BedrockRAG
+from session_cache import SessionCache
+from tmp_cache import TmpCache
+
+
+@pytest.fixture
+def pipeline(monkeypatch, tmp_path):
+    """handler wired to in-memory S3/DynamoDB stand-ins and a fake Bedrock"""
+    s3, sessions, bedrock = UploadS3(), SessionTable(), FakeBedrock()
+    monkeypatch.setattr(handler, 's3', s3)
+    monkeypatch.setattr(handler, 'table', sessions)
+    monkeypatch.setattr(handler, 'session_store', session_store.SessionStore(
+        sessions, s3, handler.S3_BUCKET, ingestion.SESSION_TTL_HOURS))
+    monkeypatch.setattr(handler, 'collections', CollectionStore(sessions, s3, handler.S3_BUCKET))
+    monkeypatch.setattr(handler, 'jobs', ingestion.JobStore(FakeJobTable()))
+    monkeypatch.setattr(handler, 'document_registry', DocumentRegistry(FakeDocumentTable()))
+    monkeypatch.setattr(handler, 'tmp_cache', TmpCache(str(tmp_path / 'cache')))
+    monkeypatch.setattr(handler, 'session_cache', SessionCache(10 ** 8))
+    monkeypatch.setattr(handler, 'bedrock_rag', BedrockRAG(
+        bedrock_runtime=bedrock, retry_policy=NO_SLEEP, embedding_cache=EmbeddingCache()))
+    monkeypatch.setattr(handler, 'ingest_queue', LocalQueue(
+        consumer=lambda message: handler.ingestion_worker().run_batch(message)))
+    return s3, sessions, bedrock
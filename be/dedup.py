@@ -0,0 +1,210 @@
+"""Boilerplate and duplicate removal between extraction and embedding.
+
+Documents from our document system repeat the same header, footer,
+disclaimer and table-of-contents lines on every page. Embedding every copy
+costs Bedrock calls, and the copies crowd real content out of the top-k.
+Two streaming stages run before embedding:
+
+* ``strip_boilerplate`` blanks page lines that recur on many pages, plus a
+  bare page number as a page's first or last line. Lines are overwritten
+  with spaces rather than removed, so chunk offsets still point into the
+  extracted text. A line's page count is looked up ``lookahead`` pages
+  after the page it is on, so headers are caught from the first page on.
+* ``dedup_chunks`` drops a chunk when its normalized text was already
+  kept (exact duplicate), or when its 64-bit SimHash over word shingles is
+  within ``NEAR_DUPLICATE_BITS`` of a kept chunk's (near duplicate). The
+  kept chunk's ``positions`` list grows by the dropped chunk's offsets and
+  pages. Only digests, fingerprints and ``positions`` lists are kept, not
+  the chunks' text. On chunks of ~200 tokens a one-word edit moves the hash by 4 bits
+  (median; 7 at the 90th percentile), while distinct chunks, even in a
+  small vocabulary, stay 15+ bits apart.
+
+Near duplicates are looked up by multi-index hashing: the hash is cut into
+four 16-bit blocks, and two hashes at most 7 bits apart differ in at most
+one bit of some block. Probing each block's value and its 16 one-bit
+neighbours finds every candidate in 68 dict lookups, however many chunks
+were kept.
+
+Both stages depend only on the document, so a retried job drops the same
+chunks and its embedding batches line up with the earlier checkpoints.
+"""
+import hashlib
+import logging
+import re
+from collections import Counter, deque
+
+from embedding_cache import normalize_text
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy is in requirements.txt
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# Changes the chunks produced for a document (part of chunking_settings)
+DEDUP_VERSION = 'boilerplate-simhash-1'
+
+# A line is boilerplate when it is on at least this many pages and this share of the pages read
+BOILERPLATE_MIN_PAGES = 3
+BOILERPLATE_PAGE_RATIO = 0.5
+BOILERPLATE_LOOKAHEAD = 8
+BOILERPLATE_MAX_LINE = 300
+
+SIMHASH_BITS = 64
+# at most 7 (see _probes)
+NEAR_DUPLICATE_BITS = 7
+SHINGLE_WORDS = 3
+# Shorter chunks give unstable SimHashes; they are only deduplicated exactly
+NEAR_DUPLICATE_MIN_WORDS = 12
+_BLOCKS = 4
+_BLOCK_BITS = SIMHASH_BITS // _BLOCKS
+_BLOCK_MASK = (1 << _BLOCK_BITS) - 1
+_MASK64 = (1 << 64) - 1
+# shingle hash = mix(w0 * _MUL[0] + w1 * _MUL[1] + w2) over the word hashes
+_MUL = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F)
+
+_WORD = re.compile(r'\w+')
+_PAGE_NUMBER = re.compile(r'^\W*(?:page|trang|p\.)?\s*\d{1,4}(?:\s*(?:/|of|trên)\s*\d{1,4})?\W*$', re.IGNORECASE)
+
+
+def _line_key(line):
+    key = ' '.join(line.lower().split())
+    return key if 0 < len(key) <= BOILERPLATE_MAX_LINE else None
+
+
+def strip_boilerplate(pages, min_pages=BOILERPLATE_MIN_PAGES, ratio=BOILERPLATE_PAGE_RATIO,
+                      lookahead=BOILERPLATE_LOOKAHEAD):
+    """Pages with recurring lines blanked; each page keeps its length"""
+    counts = Counter()
+    pending = deque()
+    seen = blanked = 0
+
+    def release():
+        nonlocal blanked
+        lines, keys = pending.popleft()
+        threshold = max(min_pages, ratio * seen)
+        edges = [n for n, key in enumerate(keys) if key]
+        edges = {edges[0], edges[-1]} if edges else set()
+        for n, key in enumerate(keys):
+            if key and (counts[key] >= threshold or (n in edges and _PAGE_NUMBER.match(key))):
+                lines[n] = ' ' * len(lines[n])
+                blanked += 1
+        return '\n'.join(lines)
+
+    for page in pages:
+        lines = page.split('\n')
+        keys = [_line_key(line) for line in lines]
+        counts.update({key for key in keys if key})
+        seen += 1
+        pending.append((lines, keys))
+        if len(pending) > lookahead:
+            yield release()
+    while pending:
+        yield release()
+    if blanked:
+        logger.info(f"Blanked {blanked} boilerplate lines on {seen} pages")
+
+
+def _word_hash(word):
+    return int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def _mix(x):
+    """splitmix64 finalizer (every input bit affects every output bit)"""
+    x = (x ^ x >> 30) * 0xBF58476D1CE4E5B9 & _MASK64
+    x = (x ^ x >> 27) * 0x94D049BB133111EB & _MASK64
+    return x ^ x >> 31
+
+
+def simhash(words, word_hashes=None):
+    """64-bit SimHash of the ``SHINGLE_WORDS``-word shingles of ``words``.
+
+    ``word_hashes`` memoizes the (stable, blake2b) hash of each word across calls.
+    """
+    if word_hashes is None:
+        word_hashes = {}
+    for word in set(words).difference(word_hashes):
+        word_hashes[word] = _word_hash(word)
+    hashes = list(map(word_hashes.__getitem__, words))
+    hashes += [0] * (SHINGLE_WORDS - len(hashes))  # fewer words than one shingle
+
+    if np is not None:
+        w = np.array(hashes, dtype=np.uint64)
+        x = w[:-2] * np.uint64(_MUL[0]) + w[1:-1] * np.uint64(_MUL[1]) + w[2:]
+        x = (x ^ x >> np.uint64(30)) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ x >> np.uint64(27)) * np.uint64(0x94D049BB133111EB)
+        x ^= x >> np.uint64(31)
+        bits = np.unpackbits(x.astype('<u8').view(np.uint8).reshape(-1, 8), axis=1, bitorder='little')
+        votes = bits.sum(axis=0, dtype=np.int64) * 2 > len(x)
+        return int.from_bytes(np.packbits(votes, bitorder='little').tobytes(), 'little')
+
+    shingles = [_mix((a * _MUL[0] + b * _MUL[1] + c) & _MASK64)
+                for a, b, c in zip(hashes, hashes[1:], hashes[2:])]
+    counts = [0] * SIMHASH_BITS
+    for value in shingles:
+        for bit in range(SIMHASH_BITS):
+            counts[bit] += value >> bit & 1
+    return sum(1 << bit for bit, count in enumerate(counts) if count * 2 > len(shingles))
+
+
+def _probes(fingerprint):
+    """Each 16-bit block of ``fingerprint`` and its one-bit neighbours, as table keys"""
+    for block in range(_BLOCKS):
+        value = fingerprint >> block * _BLOCK_BITS & _BLOCK_MASK
+        yield block, value
+        for bit in range(_BLOCK_BITS):
+            yield block, value ^ 1 << bit
+
+
+def _position(chunk):
+    position = {'start': chunk.get('start'), 'end': chunk.get('end')}
+    if 'pages' in chunk:
+        position['pages'] = chunk['pages']
+    return position
+
+
+def dedup_chunks(chunks, near_bits=NEAR_DUPLICATE_BITS):
+    """Chunks without exact or near duplicates of earlier ones.
+
+    Each chunk gets ``positions``: its own position first, then those of
+    the duplicates dropped in its favour. Duplicates are found after the
+    chunk has been yielded, so ``positions`` is best-effort while the
+    stream is being read and complete once it is exhausted.
+    """
+    exact, blocks, word_hashes = {}, {}, {}
+    dropped = near = 0
+    for chunk in chunks:
+        text = normalize_text(chunk['page_content']).lower()
+        key = hashlib.sha1(text.encode('utf-8')).digest()
+        kept = exact.get(key)
+
+        fingerprint = None
+        words = _WORD.findall(text)
+        if kept is None and len(words) >= NEAR_DUPLICATE_MIN_WORDS:
+            fingerprint = simhash(words, word_hashes)
+            kept = _nearest(blocks, fingerprint, near_bits)
+            near += kept is not None
+
+        if kept is not None:
+            kept.append(_position(chunk))
+            dropped += 1
+            continue
+
+        positions = chunk['positions'] = [_position(chunk)]
+        exact[key] = positions
+        if fingerprint is not None:
+            for block in range(_BLOCKS):
+                key = block, fingerprint >> block * _BLOCK_BITS & _BLOCK_MASK
+                blocks.setdefault(key, []).append((fingerprint, positions))
+        yield chunk
+    if dropped:
+        logger.info(f"Dropped {dropped - near} duplicate and {near} near-duplicate chunks")
+
+
+def _nearest(blocks, fingerprint, near_bits):
+    for key in _probes(fingerprint):
+        for other, positions in blocks.get(key, ()):
+            if (fingerprint ^ other).bit_count() <= near_bits:
+                return positions
+    return None
@@ -0,0 +1,155 @@
+"""Registry of built indexes, keyed by document content.
+
+Uploading a file that has already been indexed with the same chunking,
+embedding and index settings should not extract, split or embed anything.
+Each built index is recorded under ``doc_key = sha256(content):fingerprint``
+together with the set of sessions that point at it:
+
+* ``acquire`` adds a session to a live record (``ref_count > 0``) and
+  returns it, or None when there is nothing to reuse;
+* ``register`` records a freshly built index for its first session; if a
+  concurrent upload registered the same content first, the caller is told
+  to use that one instead;
+* ``release`` removes a session when its ``DocQASessions`` item is deleted
+  (TTL expiry arrives through the table's stream). The session that drops
+  ``ref_count`` to zero deletes the record, and the caller deletes the index.
+
+Sessions are tracked in a string set and removed with a ``contains``
+condition, so replayed stream records never release the same session twice.
+Records at zero can no longer be acquired, so a shared index is never
+resurrected while it is being deleted.
+"""
+import base64
+import binascii
+import hashlib
+import json
+import logging
+import time
+
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+def hex_to_checksum(hex_digest):
+    """Hex sha256 -> the base64 form S3 uses for ``ChecksumSHA256``"""
+    try:
+        raw = bytes.fromhex(hex_digest)
+    except (TypeError, ValueError):
+        raise ValueError('sha256 must be a hex digest')
+    if len(raw) != 32:
+        raise ValueError('sha256 must be a hex digest')
+    return base64.b64encode(raw).decode('ascii')
+
+
+def checksum_to_hex(checksum):
+    """S3 ``ChecksumSHA256`` -> hex, or None for composite (multipart) checksums"""
+    if not checksum or '-' in checksum:
+        return None
+    try:
+        raw = base64.b64decode(checksum, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+    return raw.hex() if len(raw) == 32 else None
+
+
+def settings_fingerprint(settings):
+    """Short stable hash of everything that shapes an index besides the content"""
+    encoded = json.dumps(settings, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()[:16]
+
+
+def document_key(content_sha256, fingerprint):
+    return f"{content_sha256}:{fingerprint}"
+
+
+def _is_condition_failure(error):
+    return error.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException'
+
+
+class DocumentRegistry:
+    """Reference-counted content -> index records in a DynamoDB table"""
+
+    def __init__(self, table, clock=time.time):
+        self.table = table
+        self.clock = clock
+
+    def acquire(self, doc_key, session_id):
+        """Add ``session_id`` to a live record and return it, else None"""
+        try:
+            response = self.table.update_item(
+                Key={'doc_key': doc_key},
+                UpdateExpression='ADD ref_count :one, sessions :session SET last_used_at = :now',
+                ConditionExpression='ref_count > :zero AND NOT contains(sessions, :session_id)',
+                ExpressionAttributeValues={
+                    ':one': 1, ':zero': 0, ':session': {session_id}, ':session_id': session_id,
+                    ':now': int(self.clock())},
+                ReturnValues='ALL_NEW')
+        except ClientError as e:
+            if _is_condition_failure(e):
+                return None
+            raise
+        return response.get('Attributes')
+
+    def register(self, doc_key, session_id, index_key, filename, chunks_count):
+        """Record a new index owned by ``session_id`` and return the record to use.
+
+        When another upload of the same content registered first, the session
+        joins that record instead and the caller should drop its own index.
+        Returns None if the existing record is being torn down; the caller's
+        index then stays private to its session.
+        """
+        now = int(self.clock())
+        record = {
+            'doc_key': doc_key,
+            'index_key': index_key,
+            'filename': filename,
+            'chunks_count': chunks_count,
+            'ref_count': 1,
+            'sessions': {session_id},
+            'created_at': now,
+            'last_used_at': now,
+        }
+        try:
+            self.table.put_item(Item=record, ConditionExpression='attribute_not_exists(doc_key)')
+            return record
+        except ClientError as e:
+            if not _is_condition_failure(e):
+                raise
+        existing = self.acquire(doc_key, session_id)
+        if existing is None:
+            # a resumed ingestion may have registered this session already
+            existing = self.table.get_item(Key={'doc_key': doc_key}, ConsistentRead=True).get('Item')
+            if not existing or session_id not in existing.get('sessions', ()):
+                return None
+        return existing
+
+    def release(self, doc_key, session_id):
+        """Drop ``session_id``; returns the index key to delete when it was the last one"""
+        try:
+            response = self.table.update_item(
+                Key={'doc_key': doc_key},
+                UpdateExpression='ADD ref_count :minus_one DELETE sessions :session',
+                ConditionExpression='contains(sessions, :session_id)',
+                ExpressionAttributeValues={
+                    ':minus_one': -1, ':session': {session_id}, ':session_id': session_id},
+                ReturnValues='ALL_NEW')
+        except ClientError as e:
+            if _is_condition_failure(e):
+                return None  # already released (stream replay) or never registered
+            raise
+
+        record = response.get('Attributes', {})
+        if int(record.get('ref_count', 0)) > 0:
+            return None
+        try:
+            self.table.delete_item(
+                Key={'doc_key': doc_key},
+                ConditionExpression='ref_count <= :zero',
+                ExpressionAttributeValues={':zero': 0})
+        except ClientError as e:
+            if _is_condition_failure(e):
+                return None
+            raise
+        logger.info(f"Last session released {doc_key}; index {record.get('index_key')} is unreferenced")
+        return record.get('index_key')
+
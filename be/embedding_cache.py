@@ -0,0 +1,201 @@
+"""Content-addressed cache of chunk embeddings shared across sessions.
+
+Embeddings are keyed by sha256(model id, normalised chunk text), so a
+chunk that was embedded for any earlier upload, in any session, costs no
+Bedrock call. Two tiers:
+
+* an in-process LRU (warm Lambda containers re-use it between uploads);
+* a durable store: DynamoDB (``DynamoDBEmbeddingStore``) in production,
+  ``LocalEmbeddingStore`` (a dict) for tests and local runs.
+
+Durable-store failures are logged and treated as misses; the cache must
+never be the reason an upload fails.
+"""
+import hashlib
+import logging
+import struct
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from rate_control import RetryPolicy
+
+logger = logging.getLogger(__name__)
+
+DURABLE_TTL_SECONDS = 90 * 24 * 3600
+_BATCH_GET_LIMIT = 100
+# batch_get_item reads of one batch while DynamoDB leaves keys unprocessed
+UNPROCESSED_KEYS_ATTEMPTS = 4
+
+
+def normalize_text(text):
+    """Canonical form used for cache keys: NFC, no NULs, collapsed whitespace"""
+    text = unicodedata.normalize('NFC', text.replace('\x00', ''))
+    return ' '.join(text.split())
+
+
+def cache_key(model_id, text):
+    digest = hashlib.sha256()
+    digest.update(model_id.encode('utf-8'))
+    digest.update(b'\n')
+    digest.update(normalize_text(text).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def pack_embedding(embedding):
+    return struct.pack(f'<{len(embedding)}f', *embedding)
+
+
+def unpack_embedding(data):
+    data = bytes(data)
+    return list(struct.unpack(f'<{len(data) // 4}f', data))
+
+
+class LocalEmbeddingStore:
+    """In-process durable-tier stand-in with the same interface as DynamoDB's"""
+
+    def __init__(self):
+        self.items = {}
+        self.get_calls = self.put_calls = 0
+
+    def get_many(self, keys):
+        self.get_calls += 1
+        return {k: unpack_embedding(self.items[k]) for k in keys if k in self.items}
+
+    def put_many(self, entries):
+        self.put_calls += 1
+        for key, embedding in entries.items():
+            self.items[key] = pack_embedding(embedding)
+
+
+class DynamoDBEmbeddingStore:
+    """Durable tier in a DynamoDB table keyed by ``cache_key`` (TTL on ``expires_at``)"""
+
+    def __init__(self, dynamodb, table_name, ttl_seconds=DURABLE_TTL_SECONDS, retry_policy=None):
+        self.dynamodb = dynamodb
+        self.table = dynamodb.Table(table_name)
+        self.table_name = table_name
+        self.ttl_seconds = ttl_seconds
+        self.retry_policy = retry_policy or RetryPolicy(max_attempts=UNPROCESSED_KEYS_ATTEMPTS)
+
+    def get_many(self, keys):
+        """Stored embeddings of ``keys``.
+
+        DynamoDB leaves keys unprocessed when it throttles; they are asked
+        for again with jittered backoff, and whatever is still unprocessed
+        after ``retry_policy.max_attempts`` reads is left out (a miss).
+        """
+        found = {}
+        keys = list(keys)
+        policy = self.retry_policy
+        for start in range(0, len(keys), _BATCH_GET_LIMIT):
+            request = {self.table_name: {
+                'Keys': [{'cache_key': k} for k in keys[start:start + _BATCH_GET_LIMIT]],
+                'ProjectionExpression': 'cache_key, embedding',
+            }}
+            for attempt in range(policy.max_attempts):
+                response = self.dynamodb.batch_get_item(RequestItems=request)
+                for item in response.get('Responses', {}).get(self.table_name, []):
+                    found[item['cache_key']] = unpack_embedding(getattr(item['embedding'], 'value', item['embedding']))
+                request = response.get('UnprocessedKeys')
+                if not request:
+                    break
+                if attempt < policy.max_attempts - 1:
+                    policy.sleep(policy.backoff(attempt))
+            else:
+                left = len(request.get(self.table_name, {}).get('Keys', []))
+                logger.warning(f"Embedding cache: {left} keys still unprocessed, treated as misses")
+        return found
+
+    def put_many(self, entries):
+        expires_at = int(time.time()) + self.ttl_seconds
+        with self.table.batch_writer(overwrite_by_pkeys=['cache_key']) as batch:
+            for key, embedding in entries.items():
+                batch.put_item(Item={
+                    'cache_key': key,
+                    'embedding': pack_embedding(embedding),
+                    'expires_at': expires_at,
+                })
+
+
+class EmbeddingCache:
+    """Memory LRU in front of an optional durable store, with hit-rate metrics"""
+
+    def __init__(self, durable=None, max_memory_entries=5000):
+        self.durable = durable
+        self.max_memory_entries = max_memory_entries
+        self.memory_hits = self.durable_hits = self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _memory_get(self, key):
+        with self._lock:
+            embedding = self._memory.get(key)
+            if embedding is not None:
+                self._memory.move_to_end(key)
+            return embedding
+
+    def _memory_put(self, key, embedding):
+        with self._lock:
+            self._memory[key] = embedding
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last=False)
+
+    def get_many(self, model_id, texts):
+        """Cached embeddings for ``texts`` (None where missing), in order"""
+        keys = [cache_key(model_id, t) for t in texts]
+        results = [self._memory_get(k) for k in keys]
+        memory_hits = sum(r is not None for r in results)
+
+        missing = {k for k, r in zip(keys, results) if r is None}
+        durable_found = {}
+        if missing and self.durable is not None:
+            try:
+                durable_found = self.durable.get_many(missing)
+            except Exception as e:
+                logger.warning(f"Embedding cache read failed, treating as miss: {e}")
+            for key, embedding in durable_found.items():
+                self._memory_put(key, embedding)
+
+        durable_hits = 0
+        for i, key in enumerate(keys):
+            if results[i] is None and key in durable_found:
+                results[i] = durable_found[key]
+                durable_hits += 1
+
+        with self._lock:
+            self.memory_hits += memory_hits
+            self.durable_hits += durable_hits
+            self.misses += len(keys) - memory_hits - durable_hits
+        return results
+
+    def put_many(self, model_id, texts, embeddings):
+        entries = {}
+        for text, embedding in zip(texts, embeddings):
+            if embedding:
+                key = cache_key(model_id, text)
+                self._memory_put(key, embedding)
+                entries[key] = embedding
+        if entries and self.durable is not None:
+            try:
+                self.durable.put_many(entries)
+            except Exception as e:
+                logger.warning(f"Embedding cache write failed: {e}")
+
+    def get(self, model_id, text):
+        return self.get_many(model_id, [text])[0]
+
+    def put(self, model_id, text, embedding):
+        self.put_many(model_id, [text], [embedding])
+
+    def stats(self):
+        hits = self.memory_hits + self.durable_hits
+        total = hits + self.misses
+        return {
+            'memory_hits': self.memory_hits,
+            'durable_hits': self.durable_hits,
+            'misses': self.misses,
+            'hit_rate': hits / total if total else 0.0,
+        }
@@ -0,0 +1,254 @@
+"""In-memory stand-ins for S3, DynamoDB and Bedrock, and helpers driving handler, shared by the tests"""
+import hashlib
+import io
+import json
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+import handler
+import ingestion
+import session_store
+from rate_control import RetryPolicy
+
+NO_SLEEP = RetryPolicy(sleep=lambda s: None)
+
+
+class FakeBedrock:
+    """Minimal bedrock-runtime stand-in returning length-based embeddings"""
+
+    def __init__(self, latency=0.0, failures=()):
+        self.latency = latency
+        self.failures = list(failures)
+        self.in_flight = self.peak = self.calls = 0
+        self._lock = threading.Lock()
+
+    def invoke_model(self, modelId, body):
+        with self._lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+            failure = self.failures.pop(0) if self.failures else None
+        if failure:
+            with self._lock:
+                self.in_flight -= 1
+            raise failure
+        time.sleep(self.latency)
+        with self._lock:
+            self.in_flight -= 1
+        text = json.loads(body)['inputText']
+        return {'body': io.BytesIO(json.dumps({'embedding': [float(len(text)), 1.0]}).encode('utf-8'))}
+
+
+def _condition_failed():
+    return ClientError({'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'failed'}},
+                       'UpdateItem')
+
+
+CONDITIONS = {
+    ingestion.CLAIM_CONDITION: lambda item, v: item['status'] == v[':queued'] or (
+        item['status'] == v[':running'] and (
+            item.get('lease_expires_at', 0) < v[':now'] or item.get('lease_owner') == v[':owner'])),
+    ingestion.OWNER_CONDITION: lambda item, v: (
+        item['status'] == v[':running'] and item.get('lease_owner') == v[':owner']),
+    '#status = :queued': lambda item, v: item['status'] == v[':queued'],
+    ingestion.RUNNING_CONDITION: lambda item, v: item['status'] == v[':running'],
+    ingestion.BATCH_CONDITION: lambda item, v: (
+        item['status'] == v[':running'] and v[':batch_id'] not in item.get('batches_completed', set())),
+    ingestion.OWNED_BATCH_CONDITION: lambda item, v: (
+        CONDITIONS[ingestion.BATCH_CONDITION](item, v) and item.get('lease_owner') == v[':owner']),
+}
+
+
+class FakeJobTable:
+    """DynamoDB stand-in for the SET updates and conditions JobStore issues"""
+
+    def __init__(self):
+        self.items = {}
+        self.updates = 0
+
+    def put_item(self, Item, ConditionExpression=None):
+        if Item['job_id'] in self.items:
+            raise _condition_failed()
+        self.items[Item['job_id']] = dict(Item)
+
+    def get_item(self, Key, ConsistentRead=False):
+        item = self.items.get(Key['job_id'])
+        return {'Item': dict(item)} if item else {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues,
+                    ReturnValues=None, ConditionExpression=None):
+        item = self.items.get(Key['job_id'])
+        if ConditionExpression and (item is None or not CONDITIONS[ConditionExpression](
+                item, ExpressionAttributeValues)):
+            raise _condition_failed()
+        self.updates += 1
+        if UpdateExpression.startswith('ADD'):  # JobStore.batch_done
+            values = ExpressionAttributeValues
+            item['batches_done'] = item.get('batches_done', 0) + values[':one']
+            item['chunks_embedded'] = item.get('chunks_embedded', 0) + values[':chunks']
+            item['batches_completed'] = item.get('batches_completed', set()) | values[':batch']
+            if ':lease' in values:
+                item['lease_expires_at'] = values[':lease']
+            return {'Attributes': dict(item)}
+        for placeholder, name in ExpressionAttributeNames.items():
+            value_key = ':' + placeholder[1:]
+            if value_key in ExpressionAttributeValues:
+                item[name] = ExpressionAttributeValues[value_key]
+        return {'Attributes': dict(item)}
+
+
+class FakeDocumentTable:
+    """Just enough of DynamoDB's conditional writes for DocumentRegistry"""
+
+    def __init__(self):
+        self.items = {}
+
+    def put_item(self, Item, ConditionExpression=None):
+        if Item['doc_key'] in self.items:
+            raise _condition_failed()
+        self.items[Item['doc_key']] = dict(Item, sessions=set(Item['sessions']))
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression, ExpressionAttributeValues,
+                    ReturnValues=None):
+        item = self.items.get(Key['doc_key'])
+        values = ExpressionAttributeValues
+        if ':one' in values:  # acquire
+            if item is None or item['ref_count'] <= 0 or values[':session_id'] in item['sessions']:
+                raise _condition_failed()
+            item['ref_count'] += 1
+            item['sessions'] |= values[':session']
+        else:  # release
+            if item is None or values[':session_id'] not in item['sessions']:
+                raise _condition_failed()
+            item['ref_count'] -= 1
+            item['sessions'] -= values[':session']
+        return {'Attributes': dict(item, sessions=set(item['sessions']))}
+
+    def get_item(self, Key, ConsistentRead=False):
+        item = self.items.get(Key['doc_key'])
+        return {'Item': dict(item, sessions=set(item['sessions']))} if item else {}
+
+    def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeValues=None):
+        item = self.items.get(Key['doc_key'])
+        if item is None or item['ref_count'] > 0:
+            raise _condition_failed()
+        del self.items[Key['doc_key']]
+
+
+class UploadS3:
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+        class NoSuchUpload(Exception):
+            pass
+
+    def __init__(self):
+        self.objects = {}
+        self.metadata = {}
+        self.checksums = {}
+        self.downloads = 0
+        self.multipart = {}
+
+    def head_object(self, Bucket, Key, ChecksumMode=None):
+        if Key not in self.objects:
+            raise self.exceptions.NoSuchKey(Key)
+        content_type = 'application/pdf' if Key.endswith('.pdf') else 'text/plain'
+        meta = {'ContentLength': len(self.objects[Key]), 'ContentType': content_type,
+                'Metadata': self.metadata.get(Key, {}), 'ETag': f'"{hashlib.md5(self.objects[Key]).hexdigest()}"'}
+        if Key in self.checksums:
+            meta['ChecksumSHA256'] = self.checksums[Key]
+        return meta
+
+    def put_object(self, Bucket, Key, Body, ContentType=None, Metadata=None):
+        self.objects[Key] = Body
+        self.metadata[Key] = Metadata or {}
+
+    def get_object(self, Bucket, Key, ChecksumMode=None, IfNoneMatch=None):
+        s3 = self
+
+        class Body(io.BytesIO):
+            def read(self, *args):
+                if not self.tell() and Key.startswith('uploads/'):
+                    s3.downloads += 1
+                return super().read(*args)
+
+        return dict(self.head_object(Bucket, Key, ChecksumMode), Body=Body(self.objects[Key]))
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+    def create_multipart_upload(self, Bucket, Key, ContentType=None):
+        upload_id = f"mpu-{len(self.multipart)}"
+        self.multipart[upload_id] = (Key, {})
+        return {'UploadId': upload_id}
+
+    def generate_presigned_url(self, operation, Params, ExpiresIn=None):
+        return f"https://s3/{operation}/{Params['UploadId']}/{Params['PartNumber']}"
+
+    def upload_part(self, url, body):
+        """What the browser's PUT to a part URL does; returns the ETag"""
+        upload_id, number = url.split('/')[-2:]
+        self._upload(upload_id)[1][int(number)] = body
+        return f'"etag-{number}"'
+
+    def _upload(self, upload_id):
+        if upload_id not in self.multipart:
+            raise self.exceptions.NoSuchUpload(upload_id)
+        return self.multipart[upload_id]
+
+    def list_parts(self, Bucket, Key, UploadId, PartNumberMarker=0):
+        parts = sorted(self._upload(UploadId)[1].items())
+        page = [{'PartNumber': n, 'Size': len(body)} for n, body in parts if n > PartNumberMarker][:2]
+        truncated = bool(page) and page[-1]['PartNumber'] < parts[-1][0]
+        return {'Parts': page, 'IsTruncated': truncated,
+                'NextPartNumberMarker': page[-1]['PartNumber'] if page else 0}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        key, parts = self.multipart.pop(UploadId)
+        self.objects[key] = b''.join(parts[p['PartNumber']] for p in MultipartUpload['Parts'])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self._upload(UploadId)
+        del self.multipart[UploadId]
+
+    def delete_objects(self, Bucket, Delete):
+        for obj in Delete['Objects']:
+            self.objects.pop(obj['Key'], None)
+
+
+class SessionTable:
+    def __init__(self):
+        self.items = {}
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeValues=None):
+        current = self.items.get(Item['session_id'], {})
+        if ConditionExpression == session_store.NEW_VERSION_CONDITION and 'documents_version' in current:
+            raise _condition_failed()
+        if ConditionExpression == session_store.VERSION_CONDITION and (
+                current.get('documents_version') != ExpressionAttributeValues[':version']):
+            raise _condition_failed()
+        self.items[Item['session_id']] = Item
+
+    def get_item(self, Key, ConsistentRead=False):
+        item = self.items.get(Key['session_id'])
+        return {'Item': item} if item else {}
+
+
+def call(fn, **body):
+    response = fn({'httpMethod': 'POST', 'body': json.dumps(body)}, None)
+    return response['statusCode'], json.loads(response['body'])
+
+
+def s3_event(*keys):
+    return {'Records': [{'s3': {'object': {'key': key.replace(' ', '+')}}} for key in keys]}
+
+
+def ingest(key):
+    """Client /upload, S3-triggered worker, then the job as /status reports it"""
+    status, job = call(handler.upload, s3_key=key)
+    assert status in (200, 202), job
+    handler.ingest(s3_event(key), None)
+    return call(handler.status, job_id=job['job_id'])[1]
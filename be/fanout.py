@@ -0,0 +1,111 @@
+"""Work queues for fan-out (map/reduce) ingestion.
+
+Documents too large to embed inside one invocation are split into
+batches: the planner writes each batch's chunks to
+``jobs/<job_id>/batches/`` and enqueues one small message per batch, batch
+workers write their embeddings as index shards under
+``jobs/<job_id>/shards/``, and the worker that lands the last batch
+aggregates the shards into the final index.
+
+``SQSQueue`` is used in Lambda; ``LocalQueue`` is an in-process stand-in
+that either delivers messages straight to a consumer or holds them until
+``deliver`` is called (tests use that to replay, reorder or drop them).
+"""
+import json
+import logging
+from collections import deque
+
+from rate_control import RetryPolicy
+
+logger = logging.getLogger(__name__)
+
+_SQS_BATCH_LIMIT = 10
+
+
+def plan_key(job_id):
+    """Chunk list and batch ranges of a job, saved once extraction finishes"""
+    return f"jobs/{job_id}/plan.json"
+
+
+def batch_input_key(job_id, batch):
+    return f"jobs/{job_id}/batches/{batch:05d}.json"
+
+
+def shard_key(job_id, batch):
+    return f"jobs/{job_id}/shards/{batch:05d}.idx"
+
+
+def job_object_keys(job_id, batches_total):
+    yield plan_key(job_id)
+    for batch in range(batches_total):
+        yield batch_input_key(job_id, batch)
+        yield shard_key(job_id, batch)
+
+
+def batch_ranges(count, batch_size):
+    """(start, end) chunk ranges covering ``count`` chunks"""
+    return [(start, min(start + batch_size, count)) for start in range(0, count, batch_size)]
+
+
+class SQSQueue:
+    def __init__(self, sqs, queue_url, retry_policy=None):
+        self.sqs = sqs
+        self.queue_url = queue_url
+        self.retry_policy = retry_policy or RetryPolicy()
+
+    def send_many(self, messages):
+        """Send ``messages`` in batches of ten.
+
+        Entries SQS rejects as the sender's fault (an invalid or oversized
+        body) raise at once; the others are resent with jittered backoff,
+        and raise once ``retry_policy.max_attempts`` sends were not enough.
+        """
+        messages = list(messages)
+        policy = self.retry_policy
+        for start in range(0, len(messages), _SQS_BATCH_LIMIT):
+            entries = [{'Id': str(i), 'MessageBody': json.dumps(message)}
+                       for i, message in enumerate(messages[start:start + _SQS_BATCH_LIMIT])]
+            for attempt in range(policy.max_attempts):
+                response = self.sqs.send_message_batch(QueueUrl=self.queue_url, Entries=entries)
+                failed = response.get('Failed', [])
+                if not failed:
+                    break
+                rejected = [f for f in failed if f.get('SenderFault')]
+                if rejected:
+                    raise RuntimeError(f"SQS rejected {len(rejected)} messages: {_failure_codes(rejected)}")
+                if attempt == policy.max_attempts - 1:
+                    raise RuntimeError(f"{len(failed)} SQS messages still not accepted after "
+                                       f"{policy.max_attempts} attempts: {_failure_codes(failed)}")
+                logger.warning(f"Retrying {len(failed)} SQS messages that were not accepted")
+                ids = {f['Id'] for f in failed}
+                entries = [e for e in entries if e['Id'] in ids]
+                policy.sleep(policy.backoff(attempt))
+
+
+def _failure_codes(failed):
+    return ', '.join(sorted({f.get('Code', 'unknown') for f in failed}))
+
+
+class LocalQueue:
+    """In-process queue; with a ``consumer`` every message is delivered on send"""
+
+    def __init__(self, consumer=None):
+        self.consumer = consumer
+        self.messages = deque()
+        self.sent = 0
+
+    def send_many(self, messages):
+        for message in messages:
+            # round-trip through JSON like SQS would
+            self.messages.append(json.loads(json.dumps(message)))
+            self.sent += 1
+        if self.consumer is not None:
+            self.deliver(self.consumer)
+
+    def deliver(self, consumer, limit=None):
+        """Hand up to ``limit`` queued messages to ``consumer``, oldest first"""
+        delivered = 0
+        while self.messages and (limit is None or delivered < limit):
+            consumer(self.messages.popleft())
+            delivered += 1
+        return delivered
@@ -2,11 +2,27 @@ import json
 import boto3
 import base64
 import uuid
-import tempfile
 import os
 import logging
-from datetime import datetime, timedelta
+import mimetypes
+from datetime import datetime
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
 from rag_bedrock import bedrock_rag
+from rate_control import BedrockBusyError
+from vector_index import load_index, load_index_bytes
+from session_cache import SessionCache
+from tmp_cache import TmpCache
+from document_registry import DocumentRegistry, hex_to_checksum
+from ingestion import (
+    COLLECTION_UPLOAD_PREFIX, JobStore, IngestionWorker, SESSION_TTL_HOURS, SESSION_UPLOAD_PREFIX,
+    TERMINAL_STATUSES, job_id_for, public_job, s3_event_keys
+)
+from session_store import SessionStore, is_merged_index, session_documents
+from fanout import SQSQueue, LocalQueue
+import ann_index
+import collection_search
+import search_engine
 
 # Configure structured logging
 logger = logging.getLogger()
@@ -16,11 +32,72 @@ logger.setLevel(logging.INFO)
 REGION = os.environ.get('AWS_REGION', 'us-east-1')
 S3_BUCKET = os.environ.get('S3_BUCKET')
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
+# .txt is decoded and chunked as it streams, so only the index being built
+# grows with the file; PDFs are parsed in memory and keep the lower cap
+MAX_TEXT_FILE_SIZE = int(os.environ.get('MAX_TEXT_FILE_SIZE', 32 * 1024 * 1024))
+# Multipart uploads: S3 needs parts of at least 5MB (except the last) and at most 10000 parts
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
+MULTIPART_MAX_PARTS = 10000
+MULTIPART_MAX_URLS = 100  # part URLs per /multipart/parts call
+# Index quantization: none | float16 | int8 | binary (see bench_quantization.py)
+INDEX_QUANTIZATION = os.environ.get('INDEX_QUANTIZATION', 'none')
+# Precision of the rows kept for rescoring int8/binary indexes: float32 | float16 | none
+INDEX_RESCORE_DTYPE = os.environ.get('INDEX_RESCORE_DTYPE', 'float32')
+
+# Approximate search for indexes of at least ANN_MIN_ROWS chunks: IVF lists
+# (ANN_NLIST, 0 for about sqrt(chunks)), ANN_NPROBE of them scanned per
+# question (more is slower and closer to exact; see bench_ann.py)
+ANN_MIN_ROWS = int(os.environ.get('ANN_MIN_ROWS', ann_index.ANN_MIN_ROWS))
+ANN_NLIST = int(os.environ.get('ANN_NLIST', 0)) or None
+ANN_NPROBE = int(os.environ.get('ANN_NPROBE', ann_index.DEFAULT_NPROBE))
+
+# Retrieval for document questions: vector (cosine, keywords only when the
+# question cannot be embedded) | hybrid (cosine + BM25, reciprocal rank fusion)
+RETRIEVAL_MODE = os.environ.get('RETRIEVAL_MODE', 'hybrid')
+HYBRID_VECTOR_WEIGHT = float(os.environ.get('HYBRID_VECTOR_WEIGHT', 1.0))
+HYBRID_LEXICAL_WEIGHT = float(os.environ.get('HYBRID_LEXICAL_WEIGHT', 1.0))
+HYBRID_CANDIDATES = int(os.environ.get('HYBRID_CANDIDATES', search_engine.HYBRID_CANDIDATES))
+RRF_K = int(os.environ.get('RRF_K', search_engine.RRF_K))
+# Collection questions: documents (picked by their centroids) whose chunks are searched
+COLLECTION_CANDIDATES = int(os.environ.get('COLLECTION_CANDIDATES', collection_search.COLLECTION_CANDIDATES))
+
+# Warm-container cache of session records + decoded indexes
+INDEX_CACHE_MAX_BYTES = int(os.environ.get('INDEX_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+INDEX_CACHE_POLICY = os.environ.get('INDEX_CACHE_POLICY', 'lru')
+INDEX_CACHE_REVALIDATE_SECONDS = int(os.environ.get('INDEX_CACHE_REVALIDATE_SECONDS', 60))
+# Disk quota for cached indexes + scratch files under /tmp (ephemeral storage is 512MB)
+TMP_CACHE_MAX_BYTES = int(os.environ.get('TMP_CACHE_MAX_BYTES', 384 * 1024 * 1024))
+
+# Content-addressed registry of built indexes (whole-document dedup)
+DOCUMENTS_TABLE = os.environ.get('DOCUMENTS_TABLE', 'DocQADocuments')
+# Ingestion job state + progress, read by /status
+JOBS_TABLE = os.environ.get('JOBS_TABLE', 'DocQAJobs')
+# Fan-out embedding of large documents (SQS in Lambda, in-process when unset)
+INGEST_QUEUE_URL = os.environ.get('INGEST_QUEUE_URL')
+# Chunks per checkpointed embedding batch
+EMBED_BATCH_SIZE = int(os.environ.get('EMBED_BATCH_SIZE', 128))
+FANOUT_MIN_CHUNKS = int(os.environ.get('FANOUT_MIN_CHUNKS', 2000))
+FANOUT_BATCH_SIZE = int(os.environ.get('FANOUT_BATCH_SIZE', 256))
 
 # AWS clients
 s3 = boto3.client('s3', region_name=REGION)
 dynamodb = boto3.resource('dynamodb', region_name=REGION)
 table = dynamodb.Table('DocQASessions')
+document_registry = DocumentRegistry(dynamodb.Table(DOCUMENTS_TABLE))
+jobs = JobStore(dynamodb.Table(JOBS_TABLE))
+session_store = SessionStore(table, s3, S3_BUCKET, SESSION_TTL_HOURS)
+collections = collection_search.CollectionStore(table, s3, S3_BUCKET)
+if INGEST_QUEUE_URL:
+    ingest_queue = SQSQueue(boto3.client('sqs', region_name=REGION), INGEST_QUEUE_URL)
+else:
+    ingest_queue = LocalQueue(consumer=lambda message: ingestion_worker().run_batch(message))
+
+session_cache = SessionCache(
+    INDEX_CACHE_MAX_BYTES,
+    policy=INDEX_CACHE_POLICY,
+    revalidate_after=INDEX_CACHE_REVALIDATE_SECONDS
+)
+tmp_cache = TmpCache(quota_bytes=TMP_CACHE_MAX_BYTES)
 
 # Input validation
 def validate_file(filename, content_type, file_size=None):
@@ -38,35 +115,59 @@ def validate_file(filename, content_type, file_size=None):
         raise ValueError(f"Unsupported file extension: {file_ext}. Allowed extensions: {', '.join(allowed_extensions)}")
     
     # Check file size if provided
-    if file_size and file_size > MAX_FILE_SIZE:
-        raise ValueError(f"File size ({file_size} bytes) exceeds maximum allowed size ({MAX_FILE_SIZE} bytes)")
+    max_size = MAX_TEXT_FILE_SIZE if file_ext == '.txt' else MAX_FILE_SIZE
+    if file_size and file_size > max_size:
+        raise ValueError(f"File size ({file_size} bytes) exceeds maximum allowed size ({max_size} bytes)")
     
     logger.info(f"File validation passed: {filename} ({content_type})")
     return True
 
+def ingestion_worker():
+    return IngestionWorker(
+        s3=s3,
+        bucket=S3_BUCKET,
+        sessions=table,
+        registry=document_registry,
+        jobs=jobs,
+        rag=bedrock_rag,
+        tmp_cache=tmp_cache,
+        validate=validate_file,
+        quantization=INDEX_QUANTIZATION,
+        rescore_dtype=INDEX_RESCORE_DTYPE,
+        ann_min_rows=ANN_MIN_ROWS,
+        ann_nlist=ANN_NLIST,
+        ann_nprobe=ANN_NPROBE,
+        embed_batch_size=EMBED_BATCH_SIZE,
+        queue=ingest_queue,
+        fanout_min_chunks=FANOUT_MIN_CHUNKS,
+        fanout_batch_size=FANOUT_BATCH_SIZE
+    )
+
 def upload(event, context):
+    """Register an uploaded object for ingestion and return its job.
+
+    The work itself happens in ``ingest`` (triggered by the S3 PUT); the
+    client polls ``/status`` with the returned job_id.
+    """
     if event.get('httpMethod') == 'OPTIONS':
         return options_response()
         
     try:
-        logger.info("📤 Starting S3-based processing")
-
         body = json.loads(event.get('body') or '{}')
         s3_key = body.get('s3_key')
         if not s3_key:
             logger.error("Missing s3_key in request body")
             return error_response('Missing s3_key in request body')
+        if not s3_key.startswith('uploads/'):
+            return error_response('s3_key must be an uploaded document')
 
         filename = os.path.basename(s3_key)
         
         # Get file metadata from S3 to validate
         try:
             s3_metadata = s3.head_object(Bucket=S3_BUCKET, Key=s3_key)
-            file_size = s3_metadata['ContentLength']
-            content_type = s3_metadata.get('ContentType', 'application/octet-stream')
-            
-            # Validate file
-            validate_file(filename, content_type, file_size)
+            validate_file(filename, s3_metadata.get('ContentType', 'application/octet-stream'),
+                          s3_metadata['ContentLength'])
         except s3.exceptions.NoSuchKey:
             logger.error(f"File not found in S3: {s3_key}")
             return error_response('File not found in S3')
@@ -74,78 +175,122 @@ def upload(event, context):
             logger.error(f"File validation failed: {str(ve)}")
             return error_response(str(ve))
 
-        # Download file from S3 to /tmp
-        tmp_dir = tempfile.gettempdir()
-        local_path = os.path.join(tmp_dir, filename)
-        s3.download_file(S3_BUCKET, s3_key, local_path)
-
-        logger.info(f"🔄 Processing document from S3: {s3_key} -> {local_path}")
+        job = jobs.create(job_id_for(s3_key), s3_key, filename)
+        logger.info(f"📤 Ingestion job {job['job_id']} for {s3_key}: {job['status']}")
+        return success_response(public_job(job), 200 if job['status'] in TERMINAL_STATUSES else 202)
 
-        # Process document with Bedrock RAG
-        chunks = bedrock_rag.load_and_split_document(local_path)
-        
-        if not chunks:
-            logger.error(f"Failed to extract chunks from document: {filename}")
-            return error_response('Failed to process document. The file may be empty or corrupted.')
-
-        # Build lightweight index: compute embeddings via bedrock and store chunks + embeddings
-        embeddings = []
-        texts = []
-        for i, chunk in enumerate(chunks):
-            text = chunk["page_content"]
-            emb = bedrock_rag.get_titan_embedding(text) or []
-            embeddings.append(emb)
-            texts.append(text)
-
-        session_id = str(uuid.uuid4())
-        index_key = f"vector_stores/{session_id}.json"
-
-        index_obj = {
-            'session_id': session_id,
-            'filename': filename,
-            'chunks_count': len(chunks),
-            'texts': texts,
-            'embeddings': embeddings,
-            'created_at': datetime.now().isoformat()
-        }
+    except Exception as e:
+        logger.error(f"❌ Upload error: {str(e)}", exc_info=True)
+        return error_response(f"Upload failed: {str(e)}")
+
+def ingest(event, context):
+    """S3 ObjectCreated (uploads/) -> run the ingestion pipeline for each object"""
+    worker = ingestion_worker()
+    results = []
+    for s3_key in s3_event_keys(event):
+        if not s3_key.startswith('uploads/'):
+            continue
+        job = jobs.create(job_id_for(s3_key), s3_key, os.path.basename(s3_key))
+        # Lambda retries keep the request id, letting a retry resume its own job
+        job = worker.run(job['job_id'], owner=getattr(context, 'aws_request_id', None))
+        logger.info(f"Ingestion job {job['job_id']} finished: {job.get('status')}")
+        results.append(public_job(job))
+    return {'jobs': results}
+
+def embed_batch(event, context):
+    """SQS consumer for fan-out batches; throttled batches go back on the queue"""
+    worker = ingestion_worker()
+    failures = []
+    for record in event.get('Records', []):
+        try:
+            job = worker.run_batch(json.loads(record['body']))
+            if job:
+                logger.info(f"Ingestion job {job['job_id']} finished: {job.get('status')}")
+        except BedrockBusyError as be:
+            logger.warning(f"Bedrock throttled, batch will be retried: {str(be)}")
+            failures.append({'itemIdentifier': record['messageId']})
+        except Exception as e:
+            logger.error(f"❌ Batch failed: {str(e)}", exc_info=True)
+            failures.append({'itemIdentifier': record['messageId']})
+    return {'batchItemFailures': failures}
+
+def status(event, context):
+    if event.get('httpMethod') == 'OPTIONS':
+        return options_response()
 
-        s3.put_object(
-            Bucket=S3_BUCKET,
-            Key=index_key,
-            Body=json.dumps(index_obj).encode('utf-8')
-        )
+    try:
+        body = json.loads(event.get('body') or '{}')
+        job_id = body.get('job_id')
+        if not job_id:
+            return error_response('job_id is required', 400)
+        job = jobs.get(job_id)
+        if not job:
+            return error_response('Job not found', 404)
+        return success_response(public_job(job))
+    except Exception as e:
+        logger.error(f"❌ Status error: {str(e)}", exc_info=True)
+        return error_response(str(e))
 
-        # Store session in DynamoDB
-        table.put_item(Item={
-            'session_id': session_id,
-            'filename': filename,
-            'chunks_count': len(chunks),
-            's3_key': index_key,
-            'created_at': datetime.now().isoformat(),
-            'expires_at': int((datetime.now() + timedelta(hours=24)).timestamp())
-        })
-
-        # Cleanup local file
-        try:
-            os.remove(local_path)
-        except Exception as cleanup_error:
-            logger.warning(f"Failed to cleanup temp file: {cleanup_error}")
-
-        logger.info(f"✅ Document processed successfully: {filename} ({len(chunks)} chunks)")
-        return success_response({
-            'session_id': session_id,
-            'filename': filename,
-            'chunks_count': len(chunks),
-            'message': 'Document processed and indexed (lightweight).'
-        })
+def cancel(event, context):
+    """Cancel an ingestion job; a running worker stops at its next batch"""
+    if event.get('httpMethod') == 'OPTIONS':
+        return options_response()
 
-    except ValueError as ve:
-        logger.error(f"Validation error: {str(ve)}")
-        return error_response(str(ve))
+    try:
+        body = json.loads(event.get('body') or '{}')
+        job_id = body.get('job_id')
+        if not job_id:
+            return error_response('job_id is required', 400)
+        job = jobs.request_cancel(job_id)
+        if not job:
+            return error_response('Job not found', 404)
+        logger.info(f"Cancellation requested for job {job_id}: {job['status']}")
+        return success_response(public_job(job))
     except Exception as e:
-        logger.error(f"❌ Upload processing error: {str(e)}", exc_info=True)
-        return error_response(f"Upload processing failed: {str(e)}")
+        logger.error(f"❌ Cancel error: {str(e)}", exc_info=True)
+        return error_response(str(e))
 
+def cleanup(event, context):
+    """DocQASessions stream consumer: release shared indexes of deleted sessions.
+
+    TTL expiry (or any delete) of a session drops its reference on each of
+    its documents' records; the last reference deletes the index object.
+    Indexes private to the session (no record) and its merged index go
+    with it. Deleting a collection item does the same for the documents
+    listed on its routing index.
+    """
+    deserializer = TypeDeserializer()
+    failures = []
+    for record in event.get('Records', []):
+        if record.get('eventName') != 'REMOVE':
+            continue
+        try:
+            old_image = record['dynamodb'].get('OldImage', {})
+            session = {k: deserializer.deserialize(v) for k, v in old_image.items()}
+            session_cache.invalidate(session.get('session_id'))
+            is_collection = collection_search.is_collection(session.get('session_id'))
+            documents = _collection_documents(session) if is_collection else session_documents(session)
+            for document in documents:
+                if not document.get('doc_key'):
+                    s3.delete_object(Bucket=S3_BUCKET, Key=document['index_key'])
+                    continue
+                index_key = document_registry.release(document['doc_key'], session['session_id'])
+                if index_key:
+                    s3.delete_object(Bucket=S3_BUCKET, Key=index_key)
+                    logger.info(f"🗑️ Deleted unreferenced index {index_key}")
+            if session.get('s3_key') and (is_collection or is_merged_index(session['s3_key'])):
+                s3.delete_object(Bucket=S3_BUCKET, Key=session['s3_key'])
+        except Exception as e:
+            logger.error(f"❌ Cleanup failed for stream record: {str(e)}", exc_info=True)
+            failures.append({'itemIdentifier': record['dynamodb'].get('SequenceNumber')})
+    return {'batchItemFailures': failures}
+
+def _collection_documents(collection):
+    try:
+        routing = collections.routing(collection)
+    except s3.exceptions.NoSuchKey:
+        return []  # replayed stream record: already cleaned up
+    return routing.documents if routing is not None else []
 
 def presign(event, context):
     if event.get('httpMethod') == 'OPTIONS':
@@ -167,18 +312,32 @@ def presign(event, context):
             logger.error(f"File validation failed in presign: {str(ve)}")
             return error_response(str(ve))
 
-        # Create s3 key
-        session_stub = str(uuid.uuid4())[:8]
-        s3_key = f"uploads/{session_stub}/{filename}"
+        # With a session_id (collection_id) the document is added to that session (collection)
+        try:
+            s3_key = upload_key_for(filename, body)
+        except LookupError as le:
+            return error_response(str(le), 404)
+        except ValueError as ve:
+            return error_response(str(ve), 400)
+
+        params = {'Bucket': S3_BUCKET, 'Key': s3_key, 'ContentType': content_type}
+        result = {'s3_key': s3_key}
+        # Optional client-computed sha256: S3 verifies it on PUT, so upload can
+        # trust it to find an existing index without downloading the file
+        if body.get('sha256'):
+            checksum = hex_to_checksum(body['sha256'])
+            params['ChecksumSHA256'] = checksum
+            result['checksum_sha256'] = checksum
 
         presigned = s3.generate_presigned_url(
             'put_object',
-            Params={'Bucket': S3_BUCKET, 'Key': s3_key, 'ContentType': content_type},
+            Params=params,
             ExpiresIn=3600
         )
 
         logger.info(f"Generated presigned URL for: {filename}")
-        return success_response({'upload_url': presigned, 's3_key': s3_key})
+        result['upload_url'] = presigned
+        return success_response(result)
     except ValueError as ve:
         logger.error(f"Validation error in presign: {str(ve)}")
         return error_response(str(ve))
@@ -186,6 +345,328 @@ def presign(event, context):
         logger.error(f"❌ Presign error: {str(e)}", exc_info=True)
         return error_response(str(e))
 
+def new_upload_key(filename, session_id=None, collection_id=None):
+    """Upload key for a new session, or for a document added to ``session_id`` / ``collection_id``"""
+    session_stub = str(uuid.uuid4())[:8]
+    if session_id:
+        return f"{SESSION_UPLOAD_PREFIX}{session_id}/{session_stub}/{filename}"
+    if collection_id:
+        return f"{COLLECTION_UPLOAD_PREFIX}{collection_id}/{session_stub}/{filename}"
+    return f"uploads/{session_stub}/{filename}"
+
+def upload_key_for(filename, body):
+    """Upload key for a presign / multipart request body.
+
+    Raises LookupError for an unknown session and ValueError for a bad
+    collection_id; collections are created by their first upload.
+    """
+    session_id, collection_id = body.get('session_id'), body.get('collection_id')
+    if session_id and collection_id:
+        raise ValueError('Pass either session_id or collection_id, not both')
+    if collection_id and not collection_search.valid_collection_id(collection_id):
+        raise ValueError('collection_id must be 1-64 letters, digits, "-" or "_"')
+    if session_id and session_store.get(session_id) is None:
+        raise LookupError('Session not found or expired')
+    return new_upload_key(filename, session_id, collection_id)
+
+def _multipart_upload(body):
+    """(s3_key, upload_id) of a multipart request body; raises ValueError"""
+    s3_key, upload_id = body.get('s3_key'), body.get('upload_id')
+    if not s3_key or not upload_id:
+        raise ValueError('s3_key and upload_id are required')
+    if not s3_key.startswith('uploads/'):
+        raise ValueError('s3_key must be an uploaded document')
+    return s3_key, upload_id
+
+def multipart_create(event, context):
+    """Start a multipart upload; the client then asks /multipart/parts for part URLs.
+
+    Parts can be uploaded in parallel and retried one by one, so large
+    files survive flaky connections. Body: filename, content_type, size,
+    and session_id (collection_id) to add the document to an existing
+    session (a collection).
+    """
+    if event.get('httpMethod') == 'OPTIONS':
+        return options_response()
+
+    try:
+        body = json.loads(event.get('body') or '{}')
+        filename = body.get('filename')
+        content_type = body.get('content_type', 'application/octet-stream')
+        if not filename:
+            return error_response('filename is required', 400)
+        try:
+            size = int(body['size']) if body.get('size') is not None else None
+            validate_file(filename, content_type, size)
+        except ValueError as ve:
+            logger.error(f"File validation failed in multipart create: {str(ve)}")
+            return error_response(str(ve), 400)
+
+        try:
+            s3_key = upload_key_for(filename, body)
+        except LookupError as le:
+            return error_response(str(le), 404)
+        except ValueError as ve:
+            return error_response(str(ve), 400)
+        upload = s3.create_multipart_upload(Bucket=S3_BUCKET, Key=s3_key, ContentType=content_type)
+        result = {'s3_key': s3_key, 'upload_id': upload['UploadId'], 'part_size': MULTIPART_PART_SIZE}
+        if size is not None:
+            result['part_count'] = max(1, -(-size // MULTIPART_PART_SIZE))
+        logger.info(f"Started multipart upload for: {filename}")
+        return success_response(result)
+    except Exception as e:
+        logger.error(f"❌ Multipart create error: {str(e)}", exc_info=True)
+        return error_response(str(e))
+
+def multipart_parts(event, context):
+    """Presigned upload_part URLs for the requested part numbers (1-based)"""
+    if event.get('httpMethod') == 'OPTIONS':
+        return options_response()
+
+    try:
+        body = json.loads(event.get('body') or '{}')
+        try:
+            s3_key, upload_id = _multipart_upload(body)
+            part_numbers = [int(n) for n in body.get('part_numbers') or []]
+        except (TypeError, ValueError) as ve:
+            return error_response(str(ve), 400)
+        if not part_numbers or len(part_numbers) > MULTIPART_MAX_URLS:
+            return error_response(f'part_numbers must list 1 to {MULTIPART_MAX_URLS} parts', 400)
+        if any(n < 1 or n > MULTIPART_MAX_PARTS for n in part_numbers):
+            return error_response(f'part numbers must be between 1 and {MULTIPART_MAX_PARTS}', 400)
+
+        urls = {
+            str(n): s3.generate_presigned_url(
+                'upload_part',
+                Params={'Bucket': S3_BUCKET, 'Key': s3_key, 'UploadId': upload_id, 'PartNumber': n},
+                ExpiresIn=3600
+            )
+            for n in part_numbers
+        }
+        return success_response({'s3_key': s3_key, 'upload_id': upload_id, 'urls': urls})
+    except Exception as e:
+        logger.error(f"❌ Multipart parts error: {str(e)}", exc_info=True)
+        return error_response(str(e))
+
+def multipart_complete(event, context):
+    """Assemble the uploaded parts, applying validate_file to the real size.
+
+    Body: s3_key, upload_id, parts = [{part_number, etag}]. An upload that
+    fails validation is aborted, so it never reaches ingestion.
+    """
+    if event.get('httpMethod') == 'OPTIONS':
+        return options_response()
+
+    try:
+        body = json.loads(event.get('body') or '{}')
+        try:
+            s3_key, upload_id = _multipart_upload(body)
+            parts = sorted(({'PartNumber': int(p['part_number']), 'ETag': p['etag']}
+                            for p in body.get('parts') or []), key=lambda p: p['PartNumber'])
+        except (KeyError, TypeError, ValueError) as e:
+            return error_response(f'Invalid multipart request: {e}', 400)
+        if not parts:
+            return error_response('parts is required', 400)
+
+        uploaded = _list_parts(s3_key, upload_id)
+        if uploaded is None:
+            return error_response('Multipart upload not found', 404)
+        missing = [p['PartNumber'] for p in parts if p['PartNumber'] not in uploaded]
+        if missing:
+            return error_response(f'Parts not uploaded: {missing}', 400)
+
+        filename = os.path.basename(s3_key)
+        try:
+            # only the listed parts become the object
+            validate_file(filename, mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                          sum(uploaded[p['PartNumber']] for p in parts))
+        except ValueError as ve:
+            logger.error(f"File validation failed in multipart complete: {str(ve)}")
+            s3.abort_multipart_upload(Bucket=S3_BUCKET, Key=s3_key, UploadId=upload_id)
+            return error_response(str(ve), 400)
+
+        s3.complete_multipart_upload(Bucket=S3_BUCKET, Key=s3_key, UploadId=upload_id,
+                                     MultipartUpload={'Parts': parts})
+        logger.info(f"Completed multipart upload of {s3_key} ({len(parts)} parts)")
+        return success_response({'s3_key': s3_key})
+    except Exception as e:
+        logger.error(f"❌ Multipart complete error: {str(e)}", exc_info=True)
+        return error_response(str(e))
+
+def multipart_abort(event, context):
+    """Discard a multipart upload and the parts stored so far"""
+    if event.get('httpMethod') == 'OPTIONS':
+        return options_response()
+
+    try:
+        body = json.loads(event.get('body') or '{}')
+        try:
+            s3_key, upload_id = _multipart_upload(body)
+        except ValueError as ve:
+            return error_response(str(ve), 400)
+        try:
+            s3.abort_multipart_upload(Bucket=S3_BUCKET, Key=s3_key, UploadId=upload_id)
+        except s3.exceptions.NoSuchUpload:
+            pass  # already completed or aborted
+        return success_response({'s3_key': s3_key, 'aborted': True})
+    except Exception as e:
+        logger.error(f"❌ Multipart abort error: {str(e)}", exc_info=True)
+        return error_response(str(e))
+
+def _list_parts(s3_key, upload_id):
+    """{part number: size} of an in-progress multipart upload, or None if unknown"""
+    sizes = {}
+    params = {'Bucket': S3_BUCKET, 'Key': s3_key, 'UploadId': upload_id}
+    try:
+        while True:
+            page = s3.list_parts(**params)
+            for part in page.get('Parts', []):
+                sizes[part['PartNumber']] = part['Size']
+            if not page.get('IsTruncated'):
+                return sizes
+            params['PartNumberMarker'] = page['NextPartNumberMarker']
+    except s3.exceptions.NoSuchUpload:
+        return None
+
+def _is_expired(session_data):
+    expires_at = session_data.get('expires_at')
+    return expires_at is not None and int(expires_at) <= datetime.now().timestamp()
+
+def _is_not_modified(error):
+    status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return status == 304 or error.response.get('Error', {}).get('Code') in ('304', 'NotModified')
+
+def load_session_index(session_id):
+    """Return (session record, decoded index) for a live session.
+
+    Served from the warm-container cache when possible. A stale cache
+    entry re-reads the record, since adding a document moves a session (or
+    a collection) to a new index, and revalidates the index it already
+    holds (or an index file left on /tmp by an earlier invocation) with a
+    conditional GET on its ETag. Indexes are memory-mapped from the /tmp
+    cache unless they do not fit its quota. Returns (None, None) for
+    unknown/expired sessions and (session, None) when the session has no
+    index.
+    """
+    entry = session_cache.get(session_id)
+    if entry and session_cache.is_fresh(entry):
+        return entry.session, entry.index
+
+    # DynamoDB TTL deletes lazily, so expired items can still be returned
+    response = table.get_item(Key={'session_id': session_id})
+    session_data = response.get('Item')
+    if not session_data or _is_expired(session_data):
+        return None, None
+
+    index_key = session_data.get('s3_key')
+    if not index_key:
+        return session_data, None
+    return session_data, _fetch_index(session_id, session_data, index_key, entry)
+
+def load_document_index(index_key):
+    """Decoded index of one document (see load_session_index), cached under its key"""
+    entry = session_cache.get(index_key)
+    if entry and session_cache.is_fresh(entry):
+        return entry.index
+    return _fetch_index(index_key, {}, index_key, entry)
+
+def _fetch_index(cache_key, record, index_key, entry):
+    """Load ``index_key``, revalidating the copy held in ``entry`` or on /tmp, and cache it"""
+    # Revalidate whatever copy we already hold: in memory, else on /tmp
+    if entry and entry.index_key == index_key and entry.etag:
+        cached_path, cached_etag = None, entry.etag
+    else:
+        cached_path, cached_etag = tmp_cache.lookup(index_key)
+
+    params = {'Bucket': S3_BUCKET, 'Key': index_key}
+    if cached_etag:
+        params['IfNoneMatch'] = cached_etag
+    try:
+        obj = s3.get_object(**params)
+    except ClientError as e:
+        if not (cached_etag and _is_not_modified(e)):
+            raise
+        if not cached_path:
+            entry.session = record
+            session_cache.mark_validated(entry)
+            return entry.index
+        etag = cached_etag
+        index = load_index(cached_path)
+    else:
+        etag = obj.get('ETag')
+        size = obj.get('ContentLength')
+        path = None
+        if size is None or size <= tmp_cache.quota_bytes:
+            path = tmp_cache.put_stream(index_key, etag, obj['Body'], size=size)
+            if path is None:
+                # the disk write failed part-way through the body; start over
+                obj = s3.get_object(Bucket=S3_BUCKET, Key=index_key)
+                etag = obj.get('ETag')
+        # indexes larger than the /tmp quota are kept in memory only
+        index = load_index(path) if path else load_index_bytes(obj['Body'].read())
+
+    session_cache.put(cache_key, record, index, index_key, etag)
+    return index
+
+def retrieve(index, question, k):
+    """Top ``k`` (row, score) pairs of a session index for a question (see RETRIEVAL_MODE)"""
+    if not len(index):
+        return []
+
+    def vector_search(n):
+        # cosine similarity over the index matrix (coarse scan + exact
+        # rescoring for quantized indexes); rows without an embedding dropped
+        query_emb = bedrock_rag.get_titan_embedding(question)
+        if not query_emb:
+            return []
+        scores = search_engine.search(index, query_emb, n, nprobe=ANN_NPROBE)
+        return [(i, score) for i, score in scores if score > -1]
+
+    def lexical_search(n):
+        # BM25 over the keyword index built at upload
+        return index.lexical_search(question, n)
+
+    if RETRIEVAL_MODE == 'hybrid':
+        return search_engine.hybrid_search(
+            vector_search, lexical_search, k, weights=(HYBRID_VECTOR_WEIGHT, HYBRID_LEXICAL_WEIGHT),
+            candidates=HYBRID_CANDIDATES, rrf_k=RRF_K)
+    return vector_search(k) or lexical_search(k)
+
+
+def ask_collection(collection_id, question):
+    """Answer from the documents of a collection the question is routed to"""
+    if not collection_search.valid_collection_id(collection_id):
+        return error_response('Invalid collection_id', 400)
+    logger.info(f"🗂️ Collection question for: {collection_id}")
+    _, routing = load_session_index(collection_search.collection_key(collection_id))
+    if routing is None or not len(routing):
+        return error_response('Collection not found or empty', 404)
+
+    query_emb = bedrock_rag.get_titan_embedding(question)
+    weights = (HYBRID_VECTOR_WEIGHT, HYBRID_LEXICAL_WEIGHT) if RETRIEVAL_MODE == 'hybrid' else (1.0, 0.0)
+    if not query_emb and RETRIEVAL_MODE != 'hybrid':
+        weights = (0.0, 1.0)
+    hits = collection_search.search(
+        routing, load_document_index, question, query_emb, k=3, candidates=COLLECTION_CANDIDATES,
+        weights=weights, per_document=HYBRID_CANDIDATES, rrf_k=RRF_K, nprobe=ANN_NPROBE)
+
+    context_text = "\n\n".join(f"[{document['filename']}] {index.text(i)}" for document, index, i, _ in hits)
+    prompt = f"Dựa trên các đoạn sau từ tài liệu:\n\n{context_text}\n\nCâu hỏi: {question}\n\nTrả lời:"
+    answer = bedrock_rag.invoke_titan(prompt)
+    if not answer:
+        logger.info("Titan failed, falling back to Claude")
+        answer = bedrock_rag.invoke_claude(prompt)
+
+    logger.info(f"Answer generated for collection {collection_id}")
+    return success_response({
+        'answer': answer or "Không thể tạo câu trả lời.",
+        'used_document': bool(hits),
+        'collection_id': collection_id,
+        'sources': [{'filename': document['filename'], 'document_id': document['document_id'], 'score': score}
+                    for document, _, _, score in hits],
+        'model': 'bedrock-titan'
+    })
+
 def ask(event, context):
     if event.get('httpMethod') == 'OPTIONS':
         return options_response()
@@ -196,6 +677,7 @@ def ask(event, context):
         body = json.loads(event['body'])
         question = body.get('question', '').strip()
         session_id = body.get('session_id')
+        collection_id = body.get('collection_id')
         
         if not question:
             logger.error("Empty question received")
@@ -205,58 +687,29 @@ def ask(event, context):
             logger.error(f"Question too long: {len(question)} characters")
             return error_response('Question is too long (max 1000 characters)')
         
+        if collection_id:
+            return ask_collection(collection_id, question)
+
         if session_id:
-            # Document-based question: load index JSON from S3 and do cosine similarity
+            # Document-based question: load the (cached) index and do cosine similarity
             logger.info(f"📄 Document question for session: {session_id}")
 
-            response = table.get_item(Key={'session_id': session_id})
-            if 'Item' not in response:
+            session_data, index = load_session_index(session_id)
+            if session_data is None:
                 logger.error(f"Session not found: {session_id}")
                 return error_response('Session not found or expired')
-
-            session_data = response['Item']
-            index_key = session_data.get('s3_key')
-            if not index_key:
+            if index is None:
                 logger.error(f"Index not found for session: {session_id}")
                 return error_response('Index not found for session')
 
-            # Download index
-            tmp_index = os.path.join(tempfile.gettempdir(), f"{session_id}_index.json")
-            s3.download_file(S3_BUCKET, index_key, tmp_index)
-            with open(tmp_index, 'r', encoding='utf-8') as f:
-                index_obj = json.load(f)
-
-            texts = index_obj.get('texts', [])
-            embeddings = index_obj.get('embeddings', [])
-
-            # Compute query embedding
-            query_emb = bedrock_rag.get_titan_embedding(question)
             top_k = 3
-            ranked = []
-            if query_emb and embeddings:
-                # cosine similarity
-                import math
-                def cosine(a, b):
-                    if not a or not b:
-                        return -1
-                    dot = sum(x*y for x,y in zip(a,b))
-                    norm_a = math.sqrt(sum(x*x for x in a))
-                    norm_b = math.sqrt(sum(x*x for x in b))
-                    if norm_a==0 or norm_b==0:
-                        return -1
-                    return dot/(norm_a*norm_b)
-
-                scores = [(i, cosine(query_emb, emb)) for i, emb in enumerate(embeddings)]
-                scores = sorted(scores, key=lambda x: x[1], reverse=True)
-                ranked = [texts[i] for i,_ in scores[:top_k]]
-            else:
-                # fallback: simple keyword matching
-                q = question.lower()
-                scores = []
-                for i,t in enumerate(texts):
-                    scores.append((i, t.lower().count(q)))
-                scores = sorted(scores, key=lambda x: x[1], reverse=True)
-                ranked = [texts[i] for i,_ in scores[:top_k]]
+            scores = retrieve(index, question, top_k)
+            rows = [i for i,_ in scores] or range(min(top_k, len(index)))
+            ranked = [index.text(i) for i in rows]
+            # which uploaded document each passage came from
+            sources = [{'filename': index.document(i).get('filename'), 'score': score} for i, score in scores]
+            if len(index.documents) > 1:
+                ranked = [f"[{index.document(i).get('filename')}] {text}" for i, text in zip(rows, ranked)]
 
             # Build prompt with top_k contexts
             context_text = "\n\n".join(ranked)
@@ -272,6 +725,7 @@ def ask(event, context):
                 'answer': answer or "Không thể tạo câu trả lời.",
                 'used_document': True,
                 'filename': session_data.get('filename'),
+                'sources': sources,
                 'model': 'bedrock-titan'
             })
         else:
@@ -292,13 +746,16 @@ def ask(event, context):
     except json.JSONDecodeError as je:
         logger.error(f"Invalid JSON in request: {str(je)}")
         return error_response("Invalid request format")
+    except BedrockBusyError as be:
+        logger.warning(f"Bedrock throttled during ask: {str(be)}")
+        return error_response('Bedrock is busy right now, please ask again shortly', 429)
     except Exception as e:
         logger.error(f"❌ Ask error: {str(e)}", exc_info=True)
         return error_response(f"Ask failed: {str(e)}")
 
-def success_response(data):
+def success_response(data, status_code=200):
     return {
-        'statusCode': 200,
+        'statusCode': status_code,
         'headers': {
             'Access-Control-Allow-Origin': '*',
             'Access-Control-Allow-Headers': 'Content-Type',
@@ -307,9 +764,9 @@ def success_response(data):
         'body': json.dumps(data)
     }
 
-def error_response(message):
+def error_response(message, status_code=500):
     return {
-        'statusCode': 500,
+        'statusCode': status_code,
         'headers': {
             'Access-Control-Allow-Origin': '*',
             'Access-Control-Allow-Headers': 'Content-Type', 
@@ -0,0 +1,837 @@
+"""Asynchronous document ingestion driven by S3 uploads.
+
+``/upload`` used to download, extract, embed and write the index inside
+the API Gateway request, so any document slower than API Gateway's 29
+second limit failed even though the function may run for 15 minutes.
+Ingestion now runs in the ``ingest`` worker, triggered by the PUT under
+``uploads/``. The API side only creates a job record and reads it back:
+
+* ``JobStore`` keeps one ``DocQAJobs`` item per uploaded object, with the
+  status (queued -> running -> succeeded | failed | cancelled), the current
+  stage and per-stage progress (pages extracted, chunks embedded);
+* ``IngestionWorker`` claims a job with a lease, runs the pipeline and
+  reports progress as it goes. The lease is renewed by every report, and
+  its owner is the Lambda request id, so an automatic retry of a crashed
+  or timed-out invocation takes its job straight back while duplicate S3
+  events for a live job are no-ops;
+* extraction and embedding overlap: chunks come out of a page-at-a-time
+  generator and are embedded in batches while later pages are still
+  being parsed, so memory is bounded by the batches in flight plus the
+  rows of the index being built, not by extra copies of the document;
+* work is checkpointed: every embedded batch is written as a shard and
+  recorded on the job, and the chunk list is saved once extraction
+  finishes, so a retried run resumes from the last completed batch
+  instead of re-embedding from chunk zero (and, once the chunk list is
+  saved, without extracting again);
+* cancelling a running job sets ``cancel_requested``; the worker sees it
+  at the next embedding batch and stops before spending more Bedrock
+  capacity;
+* chunks past the first ``fanout_min_chunks`` are embedded map/reduce
+  style (see fanout.py): their batches go to a queue, each batch worker
+  records its batch on the job, and the one that completes the set
+  aggregates the shards and finishes the job;
+* an upload under ``uploads/sessions/<session_id>/`` is added to that
+  session (see session_store.py) instead of starting a new one: only the
+  new document is embedded, into its own index, and the session's merged
+  index is rebuilt from the stored rows. One under
+  ``uploads/collections/<collection_id>/`` is added to that collection
+  (see collection_search.py) with a routing row summarising it.
+"""
+import hashlib
+import json
+from array import array
+import logging
+import time
+import uuid
+from contextlib import ExitStack, closing
+from datetime import datetime
+from decimal import Decimal
+from urllib.parse import unquote_plus
+
+from botocore.exceptions import ClientError
+
+from ann_index import ANN_MIN_ROWS, ANN_VERSION, DEFAULT_NPROBE
+from collection_search import COLLECTION_PREFIX, CollectionStore, collection_key, is_collection, routing_row
+from document_registry import checksum_to_hex, document_key, settings_fingerprint
+from fanout import batch_input_key, batch_ranges, job_object_keys, plan_key, shard_key
+from page_cache import PageCache, PageRecorder
+from rag_bedrock import EMBEDDING_MODEL_ID
+from rate_control import BedrockBusyError
+from session_store import SessionStore, session_documents
+from upload_stream import UPLOAD_SPILL_BYTES, get_upload, read_upload
+from vector_index import CONTENT_TYPE as INDEX_CONTENT_TYPE, FORMAT_VERSION as INDEX_FORMAT_VERSION
+from vector_index import load_index_bytes, merge_indexes, serialize_index
+
+logger = logging.getLogger(__name__)
+
+QUEUED, RUNNING, SUCCEEDED, FAILED, CANCELLED = 'queued', 'running', 'succeeded', 'failed', 'cancelled'
+TERMINAL_STATUSES = (SUCCEEDED, FAILED, CANCELLED)
+
+JOB_TTL_SECONDS = 7 * 24 * 3600
+# Renewed by every progress report; a worker silent for this long is presumed dead
+JOB_LEASE_SECONDS = 300
+SESSION_TTL_HOURS = 24
+# Uploads under these prefixes name the session / collection they are added to
+SESSION_UPLOAD_PREFIX = 'uploads/sessions/'
+COLLECTION_UPLOAD_PREFIX = 'uploads/collections/'
+# Chunks embedded between checkpoints / cancellation checks
+EMBED_BATCH_SIZE = 128
+# Minimum seconds between page-progress writes
+PROGRESS_INTERVAL = 2.0
+# Fan-out: chunks past this many are embedded across batch workers
+FANOUT_MIN_CHUNKS = 2000
+FANOUT_BATCH_SIZE = 256
+# Once fanned out the planner's lease only guards against re-planning
+FANOUT_LEASE_SECONDS = 24 * 3600
+
+CLAIM_CONDITION = ('#status = :queued OR '
+                   '(#status = :running AND (lease_expires_at < :now OR lease_owner = :owner))')
+OWNER_CONDITION = '#status = :running AND lease_owner = :owner'
+RUNNING_CONDITION = '#status = :running'
+BATCH_CONDITION = '#status = :running AND NOT contains(batches_completed, :batch_id)'
+OWNED_BATCH_CONDITION = BATCH_CONDITION + ' AND lease_owner = :owner'
+
+
+def job_id_for(s3_key):
+    """Job id for an uploaded object; the S3 event and /upload derive the same one"""
+    return hashlib.sha1(s3_key.encode('utf-8')).hexdigest()
+
+
+def upload_session(s3_key):
+    """Session (``collection#<id>`` for a collection) an uploaded object is
+    added to, or None when it starts a new session"""
+    for prefix, item_id in ((SESSION_UPLOAD_PREFIX, str), (COLLECTION_UPLOAD_PREFIX, collection_key)):
+        if s3_key.startswith(prefix):
+            name = s3_key[len(prefix):].split('/', 1)[0]
+            return item_id(name) if name else None
+    return None
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobLeaseLost(Exception):
+    """Another worker took the job over after our lease expired"""
+
+
+def _is_condition_failure(error):
+    return error.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException'
+
+
+def _set_expression(fields):
+    names = {f'#f{i}': name for i, name in enumerate(fields)}
+    values = {f':f{i}': value for i, value in enumerate(fields.values())}
+    expression = 'SET ' + ', '.join(f'#f{i} = :f{i}' for i in range(len(fields)))
+    return expression, names, values
+
+
+class JobStore:
+    """Ingestion job records in a DynamoDB table keyed by ``job_id``"""
+
+    def __init__(self, table, clock=time.time, lease_seconds=JOB_LEASE_SECONDS):
+        self.table = table
+        self.clock = clock
+        self.lease_seconds = lease_seconds
+
+    def create(self, job_id, s3_key, filename):
+        """Create the job if it does not exist yet; returns the current record"""
+        now = int(self.clock())
+        item = {
+            'job_id': job_id,
+            's3_key': s3_key,
+            'filename': filename,
+            'status': QUEUED,
+            'stage': QUEUED,
+            'created_at': now,
+            'updated_at': now,
+            'expires_at': now + JOB_TTL_SECONDS,
+        }
+        try:
+            self.table.put_item(Item=item, ConditionExpression='attribute_not_exists(job_id)')
+            return item
+        except ClientError as e:
+            if not _is_condition_failure(e):
+                raise
+        return self.get(job_id)
+
+    def get(self, job_id):
+        return self.table.get_item(Key={'job_id': job_id}, ConsistentRead=True).get('Item')
+
+    def _update(self, job_id, fields, condition=None, values=None):
+        expression, names, field_values = _set_expression(dict(fields, updated_at=int(self.clock())))
+        params = {
+            'Key': {'job_id': job_id},
+            'UpdateExpression': expression,
+            'ExpressionAttributeNames': names,
+            'ExpressionAttributeValues': field_values,
+            'ReturnValues': 'ALL_NEW',
+        }
+        if condition:
+            params['ConditionExpression'] = condition
+            params['ExpressionAttributeNames']['#status'] = 'status'
+            params['ExpressionAttributeValues'].update(values or {})
+        try:
+            return self.table.update_item(**params).get('Attributes')
+        except ClientError as e:
+            if _is_condition_failure(e):
+                return None
+            raise
+
+    def claim(self, job_id, owner):
+        """Take a queued job, one whose lease ran out, or one ``owner`` already held.
+
+        Returns the record (with any checkpoint fields), or None if not claimable.
+        """
+        now = int(self.clock())
+        return self._update(job_id, {
+            'status': RUNNING,
+            'lease_owner': owner,
+            'lease_expires_at': now + self.lease_seconds,
+        }, CLAIM_CONDITION, {':queued': QUEUED, ':running': RUNNING, ':now': now, ':owner': owner})
+
+    def report(self, job_id, owner, **fields):
+        """Record progress and renew the lease; returns the updated record"""
+        fields = dict({'lease_expires_at': int(self.clock()) + self.lease_seconds}, **fields)
+        record = self._update(job_id, fields, OWNER_CONDITION, {':running': RUNNING, ':owner': owner})
+        if record is None:
+            raise JobLeaseLost(job_id)
+        return record
+
+    def finish(self, job_id, owner, status, **fields):
+        """Move a running job to a terminal status (``owner`` None: any worker may)"""
+        if owner is None:
+            return self._update(job_id, dict(fields, status=status, stage=status), RUNNING_CONDITION,
+                                {':running': RUNNING})
+        return self._update(job_id, dict(fields, status=status, stage=status), OWNER_CONDITION,
+                            {':running': RUNNING, ':owner': owner})
+
+    def batch_done(self, job_id, batch, chunks, owner=None):
+        """Record a completed batch once; None if it was already recorded or the job ended.
+
+        With ``owner`` (checkpoints of a single worker) the lease must still
+        be held and is renewed.
+        """
+        now = int(self.clock())
+        values = {':one': 1, ':chunks': chunks, ':batch': {str(batch)}, ':batch_id': str(batch),
+                  ':running': RUNNING, ':now': now}
+        update = 'ADD batches_done :one, chunks_embedded :chunks, batches_completed :batch SET updated_at = :now'
+        if owner is not None:
+            update += ', lease_expires_at = :lease'
+            values.update({':owner': owner, ':lease': now + self.lease_seconds})
+        try:
+            response = self.table.update_item(
+                Key={'job_id': job_id},
+                UpdateExpression=update,
+                ConditionExpression=BATCH_CONDITION if owner is None else OWNED_BATCH_CONDITION,
+                ExpressionAttributeNames={'#status': 'status'},
+                ExpressionAttributeValues=values,
+                ReturnValues='ALL_NEW')
+        except ClientError as e:
+            if _is_condition_failure(e):
+                return None
+            raise
+        return response.get('Attributes')
+
+    def request_cancel(self, job_id):
+        """Cancel a queued job outright, or ask its running worker to stop"""
+        record = self._update(job_id, {'status': CANCELLED, 'stage': CANCELLED},
+                              '#status = :queued', {':queued': QUEUED})
+        if record is None:
+            record = self._update(job_id, {'cancel_requested': True},
+                                  '#status = :running', {':running': RUNNING})
+        return record or self.get(job_id)
+
+
+class _Progress:
+    """Rate-limited progress writes for one claimed job"""
+
+    def __init__(self, jobs, job_id, owner, clock=time.monotonic):
+        self.jobs = jobs
+        self.job_id = job_id
+        self.owner = owner
+        self.clock = clock
+        self._last = None
+
+    def report(self, force=True, **fields):
+        now = self.clock()
+        if not force and self._last is not None and now - self._last < PROGRESS_INTERVAL:
+            return None
+        self._last = now
+        record = self.jobs.report(self.job_id, self.owner, **fields)
+        if record.get('cancel_requested'):
+            raise JobCancelled(self.job_id)
+        return record
+
+    def pages(self, done, total):
+        """Page callback for extraction"""
+        self.report(force=done == total, pages_extracted=done, pages_total=total)
+
+    def checkpoint(self, batch, chunks):
+        """Record an embedded batch whose shard has been written"""
+        record = self.jobs.batch_done(self.job_id, batch, chunks, owner=self.owner)
+        if record is None:
+            raise JobLeaseLost(self.job_id)
+        self._last = self.clock()
+        if record.get('cancel_requested'):
+            raise JobCancelled(self.job_id)
+        return record
+
+
+class IngestionWorker:
+    """Runs one uploaded document through download -> extract -> embed -> index"""
+
+    def __init__(self, s3, bucket, sessions, registry, jobs, rag, tmp_cache, validate,
+                 quantization='none', rescore_dtype='float32', embed_batch_size=EMBED_BATCH_SIZE,
+                 queue=None, fanout_min_chunks=FANOUT_MIN_CHUNKS, fanout_batch_size=FANOUT_BATCH_SIZE,
+                 spill_bytes=UPLOAD_SPILL_BYTES, ann_min_rows=ANN_MIN_ROWS, ann_nlist=None,
+                 ann_nprobe=DEFAULT_NPROBE):
+        self.s3 = s3
+        self.bucket = bucket
+        self.sessions = sessions
+        self.session_store = SessionStore(sessions, s3, bucket, SESSION_TTL_HOURS)
+        self.collections = CollectionStore(sessions, s3, bucket)
+        self.registry = registry
+        self.jobs = jobs
+        self.rag = rag
+        self.tmp_cache = tmp_cache
+        self.validate = validate
+        self.quantization = quantization
+        self.rescore_dtype = rescore_dtype
+        self.ann_min_rows = ann_min_rows
+        self.ann_nlist = ann_nlist
+        self.ann_nprobe = ann_nprobe
+        self.embed_batch_size = embed_batch_size
+        self.queue = queue
+        self.fanout_min_chunks = fanout_min_chunks
+        self.fanout_batch_size = fanout_batch_size
+        self.spill_bytes = spill_bytes
+        self.page_cache = PageCache(s3, bucket)
+
+    def fingerprint(self):
+        """Settings besides the content that an index depends on"""
+        return settings_fingerprint({
+            'chunking': self.rag.chunking_settings(),
+            'embedding_model': EMBEDDING_MODEL_ID,
+            'index_format': INDEX_FORMAT_VERSION,
+            'quantization': self.quantization,
+            'rescore_dtype': self.rescore_dtype,
+            'ann': [ANN_VERSION, self.ann_min_rows, self.ann_nlist, self.ann_nprobe],
+        })
+
+    def run(self, job_id, owner=None):
+        """Process a job if it can be claimed; returns the final job record.
+
+        ``owner`` identifies the attempt: pass the Lambda request id, which
+        stays the same when Lambda retries the invocation.
+        """
+        owner = owner or uuid.uuid4().hex
+        job = self.jobs.claim(job_id, owner)
+        if job is None:
+            logger.info(f"Job {job_id} is not claimable, skipping")
+            return self.jobs.get(job_id)
+
+        progress = _Progress(self.jobs, job_id, owner)
+        try:
+            result = self._process(job, progress)
+        except JobCancelled:
+            logger.info(f"🛑 Job {job_id} cancelled")
+            return self.jobs.finish(job_id, owner, CANCELLED)
+        except JobLeaseLost:
+            logger.warning(f"Job {job_id} was taken over by another worker")
+            return self.jobs.get(job_id)
+        except ValueError as e:
+            logger.error(f"Job {job_id} rejected: {e}")
+            return self.jobs.finish(job_id, owner, FAILED, error=str(e))
+        except BedrockBusyError as e:
+            logger.warning(f"Bedrock throttled during job {job_id}: {e}")
+            return self.jobs.finish(job_id, owner, FAILED,
+                                    error='Bedrock is busy right now, please retry the upload shortly')
+        except Exception as e:
+            logger.error(f"❌ Job {job_id} failed: {e}", exc_info=True)
+            return self.jobs.finish(job_id, owner, FAILED, error=f"Upload processing failed: {e}")
+        if result is None:
+            # fanned out; the batch workers finish the job
+            return self.jobs.get(job_id)
+        return self.jobs.finish(job_id, owner, SUCCEEDED, **result)
+
+    def _process(self, job, progress):
+        plan, embeddings = self._load_plan(job), None
+        if plan is None:
+            plan = self._stream(job, progress)
+            if 'texts' not in plan:
+                return plan  # identical document already indexed
+            embeddings = plan.pop('embeddings')
+            # the saved record includes the batches checkpointed while streaming
+            job = self._save_plan(job, progress, plan)
+        else:
+            logger.info(f"⏯️ Resuming job {job['job_id']} with "
+                        f"{len(job.get('batches_completed', ()))}/{job.get('batches_total')} batches done")
+
+        if plan['mode'] == 'fanout':
+            self._fan_out(job, progress, plan)
+            return None
+
+        texts = plan['texts']
+        if embeddings is None:
+            embeddings = self._embed(job, progress, texts, plan['ranges'])
+        logger.info(f"Embedding cache: {self.rag.embedding_cache.stats()}")
+
+        progress.report(stage='indexing')
+        result = self._write_index(plan['session_id'], plan.get('document_id', plan['session_id']),
+                                   job['filename'], plan['content_sha256'], self.fingerprint(), texts, embeddings)
+        self._remove_job_objects(job['job_id'], len(plan['ranges']))
+        return result
+
+    def _stream(self, job, progress):
+        """Download, dedup, then extract and embed in one pass.
+
+        Returns the plan (with the embeddings of the batches embedded here),
+        or the result of reusing an index. A document added to an existing
+        session gets its own id; the first one shares the session's.
+        """
+        s3_key, filename = job['s3_key'], job['filename']
+        document_id = str(uuid.uuid4())
+        session_id = upload_session(s3_key) or document_id
+        appending = session_id != document_id
+        if appending and not is_collection(session_id) and self.session_store.get(session_id) is None:
+            raise ValueError('Session not found or expired')
+        fingerprint = self.fingerprint()
+
+        progress.report(stage='downloading')
+        response = get_upload(self.s3, self.bucket, s3_key)
+        recorder = None
+        with closing(response['Body']) as body, ExitStack() as cleanup:
+            self.validate(filename, response.get('ContentType', 'application/octet-stream'),
+                          response['ContentLength'])
+
+            # A checksum S3 verified on PUT (see presign) lets identical
+            # documents, or PDFs whose pages are cached, skip reading the body
+            content_hash = checksum_to_hex(response.get('ChecksumSHA256'))
+            reused = self._acquire(content_hash, fingerprint, session_id, document_id, filename)
+            if reused:
+                return reused
+
+            pdf = _is_pdf(filename)
+            if content_hash and not pdf:
+                # already checked for duplicates: text is decoded straight
+                # off the response, block by block
+                pages = self.rag.iter_pages(body, progress=progress.pages, filename=filename)
+            else:
+                pages = self._cached_pages(content_hash, progress)
+                if pages is None:
+                    # pypdf needs random access, and content without a checksum
+                    # is hashed before anything is split or embedded: the body
+                    # is held in memory (or spilled)
+                    upload = cleanup.enter_context(closing(
+                        read_upload(response, filename, self.tmp_cache, self.spill_bytes)))
+                    if not content_hash:
+                        content_hash = upload.sha256
+                        reused = self._acquire(content_hash, fingerprint, session_id, document_id, filename)
+                        if reused:
+                            return reused
+                        if pdf:
+                            pages = self._cached_pages(content_hash, progress)
+                if pages is None:
+                    logger.info(f"🔄 Processing document from S3: {s3_key} "
+                                f"({upload.size} bytes{', spilled to disk' if upload.spilled else ''})")
+                    pages = self.rag.iter_pages(upload.source, progress=progress.pages, filename=filename)
+                    if pdf:
+                        recorder = PageRecorder()
+                        pages = recorder.record(pages)
+
+            # batch numbering must not change between attempts, or the
+            # checkpoints of an earlier one would not line up
+            batch_size = int(job.get('stream_batch_size') or self.embed_batch_size)
+            progress.report(stage='extracting', stream_batch_size=batch_size)
+            chunks = self.rag.iter_chunks(pages, paged=pdf)
+            texts, embeddings = self._embed_stream(job, progress, _extracted(chunks), batch_size)
+
+        if recorder is not None:
+            self.page_cache.put(content_hash, recorder)
+
+        if not texts:
+            raise ValueError('Failed to process document. The file may be empty or corrupted.')
+
+        ranges = batch_ranges(len(embeddings), batch_size)
+        fan_out = len(embeddings) < len(texts)
+        if fan_out:
+            ranges += [(start + len(embeddings), end + len(embeddings)) for start, end in
+                       batch_ranges(len(texts) - len(embeddings), self.fanout_batch_size)]
+        return {
+            'session_id': session_id,
+            'document_id': document_id,
+            'content_sha256': content_hash,
+            'mode': 'fanout' if fan_out else 'single',
+            'ranges': ranges,
+            'texts': texts,
+            'embeddings': embeddings,
+        }
+
+    def _acquire(self, content_hash, fingerprint, session_id, document_id, filename):
+        """Reuse the index of identical content, if there is one"""
+        if not content_hash:
+            return None
+        doc_key = document_key(content_hash, fingerprint)
+        if session_id != document_id:
+            # the session may hold this content already (the registry counts it once)
+            session, documents = self._documents(session_id)
+            held = [d for d in documents if d.get('doc_key') == doc_key]
+            if held:
+                logger.info(f"♻️ {session_id} already holds the content of {filename}")
+                return _result(session, held[0], deduplicated=True)
+        record = self.registry.acquire(doc_key, session_id)
+        return self._reuse_index(session_id, document_id, filename, record) if record else None
+
+    def _cached_pages(self, content_hash, progress):
+        if not content_hash:
+            return None
+        return self.page_cache.get(content_hash, progress=progress.pages)
+
+    def _embed_stream(self, job, progress, chunks, batch_size):
+        """Embed chunks batch by batch as extraction produces them.
+
+        Each batch is checkpointed; batches an earlier attempt finished are
+        read back from their shards. With a queue, only the first
+        ``fanout_min_chunks`` chunks (rounded up to a batch) are embedded
+        here and the rest are just collected for fan-out.
+        Returns (texts, embeddings of the leading batches embedded here).
+        """
+        job_id = job['job_id']
+        completed = set(job.get('batches_completed', ()))
+
+        def local(batch):
+            return self.queue is None or batch * batch_size < self.fanout_min_chunks
+
+        texts, embeddings = [], []
+        batches = self.rag.embed_batches(
+            _batched((chunk["page_content"] for chunk in chunks), batch_size),
+            skip=lambda batch: str(batch) in completed or not local(batch))
+        with closing(batches):
+            for batch, (batch_texts, batch_embeddings) in enumerate(batches):
+                start = len(texts)
+                texts.extend(batch_texts)
+                if not local(batch):
+                    continue
+                if str(batch) in completed:
+                    embeddings.extend(self._read_shard(job_id, batch))
+                    continue
+                batch_embeddings = [emb or [] for emb in batch_embeddings]
+                self._write_shard(job_id, batch, batch_texts, batch_embeddings, start)
+                progress.checkpoint(batch, len(batch_texts))
+                embeddings.extend(batch_embeddings)
+        return texts, embeddings
+
+    # -- checkpoints --------------------------------------------------
+
+    def _save_plan(self, job, progress, plan):
+        """Checkpoint the chunk list so a retry never extracts again"""
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=plan_key(job['job_id']),
+            Body=json.dumps(plan).encode('utf-8'),
+            ContentType='application/json'
+        )
+        return progress.report(planned=True, chunks_total=len(plan['texts']), batches_total=len(plan['ranges']))
+
+    def _load_plan(self, job):
+        if not job.get('planned'):
+            return None
+        try:
+            return json.loads(self._read(plan_key(job['job_id'])))
+        except ClientError as e:
+            logger.warning(f"Checkpoint of job {job['job_id']} is unreadable, starting over: {e}")
+            return None
+
+    def _embed(self, job, progress, texts, ranges):
+        """Embed the planned batches, checkpointing each one; batches done by
+        an earlier attempt are read back from their shards"""
+        job_id = job['job_id']
+        completed = set(job.get('batches_completed', ()))
+        progress.report(stage='embedding')
+        embeddings = []
+        for batch, (start, end) in enumerate(ranges):
+            if str(batch) in completed:
+                embeddings.extend(self._read_shard(job_id, batch))
+                continue
+            batch_embeddings = [emb or [] for emb in self.rag.embed_texts(texts[start:end])]
+            self._write_shard(job_id, batch, texts[start:end], batch_embeddings, start)
+            progress.checkpoint(batch, end - start)
+            embeddings.extend(batch_embeddings)
+        return embeddings
+
+    def _write_shard(self, job_id, batch, texts, embeddings, start):
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=shard_key(job_id, batch),
+            Body=serialize_index(texts, embeddings, metadata={'start': start}),
+            ContentType=INDEX_CONTENT_TYPE
+        )
+
+    def _read_shard(self, job_id, batch):
+        shard = load_index_bytes(self._read(shard_key(job_id, batch)))
+        norms = shard.norms()
+        # array('d') holds the same values as a list of floats in a quarter
+        # of the memory, which matters when aggregating large documents
+        return [array('d', shard.vector(i)) if norms[i] else [] for i in range(len(shard))]
+
+    def _remove_job_objects(self, job_id, batches_total):
+        keys = list(job_object_keys(job_id, batches_total))
+        for start in range(0, len(keys), 1000):
+            self.s3.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': key} for key in keys[start:start + 1000]], 'Quiet': True})
+
+    # -- fan-out ------------------------------------------------------
+
+    def _fan_out(self, job, progress, plan):
+        """Write batch inputs and enqueue a message per batch not yet embedded"""
+        job_id, texts = job['job_id'], plan['texts']
+        completed = set(job.get('batches_completed', ()))
+        pending = []
+        for batch, (start, end) in enumerate(plan['ranges']):
+            if str(batch) in completed:
+                continue
+            self.s3.put_object(
+                Bucket=self.bucket,
+                Key=batch_input_key(job_id, batch),
+                Body=json.dumps({'start': start, 'texts': texts[start:end]}).encode('utf-8'),
+                ContentType='application/json'
+            )
+            pending.append(batch)
+        progress.report(
+            stage='embedding', mode='fanout', fanout_session_id=plan['session_id'],
+            fanout_document_id=plan.get('document_id', plan['session_id']),
+            content_sha256=plan['content_sha256'],
+            lease_expires_at=int(self.jobs.clock()) + FANOUT_LEASE_SECONDS)
+        self.queue.send_many({'job_id': job_id, 'batch': batch} for batch in pending)
+        logger.info(f"🔀 Job {job_id}: fanned {len(texts)} chunks out, {len(pending)} batches queued")
+
+    def run_batch(self, message):
+        """Embed one fan-out batch; the worker that lands the last batch aggregates.
+
+        Returns the job record when this call finished the job, else None.
+        Redelivered messages and batches of finished jobs are no-ops.
+        BedrockBusyError propagates so the queue redelivers the batch.
+        """
+        job_id, batch = message['job_id'], int(message['batch'])
+        job = self.jobs.get(job_id)
+        if not job or job.get('status') != RUNNING or job.get('mode') != 'fanout':
+            return None
+        if job.get('cancel_requested'):
+            logger.info(f"🛑 Job {job_id} cancelled, dropping batch {batch}")
+            return self._end_fanout(job, CANCELLED)
+        if str(batch) in job.get('batches_completed', ()):
+            return None
+
+        try:
+            payload = json.loads(self._read(batch_input_key(job_id, batch)))
+            embeddings = [emb or [] for emb in self.rag.embed_texts(payload['texts'])]
+            self._write_shard(job_id, batch, payload['texts'], embeddings, payload['start'])
+        except BedrockBusyError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Job {job_id} batch {batch} failed: {e}", exc_info=True)
+            return self._end_fanout(job, FAILED, error=f"Upload processing failed: {e}")
+
+        job = self.jobs.batch_done(job_id, batch, len(payload['texts']))
+        if job is None:
+            return None
+        if job.get('cancel_requested'):
+            return self._end_fanout(job, CANCELLED)
+        if int(job['batches_done']) < int(job['batches_total']):
+            return None
+        return self._aggregate(job)
+
+    def _aggregate(self, job):
+        """Merge every shard, in batch order, into the session's index"""
+        job_id = job['job_id']
+        try:
+            texts = json.loads(self._read(plan_key(job_id)))['texts']
+            embeddings = []
+            for batch in range(int(job['batches_total'])):
+                embeddings.extend(self._read_shard(job_id, batch))
+            result = self._write_index(job['fanout_session_id'],
+                                       job.get('fanout_document_id', job['fanout_session_id']),
+                                       job['filename'], job['content_sha256'], self.fingerprint(), texts, embeddings)
+        except Exception as e:
+            logger.error(f"❌ Job {job_id} aggregation failed: {e}", exc_info=True)
+            return self._end_fanout(job, FAILED, error=f"Upload processing failed: {e}")
+        return self._end_fanout(job, SUCCEEDED, **result)
+
+    def _end_fanout(self, job, status, **fields):
+        record = self.jobs.finish(job['job_id'], None, status, **fields)
+        self._remove_job_objects(job['job_id'], int(job.get('batches_total', 0)))
+        return record
+
+    def _read(self, key):
+        return self.s3.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+
+    # -- index + session ----------------------------------------------
+
+    def _write_index(self, session_id, document_id, filename, content_hash, fingerprint, texts, embeddings):
+        index_key = f"vector_stores/{document_id}.idx"
+        index_body = serialize_index(texts, embeddings, metadata={
+            'session_id': session_id,
+            'document_id': document_id,
+            'filename': filename,
+            'chunks_count': len(texts),
+            'content_sha256': content_hash,
+            'created_at': datetime.now().isoformat()
+        }, **self._index_settings())
+
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=index_key,
+            Body=index_body,
+            ContentType=INDEX_CONTENT_TYPE
+        )
+
+        doc_key = document_key(content_hash, fingerprint)
+        record = self.registry.register(doc_key, session_id, index_key, filename, len(texts))
+        if record is not None and record['index_key'] != index_key:
+            # an identical upload finished first; share its index instead
+            self.s3.delete_object(Bucket=self.bucket, Key=index_key)
+            return self._reuse_index(session_id, document_id, filename, record)
+
+        document = {'document_id': document_id, 'filename': filename, 'chunks_count': len(texts),
+                    'index_key': index_key}
+        if record is not None:
+            document['doc_key'] = doc_key
+        try:
+            session = self._attach(session_id, document)
+        except Exception:
+            if record is None:
+                self.s3.delete_object(Bucket=self.bucket, Key=index_key)
+            else:
+                self._release(doc_key, session_id)
+            raise
+        logger.info(f"✅ Document processed successfully: {filename} ({len(texts)} chunks)")
+        return _result(session, document)
+
+    def _index_settings(self):
+        return {
+            'quantization': self.quantization,
+            'rescore_dtype': None if self.rescore_dtype == 'none' else self.rescore_dtype,
+            'lexical': True,
+            'ann_min_rows': self.ann_min_rows,
+            'ann_nlist': self.ann_nlist,
+            'ann_nprobe': self.ann_nprobe,
+        }
+
+    def _documents(self, session_id):
+        """(item, documents) of a session or collection"""
+        if is_collection(session_id):
+            item = self.collections.get(session_id[len(COLLECTION_PREFIX):])
+            routing = self.collections.routing(item)
+            return item, routing.documents if routing is not None else []
+        item = self.session_store.get(session_id)
+        return item, session_documents(item or {})
+
+    def _attach(self, session_id, document):
+        """The session item after adding ``document``: a new session for the
+        first document, else one more document of an existing session or
+        collection"""
+        if is_collection(session_id):
+            index = load_index_bytes(self._read(document['index_key']))
+            try:
+                row = routing_row(index, document['filename'])
+            finally:
+                index.close()
+            return self.collections.add(session_id[len(COLLECTION_PREFIX):], document, row)
+        if document['document_id'] == session_id:
+            return self.session_store.create(session_id, document)
+        return self.session_store.add(session_id, document, self._merge_documents)
+
+    def _merge_documents(self, documents, metadata):
+        """Merged index over the stored indexes of ``documents`` (nothing is re-embedded)"""
+        indexes = [load_index_bytes(self._read(document['index_key'])) for document in documents]
+        try:
+            return merge_indexes(indexes, metadata, **self._index_settings())
+        finally:
+            for index in indexes:
+                index.close()
+
+    def _release(self, doc_key, session_id):
+        index_key = self.registry.release(doc_key, session_id)
+        if index_key:
+            self.s3.delete_object(Bucket=self.bucket, Key=index_key)
+
+    def _reuse_index(self, session_id, document_id, filename, record):
+        """Add an index another upload of the same content built to the session"""
+        document = {'document_id': document_id, 'filename': filename,
+                    'chunks_count': int(record['chunks_count']), 'index_key': record['index_key'],
+                    'doc_key': record['doc_key']}
+        try:
+            session = self._attach(session_id, document)
+        except Exception:
+            self._release(record['doc_key'], session_id)
+            raise
+
+        logger.info(f"♻️ Reusing index {record['index_key']} for identical upload of {filename}")
+        return _result(session, document, deduplicated=True)
+
+
+def _result(session, document, **fields):
+    """Job result for ``document`` once it is part of ``session`` (or a collection)"""
+    result = {
+        'document_id': document['document_id'],
+        'chunks_count': int(document['chunks_count']),
+        'documents_count': int(session.get('documents_count') or len(session_documents(session))),
+    }
+    if session.get('collection_id'):
+        result['collection_id'] = session['collection_id']
+    else:
+        result['session_id'] = session['session_id']
+    return dict(result, **fields)
+
+
+def _is_pdf(filename):
+    return filename.lower().endswith('.pdf')
+
+
+def _batched(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _extracted(chunks):
+    """Chunks from the extraction generator, with parse errors reported as bad input"""
+    try:
+        yield from chunks
+    except (JobCancelled, JobLeaseLost):
+        raise
+    except Exception as e:
+        logger.error(f"❌ Document extraction failed: {e}")
+        raise ValueError('Failed to process document. The file may be empty or corrupted.')
+
+
+def public_job(job):
+    """The fields of a job record the status API exposes"""
+    if not job:
+        return None
+    fields = ('job_id', 'status', 'stage', 'filename', 'pages_extracted', 'pages_total',
+              'chunks_total', 'chunks_embedded', 'session_id', 'collection_id', 'document_id', 'chunks_count',
+              'documents_count', 'deduplicated', 'error', 'cancel_requested')
+    result = {}
+    for field in fields:
+        value = job.get(field)
+        if value is None:
+            continue
+        # DynamoDB numbers come back as Decimal
+        result[field] = int(value) if isinstance(value, Decimal) else value
+    return result
+
+
+def s3_event_keys(event):
+    """Object keys of an S3 event notification, URL-decoded"""
+    for record in event.get('Records', []):
+        obj = record.get('s3', {}).get('object', {})
+        if obj.get('key'):
+            yield unquote_plus(obj['key'])
+
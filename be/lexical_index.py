@@ -0,0 +1,137 @@
+"""BM25 keyword index over chunk texts, stored in the session index file.
+
+Used when the question cannot be embedded, in place of counting
+occurrences of the whole question string in every chunk (which scanned all
+of the text and almost never matched). Built once at ingestion from the
+chunk texts and serialized as extra sections of the binary index (see
+vector_index):
+
+    lex_terms     sorted terms, UTF-8, "\\n"-separated
+    lex_postings  uint64, terms + 1 offsets into lex_docs / lex_tfs
+    lex_docs      uint32 chunk numbers, ascending within a term
+    lex_tfs       uint16 term frequency in that chunk (capped at 65535)
+    lex_lengths   uint32 chunk lengths in tokens
+
+The number of chunks, the average length and the tokenizer version are
+kept in the ``lex_terms`` section info. A query decodes only the postings
+of its own terms, so it costs time proportional to the postings it
+touches, not to the size of the document.
+
+``tokenize`` folds Vietnamese diacritics (and đ to d) and case, so "Hợp
+đồng" matches "hop dong". Identifiers like "HD-2023/045" are indexed whole
+as well as in parts, so a pasted contract number or error code matches
+exactly.
+"""
+import heapq
+import math
+import re
+import struct
+import unicodedata
+from collections import Counter
+
+TOKENIZER_VERSION = 'fold-1'
+BM25_K1 = 1.2
+BM25_B = 0.75
+SECTIONS = ('lex_terms', 'lex_postings', 'lex_docs', 'lex_tfs', 'lex_lengths')
+
+_COMBINING = re.compile(r'[̀-ͯ]+')
+_FOLD = str.maketrans({'đ': 'd', 'Đ': 'd'})
+_WORD = re.compile(r'[^\W_]+')
+_IDENTIFIER = re.compile(r'[^\W_]+(?:[-/._:][^\W_]+)+')
+_MAX_TF = 65535
+
+
+def fold(text):
+    """Lowercase without diacritics: "Hợp Đồng" -> "hop dong" """
+    return _COMBINING.sub('', unicodedata.normalize('NFD', text.translate(_FOLD))).lower()
+
+
+def tokenize(text):
+    text = fold(text)
+    return _WORD.findall(text) + _IDENTIFIER.findall(text)
+
+
+def _pack(fmt, values):
+    return struct.pack(f'<{len(values)}{fmt}', *values)
+
+
+def encode(texts):
+    """``(info, {section: bytes})`` of the index over ``texts``"""
+    postings = {}
+    lengths = []
+    for doc, text in enumerate(texts):
+        tokens = tokenize(text)
+        lengths.append(len(tokens))
+        for term, tf in Counter(tokens).items():
+            postings.setdefault(term, []).append((doc, min(tf, _MAX_TF)))
+
+    terms = sorted(postings)
+    offsets, docs, tfs = [0], [], []
+    for term in terms:
+        for doc, tf in postings[term]:
+            docs.append(doc)
+            tfs.append(tf)
+        offsets.append(len(docs))
+
+    info = {
+        'tokenizer': TOKENIZER_VERSION,
+        'count': len(texts),
+        'avgdl': sum(lengths) / len(lengths) if lengths else 0.0,
+    }
+    return info, {
+        'lex_terms': '\n'.join(terms).encode('utf-8'),
+        'lex_postings': _pack('Q', offsets),
+        'lex_docs': _pack('I', docs),
+        'lex_tfs': _pack('H', tfs),
+        'lex_lengths': _pack('I', lengths),
+    }
+
+
+class LexicalIndex:
+    """BM25 scoring over the sections written by ``encode``"""
+
+    def __init__(self, info, sections):
+        self.count = info['count']
+        self.avgdl = info['avgdl'] or 1.0
+        self._sections = sections
+        terms = bytes(sections['lex_terms']).decode('utf-8')
+        self._terms = {term: n for n, term in enumerate(terms.split('\n'))} if terms else {}
+        self._lengths = None
+
+    @classmethod
+    def build(cls, texts):
+        info, sections = encode(texts)
+        return cls(info, sections)
+
+    def __len__(self):
+        return self.count
+
+    def _postings(self, n):
+        start, end = struct.unpack_from('<2Q', self._sections['lex_postings'], 8 * n)
+        docs = struct.unpack_from(f'<{end - start}I', self._sections['lex_docs'], 4 * start)
+        tfs = struct.unpack_from(f'<{end - start}H', self._sections['lex_tfs'], 2 * start)
+        return docs, tfs
+
+    def _length(self, doc):
+        if self._lengths is None:
+            self._lengths = struct.unpack_from(f'<{self.count}I', self._sections['lex_lengths'])
+        return self._lengths[doc]
+
+    def scores(self, query):
+        """{chunk: BM25 score} for the chunks containing any query term"""
+        scores = {}
+        for term in set(tokenize(query)):
+            n = self._terms.get(term)
+            if n is None:
+                continue
+            docs, tfs = self._postings(n)
+            idf = math.log(1 + (self.count - len(docs) + 0.5) / (len(docs) + 0.5))
+            for doc, tf in zip(docs, tfs):
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self._length(doc) / self.avgdl)
+                scores[doc] = scores.get(doc, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return scores
+
+    def search(self, query, k=3):
+        """Top ``k`` (chunk, score) pairs, best first, ties by position; [] if no term matches"""
+        return heapq.nsmallest(k, ((doc, score) for doc, score in self.scores(query).items()),
+                               key=lambda item: (-item[1], item[0]))
@@ -0,0 +1,92 @@
+"""Extracted page text of PDFs, kept in S3 by content hash.
+
+Changing chunking, the embedding model or the index format changes the
+document fingerprint, so an upload of an already indexed PDF is indexed
+again. Parsing with pypdf is the slow, CPU-bound part of that and does not
+depend on any of those settings. The first extraction of a PDF therefore
+records its pages under ``extracted/<sha256>/<EXTRACTOR_VERSION>.pages.gz``.
+The object is gzip-compressed JSON lines, one page per line, with the page
+count in its metadata. Later indexings of the same content stream pages
+from it instead of the PDF. When the checksum is verified on upload, they
+do not read the PDF at all.
+
+Bump ``EXTRACTOR_VERSION`` whenever the text extracted for a page changes;
+old artifacts are then ignored and expire with the bucket lifecycle rule.
+"""
+import gzip
+import io
+import json
+import logging
+
+import pypdf
+
+logger = logging.getLogger(__name__)
+
+EXTRACTOR_VERSION = f"pypdf-{pypdf.__version__}-1"
+CONTENT_TYPE = 'application/gzip'
+
+
+def page_cache_key(content_sha256, version=EXTRACTOR_VERSION):
+    return f"extracted/{content_sha256}/{version}.pages.gz"
+
+
+class PageRecorder:
+    """Compresses pages as they stream past; see ``PageCache.put``"""
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+        self.pages = 0
+        self.complete = False
+        self._gzip = gzip.GzipFile(fileobj=self.buffer, mode='wb', mtime=0)
+
+    def record(self, pages):
+        for page in pages:
+            self._gzip.write(json.dumps(page, ensure_ascii=False).encode('utf-8') + b'\n')
+            self.pages += 1
+            yield page
+        self._gzip.close()
+        self.complete = True
+
+
+class PageCache:
+    def __init__(self, s3, bucket):
+        self.s3 = s3
+        self.bucket = bucket
+
+    def get(self, content_sha256, progress=None):
+        """Generator over the cached pages of a document, or None if not cached"""
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=page_cache_key(content_sha256))
+        except self.s3.exceptions.NoSuchKey:
+            return None
+        except Exception as e:
+            logger.warning(f"Page cache lookup failed for {content_sha256}: {e}")
+            return None
+        total = int(response.get('Metadata', {}).get('pages', 0))
+        logger.info(f"📑 Using {total} cached pages of {content_sha256}")
+        return self._pages(response['Body'], total, progress)
+
+    @staticmethod
+    def _pages(body, total, progress):
+        with gzip.open(body, 'rt', encoding='utf-8') as lines:
+            for number, line in enumerate(lines, 1):
+                yield json.loads(line)
+                if progress:
+                    progress(number, total)
+
+    def put(self, content_sha256, recorder):
+        """Store what ``recorder`` saw, if it saw the whole document; never raises"""
+        if not recorder.complete:
+            return False
+        try:
+            self.s3.put_object(
+                Bucket=self.bucket,
+                Key=page_cache_key(content_sha256),
+                Body=recorder.buffer.getvalue(),
+                ContentType=CONTENT_TYPE,
+                Metadata={'pages': str(recorder.pages)}
+            )
+        except Exception as e:
+            logger.warning(f"Failed to cache extracted pages of {content_sha256}: {e}")
+            return False
+        return True
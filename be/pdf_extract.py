@@ -0,0 +1,125 @@
+"""PDF page text extraction, optionally spread over worker processes.
+
+pypdf's text extraction is pure Python and CPU bound, so one thread parses
+a long text-heavy PDF at the speed of one core while the Lambda (3008 MB =
+2 vCPUs) has more. ``iter_pdf_pages`` splits the page range into blocks of
+``block_pages`` pages dealt round-robin to ``processes`` workers, each of
+which opens its own ``PdfReader``. Blocks are read back in order, so pages
+come out in page order and a worker is never more than about one block
+ahead of the consumer: memory stays bounded like the serial generator.
+
+Lambda has no /dev/shm, so ``multiprocessing.Pool`` and ``Queue`` (which
+need POSIX semaphores) do not work there; workers are plain ``Process``es,
+each with its own ``Pipe``. They are started with ``spawn`` because the
+parent usually has embedding threads running, and forking a threaded
+process can deadlock the child.
+
+Small documents are extracted serially: starting interpreters costs more
+than it saves below ``min_pages`` pages.
+
+``source`` is a file path or the PDF's bytes (uploads read from S3 into
+memory); workers get a copy of the bytes.
+"""
+import io
+import logging
+import multiprocessing
+import os
+
+import pypdf
+
+logger = logging.getLogger(__name__)
+
+# Worker processes for large PDFs (one per vCPU by default; 1 = always serial)
+PDF_EXTRACT_PROCESSES = int(os.environ.get('PDF_EXTRACT_PROCESSES', os.cpu_count() or 1))
+# Below this many pages the serial path is faster
+PDF_PARALLEL_MIN_PAGES = int(os.environ.get('PDF_PARALLEL_MIN_PAGES', 64))
+PDF_BLOCK_PAGES = 8
+
+
+def _page_text(page):
+    return page.extract_text() + "\n"
+
+
+def _open(source):
+    if isinstance(source, (bytes, bytearray)):
+        return io.BytesIO(source)
+    return open(source, 'rb')
+
+
+def iter_pdf_pages(source, progress=None, processes=None, min_pages=None, block_pages=PDF_BLOCK_PAGES):
+    """Text of each page in order; ``progress(pages_done, pages_total)`` after each"""
+    processes = PDF_EXTRACT_PROCESSES if processes is None else processes
+    min_pages = PDF_PARALLEL_MIN_PAGES if min_pages is None else min_pages
+    with _open(source) as file:
+        pdf_reader = pypdf.PdfReader(file)
+        total = len(pdf_reader.pages)
+        workers = min(processes, -(-total // block_pages))
+        if workers <= 1 or total < min_pages:
+            for number, page in enumerate(pdf_reader.pages, 1):
+                yield _page_text(page)
+                if progress:
+                    progress(number, total)
+            return
+
+    logger.info(f"Extracting {total} pages with {workers} processes")
+    number = 0
+    for text in _iter_parallel(source, total, workers, block_pages):
+        number += 1
+        yield text
+        if progress:
+            progress(number, total)
+
+
+def _extract_blocks(source, worker, workers, block_pages, total, conn):
+    """Worker process: send the blocks ``worker``, ``worker + workers``, ... in order"""
+    try:
+        with _open(source) as file:
+            pages = pypdf.PdfReader(file).pages
+            for start in range(worker * block_pages, total, workers * block_pages):
+                conn.send(('pages', [_page_text(pages[n]) for n in range(start, min(start + block_pages, total))]))
+        conn.send(('done', None))
+    except BrokenPipeError:
+        pass  # the consumer stopped early
+    except Exception as e:
+        conn.send(('error', f"{type(e).__name__}: {e}"))
+    finally:
+        conn.close()
+
+
+def _receive(receiver):
+    try:
+        return receiver.recv()
+    except EOFError:
+        return 'error', 'worker exited unexpectedly'
+
+
+def _iter_parallel(source, total, workers, block_pages):
+    context = multiprocessing.get_context('spawn')
+    pipes, children = [], []
+    try:
+        for worker in range(workers):
+            receiver, sender = context.Pipe(duplex=False)
+            child = context.Process(target=_extract_blocks, daemon=True,
+                                    args=(source, worker, workers, block_pages, total, sender))
+            child.start()
+            sender.close()
+            pipes.append(receiver)
+            children.append(child)
+
+        blocks = -(-total // block_pages)
+        for block in range(blocks + workers):
+            # each worker ends with 'done'
+            kind, payload = _receive(pipes[block % workers])
+            if kind != ('pages' if block < blocks else 'done'):
+                raise RuntimeError(f"PDF extraction failed: {payload}")
+            if payload:
+                yield from payload
+    finally:
+        # also reached when the consumer stops early (cancel, error)
+        for receiver in pipes:
+            receiver.close()
+        for child in children:
+            child.join(timeout=1)
+            if child.is_alive():
+                child.terminate()
+                child.join()
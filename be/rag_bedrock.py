@@ -1,18 +1,145 @@
 import boto3
+import codecs
 import json
+import os
 import uuid
-import math
-import pypdf
-import re
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+import chunker
+import dedup
+import lexical_index
+import pdf_extract
+import search_engine
+from rate_control import AIMDController, BedrockBusyError, RetryPolicy, call_with_retries
+from embedding_cache import EmbeddingCache, DynamoDBEmbeddingStore, normalize_text
+
+EMBEDDING_MODEL_ID = 'amazon.titan-embed-text-v1'
+
+# Số request embedding chạy song song khi index tài liệu: bắt đầu từ
+# EMBED_CONCURRENCY, AIMD điều chỉnh trong khoảng [1, EMBED_MAX_CONCURRENCY]
+EMBED_CONCURRENCY = int(os.environ.get('EMBED_CONCURRENCY', 8))
+EMBED_MAX_CONCURRENCY = int(os.environ.get('EMBED_MAX_CONCURRENCY', 32))
+GENERATION_MAX_CONCURRENCY = 4
+# Số batch embedding chạy nền trong lúc vẫn đang trích xuất các trang sau
+EMBED_PIPELINE_DEPTH = 2
+
+# Đọc file text theo khối (bytes) thay vì cả file một lần
+TEXT_BLOCK_BYTES = 64 * 1024
+
+# Kích thước chunk và phần chồng lấn giữa hai chunk liền nhau, tính theo token ước lượng
+CHUNK_TOKENS = int(os.environ.get('CHUNK_TOKENS', 200))
+CHUNK_OVERLAP_TOKENS = int(os.environ.get('CHUNK_OVERLAP_TOKENS', 30))
+
+# Bảng DynamoDB lưu cache embedding dùng chung giữa các session (bỏ trống = chỉ cache trong RAM)
+EMBEDDING_CACHE_TABLE = os.environ.get('EMBEDDING_CACHE_TABLE')
+EMBEDDING_CACHE_MEMORY_ENTRIES = int(os.environ.get('EMBEDDING_CACHE_MEMORY_ENTRIES', 5000))
+
+def iter_text_blocks(source, block_bytes=None):
+    """Giải mã UTF-8 theo từng khối ``block_bytes`` byte
+
+    ``source`` là bytes hoặc stream nhị phân (file, body của S3). Ký tự
+    nhiều byte bị cắt ở ranh giới khối được decoder giữ lại và ghép với
+    khối sau, nên bộ nhớ chỉ tốn một khối dù file lớn đến đâu.
+    """
+    block_bytes = block_bytes or TEXT_BLOCK_BYTES
+    if isinstance(source, (bytes, bytearray)):
+        view = memoryview(source)
+        blocks = (view[start:start + block_bytes] for start in range(0, len(view), block_bytes))
+    else:
+        blocks = iter(lambda: source.read(block_bytes), b'')
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for block in blocks:
+        text = decoder.decode(block)
+        if text:
+            yield text
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+def _document_name(source, filename):
+    """Tên dùng để đoán loại file: ``filename``, hoặc chính ``source`` khi là đường dẫn"""
+    if filename:
+        return filename
+    if isinstance(source, str):
+        return source
+    raise ValueError('filename is required when the document is given as bytes or a stream')
+
+def _is_pdf_name(name):
+    return name.lower().endswith('.pdf')
+
+def default_embedding_cache():
+    durable = None
+    if EMBEDDING_CACHE_TABLE:
+        durable = DynamoDBEmbeddingStore(boto3.resource('dynamodb', region_name='us-east-1'), EMBEDDING_CACHE_TABLE)
+    return EmbeddingCache(durable, max_memory_entries=EMBEDDING_CACHE_MEMORY_ENTRIES)
 
 class BedrockRAG:
-    def __init__(self):
-        self.bedrock_runtime = boto3.client('bedrock-runtime', region_name='us-east-1')
-        self.chunk_size = 800
-        self.chunk_overlap = 100
+    def __init__(self, bedrock_runtime=None, embed_concurrency=EMBED_CONCURRENCY,
+                 embed_max_concurrency=EMBED_MAX_CONCURRENCY, retry_policy=None, embedding_cache=None):
+        # boto3 clients are thread-safe; size the connection pool so every
+        # embedding worker gets its own connection. botocore's own retries are
+        # off so throttles reach the rate controller instead of being hidden.
+        self.bedrock_runtime = bedrock_runtime or boto3.client(
+            'bedrock-runtime',
+            region_name='us-east-1',
+            config=Config(
+                max_pool_connections=max(10, embed_max_concurrency + GENERATION_MAX_CONCURRENCY),
+                retries={'total_max_attempts': 1}
+            )
+        )
+        self.embed_concurrency = embed_concurrency
+        self.embed_max_concurrency = max(embed_max_concurrency, 1)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.embedding_cache = embedding_cache or default_embedding_cache()
+        self._controllers = {}
+        self._controllers_lock = threading.Lock()
+        self.chunk_size = CHUNK_TOKENS
+        self.chunk_overlap = CHUNK_OVERLAP_TOKENS
+
+    def chunking_settings(self):
+        """Everything that changes the chunks produced for a given document"""
+        return {
+            'splitter': chunker.SPLITTER,
+            'dedup': dedup.DEDUP_VERSION,
+            'chunk_size': self.chunk_size,
+            'chunk_overlap': self.chunk_overlap,
+        }
+    
+    def controller(self, model_id):
+        """AIMD controller cho từng model (quota Bedrock tính theo model)"""
+        with self._controllers_lock:
+            if model_id not in self._controllers:
+                if model_id == EMBEDDING_MODEL_ID:
+                    initial, maximum = self.embed_concurrency, self.embed_max_concurrency
+                else:
+                    initial, maximum = 2, GENERATION_MAX_CONCURRENCY
+                self._controllers[model_id] = AIMDController(initial=initial, maximum=maximum)
+            return self._controllers[model_id]
+    
+    def _invoke_model(self, model_id, body):
+        """invoke_model có retry + backoff cho throttling, trả về body đã parse"""
+        def call():
+            response = self.bedrock_runtime.invoke_model(modelId=model_id, body=body)
+            return json.loads(response['body'].read())
+        return call_with_retries(call, self.controller(model_id), self.retry_policy)
     
     def get_titan_embedding(self, text):
-        """Lấy embedding từ Amazon Titan (FREE)"""
+        """Lấy embedding từ Amazon Titan (FREE) cho câu hỏi
+
+        Cố ý không qua embedding cache (khác với các đường embedding lúc
+        ingestion): câu hỏi hiếm khi lặp lại, nên cache chỉ thêm một lượt
+        batch_get/batch_write DynamoDB cho mỗi /ask và lấp bảng cache bền
+        bằng các câu hỏi dùng một lần. Cache chỉ dành cho các đoạn văn
+        (embed_texts / embed_batches).
+        Trả về None nếu input không hợp lệ; raise BedrockBusyError nếu vẫn bị
+        throttle sau khi đã retry.
+        """
+        return self._embed_uncached(text)
+    
+    def _embed_uncached(self, text):
+        """Gọi Titan embedding trực tiếp (không qua cache)"""
         try:
             # Clean text để tránh lỗi
             clean_text = text.replace('\x00', '').strip()
@@ -23,18 +150,83 @@ class BedrockRAG:
                 "inputText": clean_text
             })
             
-            response = self.bedrock_runtime.invoke_model(
-                modelId='amazon.titan-embed-text-v1',
-                body=body
-            )
-            
-            response_body = json.loads(response['body'].read())
+            response_body = self._invoke_model(EMBEDDING_MODEL_ID, body)
             return response_body['embedding']
             
+        except BedrockBusyError:
+            raise
         except Exception as e:
             print(f"Embedding error: {e}")
             return None
     
+    def embed_texts(self, texts, max_workers=None):
+        """Embed nhiều đoạn, giữ nguyên thứ tự (None nếu lỗi)
+
+        Đoạn đã có trong cache (kể cả từ session khác) không tốn request
+        Bedrock; mỗi nội dung còn thiếu chỉ được embed một lần.
+        """
+        results = self.embedding_cache.get_many(EMBEDDING_MODEL_ID, texts)
+        
+        pending = {}
+        for i, (text, embedding) in enumerate(zip(texts, results)):
+            if embedding is None and text.replace('\x00', '').strip():
+                pending.setdefault(normalize_text(text), []).append(i)
+        if not pending:
+            return results
+        
+        unique_texts = [texts[positions[0]] for positions in pending.values()]
+        embedded = self._embed_many_uncached(unique_texts, max_workers)
+        for positions, embedding in zip(pending.values(), embedded):
+            for i in positions:
+                results[i] = embedding
+        
+        self.embedding_cache.put_many(EMBEDDING_MODEL_ID, unique_texts, embedded)
+        return results
+    
+    def _embed_many_uncached(self, texts, max_workers=None):
+        """Embed song song; số request thực sự đang chạy do AIMD controller
+        quyết định, pool chỉ là giới hạn trên"""
+        workers = max_workers or self.embed_max_concurrency
+        if workers <= 1 or len(texts) <= 1:
+            return [self._embed_uncached(text) for text in texts]
+        
+        with ThreadPoolExecutor(max_workers=min(workers, len(texts))) as pool:
+            futures = [pool.submit(self._embed_uncached, text) for text in texts]
+            try:
+                return [future.result() for future in futures]
+            except BedrockBusyError:
+                # dừng các chunk còn lại thay vì tiếp tục dội request vào Bedrock
+                for future in futures:
+                    future.cancel()
+                raise
+    
+    def embed_batches(self, batches, max_pending=EMBED_PIPELINE_DEPTH, skip=None):
+        """Embed các batch text trong khi batch sau vẫn đang được tạo ra
+
+        ``batches`` thường là generator (trích xuất + chia chunk): tối đa
+        ``max_pending`` batch được embed ở background trong lúc thread gọi
+        tiếp tục đọc trang kế tiếp. Trả về ``(texts, embeddings)`` đúng thứ
+        tự; batch có ``skip(số thứ tự)`` đúng thì embeddings là None.
+        """
+        pending = deque()
+        pool = ThreadPoolExecutor(max_workers=max_pending + 1)
+        try:
+            for number, texts in enumerate(batches):
+                embed = not (skip and skip(number))
+                pending.append((texts, pool.submit(self.embed_texts, texts) if embed else None))
+                while len(pending) > max_pending or (pending and pending[0][1] is None):
+                    texts, future = pending.popleft()
+                    yield texts, future.result() if future else None
+            while pending:
+                texts, future = pending.popleft()
+                yield texts, future.result() if future else None
+        finally:
+            # consumer dừng giữa chừng (cancel, lỗi): bỏ các batch chưa chạy
+            for _, future in pending:
+                if future:
+                    future.cancel()
+            pool.shutdown(wait=True)
+    
     def invoke_claude(self, prompt, max_tokens=1000):
         """Gọi Claude cho generation"""
         try:
@@ -45,14 +237,11 @@ class BedrockRAG:
                 "top_p": 0.9,
             })
             
-            response = self.bedrock_runtime.invoke_model(
-                modelId='anthropic.claude-instant-v1',
-                body=body
-            )
-            
-            response_body = json.loads(response['body'].read())
+            response_body = self._invoke_model('anthropic.claude-instant-v1', body)
             return response_body['completion']
             
+        except BedrockBusyError:
+            raise
         except Exception as e:
             print(f"Claude error: {e}")
             return None
@@ -69,83 +258,83 @@ class BedrockRAG:
                 }
             })
             
-            response = self.bedrock_runtime.invoke_model(
-                modelId='amazon.titan-text-lite-v1',
-                body=body
-            )
-            
-            response_body = json.loads(response['body'].read())
+            response_body = self._invoke_model('amazon.titan-text-lite-v1', body)
             return response_body['results'][0]['outputText']
             
+        except BedrockBusyError:
+            raise
         except Exception as e:
             print(f"Titan error: {e}")
             return None
     
-    def load_and_split_document(self, file_path):
-        """Load và chia nhỏ document"""
+    def load_and_split_document(self, file_path, progress=None):
+        """Load và chia nhỏ document
+
+        ``progress(pages_done, pages_total)`` được gọi sau mỗi trang PDF.
+        """
         print(f"📖 Loading document: {file_path}")
         
         try:
-            if file_path.lower().endswith('.pdf'):
-                text = self._extract_pdf_text(file_path)
-            else:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    text = f.read()
-            
-            chunks = self._split_text(text)
+            chunks = list(self.iter_document_chunks(file_path, progress))
             print(f"📄 Split into {len(chunks)} chunks")
             return chunks
         except Exception as e:
             print(f"❌ Document loading error: {e}")
             return []
     
-    def _extract_pdf_text(self, file_path):
+    def iter_document_chunks(self, source, progress=None, filename=None):
+        """Generator: trích xuất từng trang và trả chunk ngay khi chunk đã đủ
+
+        ``source`` là đường dẫn file, nội dung (bytes) của file, hoặc (với
+        file text) một stream nhị phân như body của S3; loại file lấy theo
+        ``filename`` (mặc định là chính đường dẫn, bắt buộc với bytes và
+        stream: raise ValueError nếu thiếu). Chỉ giữ
+        trang đang đọc, câu đang dở và chunk đang gom, không bao giờ tạo
+        thêm bản sao của cả tài liệu. Lỗi đọc file được raise ra ngoài.
+        """
+        pdf = _is_pdf_name(_document_name(source, filename))
+        return self.iter_chunks(self.iter_pages(source, progress, filename), paged=pdf)
+    
+    def iter_pages(self, source, progress=None, filename=None):
+        """Text của tài liệu theo từng trang PDF (hoặc từng khối với file text)"""
+        if _is_pdf_name(_document_name(source, filename)):
+            yield from self._iter_pdf_pages(source, progress)
+        elif isinstance(source, str):
+            with open(source, 'rb') as f:
+                yield from iter_text_blocks(f)
+        else:
+            yield from iter_text_blocks(source)
+    
+    def _iter_pdf_pages(self, source, progress=None):
+        """Text của từng trang PDF (PDF lớn được đọc song song nhiều process)"""
+        return pdf_extract.iter_pdf_pages(source, progress)
+    
+    def _extract_pdf_text(self, file_path, progress=None):
         """Extract text from PDF"""
-        text = ""
-        with open(file_path, 'rb') as file:
-            pdf_reader = pypdf.PdfReader(file)
-            for page in pdf_reader.pages:
-                text += page.extract_text() + "\n"
-        return text
+        return "".join(self._iter_pdf_pages(file_path, progress))
+    
+    def iter_chunks(self, pieces, paged=False):
+        """Gom câu thành chunk tối đa ``chunk_size`` token, chồng lấn ``chunk_overlap`` token
+
+        Mỗi chunk có thêm vị trí ký tự (``start``/``end``) và, nếu ``paged``
+        (mỗi phần tử của ``pieces`` là một trang), số trang (``pages``).
+        Header/footer lặp lại giữa các trang và chunk trùng (hoặc gần trùng)
+        bị loại trước khi embedding; ``positions`` của chunk được giữ lại
+        ghi vị trí của các bản bị loại.
+        """
+        if paged:
+            pieces = dedup.strip_boilerplate(pieces)
+        chunks = chunker.iter_chunks(pieces, self.chunk_size, self.chunk_overlap, paged)
+        return dedup.dedup_chunks(chunks)
     
     def _split_text(self, text):
         """Split text into chunks"""
-        # Simple text splitting
-        sentences = re.split(r'[.!?]+', text)
-        chunks = []
-        current_chunk = ""
-        
-        for sentence in sentences:
-            sentence = sentence.strip()
-            if not sentence:
-                continue
-                
-            if len(current_chunk) + len(sentence) < self.chunk_size:
-                current_chunk += sentence + ". "
-            else:
-                if current_chunk:
-                    chunks.append({"page_content": current_chunk.strip()})
-                current_chunk = sentence + ". "
-        
-        if current_chunk:
-            chunks.append({"page_content": current_chunk.strip()})
-            
-        return chunks
+        return list(self.iter_chunks([text]))
     
     def cosine_similarity(self, a, b):
         """Tính cosine similarity giữa 2 vectors"""
-        if not a or not b or len(a) != len(b):
-            return -1
-        
         try:
-            dot = sum(x * y for x, y in zip(a, b))
-            norm_a = math.sqrt(sum(x * x for x in a))
-            norm_b = math.sqrt(sum(x * x for x in b))
-            
-            if norm_a == 0 or norm_b == 0:
-                return -1
-                
-            return dot / (norm_a * norm_b)
+            return search_engine.cosine(a, b)
         except Exception as e:
             print(f"Cosine similarity error: {e}")
             return -1
@@ -155,13 +344,10 @@ class BedrockRAG:
         print("🔄 Creating vector store với Titan embeddings...")
         
         texts = [chunk["page_content"] for chunk in chunks]
-        embeddings = []
+        print(f"📊 Embedding {len(texts)} chunks ({self.embed_concurrency} workers)")
         
-        for i, text in enumerate(texts):
-            if i % 5 == 0:  # Log progress every 5 chunks
-                print(f"📊 Processing chunk {i+1}/{len(texts)}")
-            
-            embedding = self.get_titan_embedding(text)
+        embeddings = []
+        for embedding in self.embed_texts(texts):
             if embedding:
                 embeddings.append(embedding)
             else:
@@ -171,7 +357,10 @@ class BedrockRAG:
         return {
             'chunks': chunks,
             'texts': texts,
-            'embeddings': embeddings
+            'embeddings': embeddings,
+            # Chuẩn hoá một lần để mỗi câu hỏi chỉ cần một phép nhân ma trận
+            'vectors': search_engine.VectorSet(embeddings),
+            'lexical': lexical_index.LexicalIndex.build(texts)
         }
     
     def similarity_search(self, vector_store, query, k=3):
@@ -182,18 +371,15 @@ class BedrockRAG:
             print("❌ Failed to get query embedding, using fallback search")
             return self.fallback_search(vector_store, query, k)
         
-        # Tính similarity với tất cả chunks
-        similarities = []
-        for i, emb in enumerate(vector_store['embeddings']):
-            sim = self.cosine_similarity(query_embedding, emb)
-            similarities.append((i, sim))
-        
-        # Sắp xếp theo similarity giảm dần
-        similarities.sort(key=lambda x: x[1], reverse=True)
+        # Tính similarity với tất cả chunks (một phép nhân ma trận + chọn top k)
+        vectors = vector_store.get('vectors')
+        if vectors is None:
+            vectors = search_engine.VectorSet(vector_store['embeddings'])
+        similarities = search_engine.search(vectors, query_embedding, k)
         
         # Lấy top k chunks
         relevant_chunks = []
-        for idx, score in similarities[:k]:
+        for idx, score in similarities:
             if idx < len(vector_store['chunks']) and score > 0:  # Chỉ lấy chunks có similarity > 0
                 relevant_chunks.append(vector_store['chunks'][idx])
         
@@ -201,23 +387,14 @@ class BedrockRAG:
         return relevant_chunks
     
     def fallback_search(self, vector_store, query, k=3):
-        """Fallback search khi không có embeddings"""
+        """Fallback search khi không có embeddings (BM25 trên từ khoá của câu hỏi)"""
         print("🔄 Using fallback keyword search")
-        query_lower = query.lower()
-        
-        scores = []
-        for i, text in enumerate(vector_store['texts']):
-            score = text.lower().count(query_lower)
-            scores.append((i, score))
-        
-        scores.sort(key=lambda x: x[1], reverse=True)
+        lexical = vector_store.get('lexical')
+        if lexical is None:
+            lexical = vector_store['lexical'] = lexical_index.LexicalIndex.build(vector_store['texts'])
         
-        relevant_chunks = []
-        for idx, score in scores[:k]:
-            if score > 0:  # Chỉ lấy chunks có keyword match
-                relevant_chunks.append(vector_store['chunks'][idx])
-        
-        return relevant_chunks
+        # Chỉ có các chunk chứa ít nhất một từ khoá mới có điểm
+        return [vector_store['chunks'][idx] for idx, _ in lexical.search(query, k)]
     
     def answer_question(self, vector_store, question):
         """Trả lời câu hỏi dựa trên RAG"""
@@ -0,0 +1,150 @@
+"""Adaptive rate control for Bedrock calls.
+
+Bedrock quotas are per model, and a burst above them comes back as
+ThrottlingException. Treating that like a bad input (return None) turns a
+busy minute into empty embeddings or a needless model fallback. Instead:
+
+* errors are classified as ``throttle`` / ``transient`` / ``fatal``;
+* throttles and transient errors are retried with full-jitter exponential
+  backoff, fatal errors are raised immediately;
+* an AIMD controller gates how many calls are in flight: every success
+  grows the limit additively (about +1 per window of ``limit`` successes),
+  every throttle halves it (at most once per ``cooldown`` seconds, so one
+  burst of rejections counts as a single congestion event).
+
+Bulk ingestion therefore settles just under the account's TPS limit rather
+than oscillating into cascading failures.
+"""
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError, ReadTimeoutError
+
+THROTTLE_CODES = {
+    'ThrottlingException',
+    'TooManyRequestsException',
+    'ServiceQuotaExceededException',
+    'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded',
+    'SlowDown',
+}
+TRANSIENT_CODES = {
+    'InternalServerException',
+    'ServiceUnavailableException',
+    'ModelNotReadyException',
+    'ModelTimeoutException',
+    'RequestTimeout',
+}
+
+
+class BedrockBusyError(Exception):
+    """Raised when a call is still throttled/failing after all retries"""
+
+    def __init__(self, message, kind='throttle'):
+        super().__init__(message)
+        self.kind = kind
+
+
+def classify_error(error):
+    """Return 'throttle', 'transient' or 'fatal' for an exception"""
+    if isinstance(error, ClientError):
+        code = error.response.get('Error', {}).get('Code', '')
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        if code in THROTTLE_CODES or status == 429:
+            return 'throttle'
+        if code in TRANSIENT_CODES or (status is not None and status >= 500):
+            return 'transient'
+        return 'fatal'
+    if isinstance(error, (BotoConnectionError, ReadTimeoutError)):
+        return 'transient'
+    return 'fatal'
+
+
+class AIMDController:
+    """Additive-increase / multiplicative-decrease limit on in-flight calls"""
+
+    def __init__(self, initial=4, minimum=1, maximum=32, increase=1.0, decrease=0.5,
+                 cooldown=1.0, clock=time.monotonic):
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.clock = clock
+        self.in_flight = 0
+        self.successes = self.throttles = 0
+        self._last_decrease = None
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def on_success(self):
+        with self._cond:
+            self.successes += 1
+            self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+            self._cond.notify_all()
+
+    def on_throttle(self):
+        with self._cond:
+            self.throttles += 1
+            now = self.clock()
+            if self._last_decrease is None or now - self._last_decrease >= self.cooldown:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self._last_decrease = now
+
+
+class RetryPolicy:
+    """Full-jitter exponential backoff settings"""
+
+    def __init__(self, max_attempts=6, base_delay=0.25, max_delay=8.0, sleep=time.sleep, rng=random.random):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self.rng = rng
+
+    def backoff(self, attempt):
+        return self.rng() * min(self.max_delay, self.base_delay * (2 ** attempt))
+
+
+def call_with_retries(fn, controller, policy):
+    """Run ``fn`` under ``controller``, retrying throttles/transient errors"""
+    for attempt in range(policy.max_attempts):
+        with controller.slot():
+            try:
+                result = fn()
+            except Exception as e:
+                kind = classify_error(e)
+                if kind == 'fatal':
+                    raise
+                if kind == 'throttle':
+                    controller.on_throttle()
+                if attempt == policy.max_attempts - 1:
+                    raise BedrockBusyError(
+                        f"Bedrock still {'throttling' if kind == 'throttle' else 'failing'} "
+                        f"after {policy.max_attempts} attempts: {e}", kind) from e
+            else:
+                controller.on_success()
+                return result
+        # back off outside the slot so other calls can use it meanwhile
+        policy.sleep(policy.backoff(attempt))
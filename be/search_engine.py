@@ -0,0 +1,246 @@
+"""Shared vector search used by handler.ask and BedrockRAG.
+
+Embeddings are L2-normalised once, when the index is built, and their
+norms are kept alongside. A query is then scored with a single
+matrix-vector product and the best ``k`` rows are picked with a linear
+selection (numpy.argpartition / heapq) rather than a full sort. Rankings,
+including tie order and the -1 score for missing embeddings, match the
+original per-chunk cosine loop.
+
+Anything exposing ``exact_scores(q_unit, rows=None)`` can be searched:
+VectorIndex (the on-disk format) and VectorSet (an in-memory list of
+embeddings). Quantized sources also expose ``coarse_scores(q_unit, rows)``
+and large indexes ``ann_candidates(q_unit, nprobe)`` (see ann_index).
+
+``hybrid_search`` runs a vector and a keyword search side by side and
+merges their rankings with reciprocal rank fusion (``fuse``): only ranks
+are combined, so cosine and BM25 scores never need to be on one scale.
+"""
+import heapq
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy is in requirements.txt
+    np = None
+
+RESCORE_FACTOR = 10
+# Reciprocal rank fusion: a row at rank r (from 1) of a ranking adds weight / (RRF_K + r)
+RRF_K = 60
+# Rows taken from each ranking before fusing
+HYBRID_CANDIDATES = 20
+# Rows of a float16 matrix widened to float32 at a time when scoring
+SCORE_BLOCK_ROWS = 1024
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def unit_vector(vector, dim=None):
+    """L2-normalise ``vector``; None when it is empty, zero or the wrong size"""
+    if not vector or (dim is not None and len(vector) != dim):
+        return None
+    norm = math.sqrt(sum(x * x for x in vector))
+    if norm == 0:
+        return None
+    return [x / norm for x in vector]
+
+
+def cosine(a, b):
+    """Cosine similarity of two vectors, -1 when either is empty or zero"""
+    if not a or not b or len(a) != len(b):
+        return -1
+    unit_a, unit_b = unit_vector(a), unit_vector(b)
+    if unit_a is None or unit_b is None:
+        return -1
+    return sum(x * y for x, y in zip(unit_a, unit_b))
+
+
+def dot_scores(rows, norms, q_unit, normalized=True, subset=None):
+    """Score ``rows`` (ndarray or row sequence) against a unit query.
+
+    ``normalized`` rows give cosine directly; raw rows are divided by their
+    stored norm. Rows whose norm is 0 score -1.
+
+    Rows that are not float32 (float16 indexes) are widened to float32
+    ``SCORE_BLOCK_ROWS`` at a time, as BLAS has no float16 product. That
+    bounds the extra memory to one block, but every row is still converted
+    on every query: float16 halves the index at the price of a full scan
+    about as slow as the conversion (see bench_quantization).
+    """
+    if np is not None and isinstance(rows, np.ndarray):
+        norms = np.asarray(norms)
+        if subset is not None:
+            idx = np.asarray(subset, dtype=np.int64)
+            rows, norms = rows[idx], norms[idx]
+        dots = _matvec(rows, np.asarray(q_unit, dtype=np.float32))
+        if not normalized:
+            dots = dots / np.where(norms > 0, norms, 1.0)
+        return np.where(norms > 0, dots, -1.0)
+
+    scores = []
+    for i in (range(len(rows)) if subset is None else subset):
+        if not norms[i]:
+            scores.append(-1)
+            continue
+        dot = sum(x * y for x, y in zip(rows[i], q_unit))
+        scores.append(dot if normalized else dot / norms[i])
+    return scores
+
+
+def _matvec(rows, q):
+    if rows.dtype == np.float32 or len(rows) <= SCORE_BLOCK_ROWS:
+        return rows.astype(np.float32, copy=False) @ q
+    dots = np.empty(len(rows), dtype=np.float32)
+    block = np.empty((SCORE_BLOCK_ROWS, rows.shape[1]), dtype=np.float32)
+    for start in range(0, len(rows), SCORE_BLOCK_ROWS):
+        part = rows[start:start + SCORE_BLOCK_ROWS]
+        widened = block[:len(part)]
+        widened[...] = part
+        np.matmul(widened, q, out=dots[start:start + len(part)])
+    return dots
+
+
+def top_k(scores, k):
+    """Best ``k`` (position, score) pairs, highest first, ties by position.
+
+    Equivalent to ``sorted(enumerate(scores), key=score, reverse=True)[:k]``
+    but linear in ``len(scores)``.
+    """
+    n = len(scores)
+    if k <= 0 or n == 0:
+        return []
+
+    if np is not None:
+        arr = np.asarray(scores, dtype=np.float64)
+        if k >= n:
+            order = np.argsort(-arr, kind='stable')
+        else:
+            kth = np.partition(arr, n - k)[n - k]
+            # every value >= the k-th largest; ties at the boundary are then
+            # resolved by position, exactly like a stable sort
+            candidates = np.flatnonzero(arr >= kth)
+            order = candidates[np.lexsort((candidates, -arr[candidates]))][:k]
+        return [(int(i), float(arr[i])) for i in order]
+
+    return heapq.nlargest(k, enumerate(scores), key=lambda x: x[1])
+
+
+def _top_rows(scores, rows, k):
+    """top_k of ``scores`` for the subset ``rows`` (ascending), as rows of the source"""
+    ranked = top_k(scores, k)
+    if rows is None:
+        return ranked
+    return [(int(rows[j]), score) for j, score in ranked]
+
+
+def search(source, query, k=3, rescore_factor=RESCORE_FACTOR, nprobe=None):
+    """Top ``k`` (row, score) pairs of ``source`` for ``query``, best first.
+
+    Quantized sources are scanned on their codes first; the best
+    ``k * rescore_factor`` candidates are then rescored exactly when the
+    source still has full-precision rows. Sources with an ANN index
+    (``has_ann``) are only scanned on the rows of the ``nprobe`` IVF lists
+    closest to the query (None for the index's default, 0 for an exact
+    scan); the scan is exact when those lists hold fewer than ``k`` rows.
+    """
+    if len(source) == 0:
+        return []
+    q_unit = unit_vector(query, source.dim)
+    if q_unit is None:
+        return top_k([-1] * len(source), k)
+
+    rows = None
+    if nprobe != 0 and getattr(source, 'has_ann', False):
+        rows = source.ann_candidates(q_unit, nprobe)
+        if len(rows) < k:
+            rows = None
+
+    if getattr(source, 'quantization', 'none') in ('int8', 'binary'):
+        coarse = _top_rows(source.coarse_scores(q_unit, rows), rows, max(k, k * rescore_factor))
+        if not source.has_vectors:
+            return coarse[:k]
+        shortlist = [i for i, _ in coarse]
+        rescored = source.exact_scores(q_unit, shortlist)
+        return [(shortlist[j], score) for j, score in top_k(rescored, k)]
+
+    return _top_rows(source.exact_scores(q_unit, rows), rows, k)
+
+
+def fuse(rankings, k=3, weights=None, rrf_k=RRF_K):
+    """Reciprocal rank fusion of best-first (row, score) rankings.
+
+    Returns the best ``k`` (row, fused score) pairs, ties by row.
+    ``weights`` (default 1 each) scale each ranking's contribution.
+    """
+    if weights is None:
+        weights = [1.0] * len(rankings)
+    fused = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, (row, _) in enumerate(ranking, 1):
+            fused[row] = fused.get(row, 0.0) + weight / (rrf_k + rank)
+    return heapq.nsmallest(k, fused.items(), key=lambda item: (-item[1], item[0]))
+
+
+def _executor():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='hybrid-search')
+        return _pool
+
+
+def hybrid_search(vector_search, lexical_search, k=3, weights=(1.0, 1.0),
+                  candidates=HYBRID_CANDIDATES, rrf_k=RRF_K):
+    """Fused top ``k`` of a vector and a keyword search.
+
+    ``vector_search(n)`` and ``lexical_search(n)`` return their best ``n``
+    (row, score) pairs. The keyword search runs on a worker thread while
+    the vector search (query embedding included) runs on the caller's, so
+    the fused result costs no more wall time than the slower of the two.
+    A search with weight 0 is not run.
+    """
+    n = max(k, candidates)
+    vector_weight, lexical_weight = weights
+    if not lexical_weight:
+        return fuse([vector_search(n)], k, [vector_weight], rrf_k)
+    if not vector_weight:
+        return fuse([lexical_search(n)], k, [lexical_weight], rrf_k)
+
+    lexical = _executor().submit(lexical_search, n)
+    vector = vector_search(n)
+    return fuse([vector, lexical.result()], k, weights, rrf_k)
+
+
+class VectorSet:
+    """In-memory embeddings, normalised once for repeated searches"""
+
+    quantization = 'none'
+    has_vectors = True
+
+    def __init__(self, embeddings):
+        self.dim = max((len(e) for e in embeddings if e), default=0)
+        zero_row = [0.0] * self.dim
+        rows = [e if e and len(e) == self.dim else zero_row for e in embeddings]
+
+        if np is not None:
+            matrix = np.asarray(rows, dtype=np.float64).reshape(len(rows), self.dim)
+            self.norms = np.linalg.norm(matrix, axis=1)
+            self.rows = matrix / np.where(self.norms > 0, self.norms, 1.0)[:, None]
+        else:
+            self.norms = [math.sqrt(sum(x * x for x in row)) for row in rows]
+            self.rows = [[x / n for x in row] if n else row for row, n in zip(rows, self.norms)]
+
+    def __len__(self):
+        return len(self.norms)
+
+    def exact_scores(self, q_unit, rows=None):
+        if np is not None and isinstance(self.rows, np.ndarray):
+            # keep float64 here: in-memory sets are small and this matches
+            # the old pure-Python arithmetic most closely
+            norms = self.norms if rows is None else self.norms[np.asarray(rows, dtype=np.int64)]
+            matrix = self.rows if rows is None else self.rows[np.asarray(rows, dtype=np.int64)]
+            return np.where(norms > 0, matrix @ np.asarray(q_unit, dtype=np.float64), -1.0)
+        return dot_scores(self.rows, self.norms, q_unit, subset=rows)
@@ -0,0 +1,121 @@
+"""Warm, in-process cache of session records and decoded indexes.
+
+Lambda keeps the module loaded between invocations of a warm container,
+so repeat questions against the same session can skip the DynamoDB
+``get_item``, the S3 download and the index decode entirely. Entries are
+bounded by a byte budget (the size of the decoded index) and evicted by
+LRU or LFU. An entry is trusted for ``revalidate_after`` seconds; after
+that the index is revalidated with a conditional GET on its ETag. Sessions
+past their ``expires_at`` are never served.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+# Rough per-entry overhead for the session record and bookkeeping
+ENTRY_OVERHEAD = 4096
+
+
+class CacheEntry:
+    __slots__ = ('session', 'index', 'index_key', 'etag', 'size', 'hits', 'validated_at')
+
+    def __init__(self, session, index, index_key, etag, size, validated_at):
+        self.session = session
+        self.index = index
+        self.index_key = index_key
+        self.etag = etag
+        self.size = size
+        self.hits = 0
+        self.validated_at = validated_at
+
+    @property
+    def expires_at(self):
+        expires_at = self.session.get('expires_at')
+        return int(expires_at) if expires_at is not None else None
+
+
+class SessionCache:
+    """Byte-budgeted session/index cache with LRU or LFU eviction"""
+
+    def __init__(self, max_bytes, policy='lru', revalidate_after=60, clock=time.time):
+        if policy not in ('lru', 'lfu'):
+            raise ValueError(f"Unknown eviction policy: {policy}")
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.revalidate_after = revalidate_after
+        self.clock = clock
+        self.current_bytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, session_id):
+        return session_id in self._entries
+
+    def get(self, session_id):
+        """Cached entry for ``session_id``; expired sessions are dropped"""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at = entry.expires_at
+            if expires_at is not None and expires_at <= self.clock():
+                self._remove(session_id)
+                self.misses += 1
+                return None
+            entry.hits += 1
+            self.hits += 1
+            self._entries.move_to_end(session_id)
+            return entry
+
+    def is_fresh(self, entry):
+        return self.clock() - entry.validated_at < self.revalidate_after
+
+    def mark_validated(self, entry):
+        entry.validated_at = self.clock()
+
+    def put(self, session_id, session, index, index_key, etag):
+        """Cache a session + decoded index, evicting to stay within budget"""
+        size = getattr(index, 'nbytes', 0) + ENTRY_OVERHEAD
+        entry = CacheEntry(session, index, index_key, etag, size, self.clock())
+        with self._lock:
+            if session_id in self._entries:
+                self._remove(session_id)
+            if size > self.max_bytes:
+                return entry
+            while self._entries and self.current_bytes + size > self.max_bytes:
+                self._remove(self._victim())
+                self.evictions += 1
+            self._entries[session_id] = entry
+            self.current_bytes += size
+        return entry
+
+    def invalidate(self, session_id):
+        with self._lock:
+            if session_id in self._entries:
+                self._remove(session_id)
+
+    def _victim(self):
+        if self.policy == 'lru':
+            return next(iter(self._entries))
+        # LFU; ties go to the least recently used entry
+        return min(self._entries, key=lambda sid: self._entries[sid].hits)
+
+    def _remove(self, session_id):
+        entry = self._entries.pop(session_id)
+        self.current_bytes -= entry.size
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self.current_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,154 @@
+"""Sessions holding one or more documents.
+
+A ``DocQASessions`` item used to describe exactly one upload. A session
+now collects documents as they are uploaded into it:
+
+    documents          [{document_id, filename, chunks_count, index_key[, doc_key]}]
+    s3_key             the index /ask searches: the document's own index
+                       while there is one, then a merged index under
+                       vector_stores/sessions/<session_id>/
+    documents_version  bumped by every change to ``documents``
+
+Each document keeps its own index (shared through the document registry
+when the content was already indexed), so adding a document never
+re-embeds the others: the merged index is rebuilt by copying their stored
+rows (vector_index.merge_indexes) and records which rows came from which
+document. Concurrent additions are serialized by a condition on
+``documents_version``; the loser deletes its merged index and rebuilds on
+top of the winner's documents. Items written before this change (and
+single-document sessions) keep ``filename``/``doc_key`` at the top level
+and read as one document.
+"""
+import logging
+import time
+import uuid
+from datetime import datetime
+
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+MERGED_INDEX_PREFIX = 'vector_stores/sessions/'
+VERSION_CONDITION = 'documents_version = :version'
+NEW_VERSION_CONDITION = 'attribute_not_exists(documents_version)'
+# Additions racing on one session before giving up
+MAX_ATTEMPTS = 5
+
+
+def _is_condition_failure(error):
+    return error.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException'
+
+
+def is_merged_index(index_key):
+    return bool(index_key) and index_key.startswith(MERGED_INDEX_PREFIX)
+
+
+def session_documents(item):
+    """The documents of a session item (one, rebuilt from the top-level fields, for older items)"""
+    if item.get('documents'):
+        return item['documents']
+    if not item.get('s3_key') or is_merged_index(item['s3_key']):
+        return []
+    document = {
+        'document_id': item['session_id'],
+        'filename': item.get('filename'),
+        'chunks_count': int(item.get('chunks_count', 0)),
+        'index_key': item['s3_key'],
+    }
+    if item.get('doc_key'):
+        document['doc_key'] = item['doc_key']
+    return [document]
+
+
+def holds_document(documents, document):
+    """Whether ``document`` (its index, or content registered under its doc_key) is among ``documents``"""
+    return any(d['index_key'] == document['index_key'] or
+               (document.get('doc_key') and d.get('doc_key') == document['doc_key']) for d in documents)
+
+
+class SessionStore:
+    """Session items in ``DocQASessions`` plus the merged indexes they point at"""
+
+    def __init__(self, table, s3, bucket, ttl_hours, clock=time.time):
+        self.table = table
+        self.s3 = s3
+        self.bucket = bucket
+        self.ttl_hours = ttl_hours
+        self.clock = clock
+
+    def _expires_at(self):
+        return int(self.clock() + self.ttl_hours * 3600)
+
+    def get(self, session_id):
+        """The live session item, or None when it does not exist or has expired"""
+        item = self.table.get_item(Key={'session_id': session_id}, ConsistentRead=True).get('Item')
+        # DynamoDB TTL deletes lazily, so expired items can still be returned
+        if not item or int(item.get('expires_at', 0)) < self.clock():
+            return None
+        return item
+
+    def create(self, session_id, document):
+        """New session whose only document is ``document``"""
+        item = {
+            'session_id': session_id,
+            'filename': document['filename'],
+            'chunks_count': document['chunks_count'],
+            's3_key': document['index_key'],
+            'documents': [document],
+            'documents_version': 1,
+            'created_at': datetime.fromtimestamp(self.clock()).isoformat(),
+            'expires_at': self._expires_at(),
+        }
+        if document.get('doc_key'):
+            item['doc_key'] = document['doc_key']
+        self.table.put_item(Item=item)
+        return item
+
+    def add(self, session_id, document, build_index):
+        """Add ``document`` to a live session and return its updated item.
+
+        ``build_index(documents, metadata)`` returns the bytes of the merged
+        index over ``documents``. Adding a document the session already
+        holds (same index or content) changes nothing. Raises ValueError
+        when the session is gone.
+        """
+        for _ in range(MAX_ATTEMPTS):
+            item = self.get(session_id)
+            if item is None:
+                raise ValueError('Session not found or expired')
+            documents = session_documents(item)
+            if holds_document(documents, document):
+                return item
+
+            documents = documents + [document]
+            version = int(item.get('documents_version', 0))
+            index_key = f"{MERGED_INDEX_PREFIX}{session_id}/{version + 1}-{uuid.uuid4().hex[:8]}.idx"
+            start, rows = 0, []
+            for d in documents:
+                rows.append({'document_id': d['document_id'], 'filename': d['filename'],
+                             'start': start, 'count': int(d['chunks_count'])})
+                start += int(d['chunks_count'])
+            self.s3.put_object(Bucket=self.bucket, Key=index_key, ContentType='application/octet-stream',
+                               Body=build_index(documents, {'session_id': session_id, 'documents': rows}))
+
+            updated = dict(item, documents=documents, documents_version=version + 1, s3_key=index_key,
+                           chunks_count=start, filename=documents[0]['filename'], expires_at=self._expires_at())
+            updated.pop('doc_key', None)
+            condition = {'ConditionExpression': NEW_VERSION_CONDITION}
+            if version:
+                condition = {'ConditionExpression': VERSION_CONDITION,
+                             'ExpressionAttributeValues': {':version': version}}
+            try:
+                self.table.put_item(Item=updated, **condition)
+            except ClientError as e:
+                self.s3.delete_object(Bucket=self.bucket, Key=index_key)
+                if not _is_condition_failure(e):
+                    raise
+                logger.info(f"Session {session_id} changed while adding {document['filename']}, retrying")
+                continue
+
+            if is_merged_index(item.get('s3_key')):
+                self.s3.delete_object(Bucket=self.bucket, Key=item['s3_key'])
+            logger.info(f"📚 Session {session_id} now holds {len(documents)} documents ({start} chunks)")
+            return updated
+        raise RuntimeError(f"Session {session_id} kept changing while adding {document['filename']}")
@@ -0,0 +1,85 @@
+"""
+Tests for the IVF approximate search index
+Run with: python -m pytest test_ann_index.py
+"""
+import numpy as np
+import pytest
+
+import ann_index
+import search_engine
+import vector_index
+from vector_index import serialize_index, load_index, load_index_bytes
+
+
+def _corpus(n=2000, dim=24, clusters=40, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim))
+    rows = centers[rng.integers(0, clusters, size=n)] + 0.4 * rng.normal(size=(n, dim))
+    queries = rows[rng.integers(0, n, size=30)] + 0.2 * rng.normal(size=(30, dim))
+    return rows.tolist(), queries.tolist()
+
+
+def _recall(index, queries, k=5, **kwargs):
+    hits = 0
+    for query in queries:
+        exact = {i for i, _ in index.search(query, k, nprobe=0)}
+        hits += len(exact & {i for i, _ in index.search(query, k, **kwargs)})
+    return hits / (k * len(queries))
+
+
+def test_lists_cover_every_embedded_row_once(tmp_path):
+    rows, _ = _corpus()
+    rows[7] = []  # failed embedding
+    path = tmp_path / 'big.idx'
+    path.write_bytes(serialize_index([''] * len(rows), rows, ann_min_rows=1000, ann_nlist=30, ann_nprobe=4))
+
+    with load_index(str(path)) as index:
+        ann = index.ann()
+        assert index.has_ann and (ann.nlist, ann.nprobe) == (30, 4)
+        members = index.ann_candidates([1.0] + [0.0] * 23, nprobe=30)
+        assert list(members) == [i for i in range(len(rows)) if i != 7]
+        assert len(index.ann_candidates([1.0] + [0.0] * 23)) < len(rows) / 3
+
+
+def test_small_indexes_are_searched_exactly():
+    rows, queries = _corpus(n=300)
+    index = load_index_bytes(serialize_index([''] * 300, rows, ann_min_rows=1000))
+    assert not index.has_ann and index.ann() is None
+    assert index.search(queries[0], 3) == index.search(queries[0], 3, nprobe=0)
+
+
+def test_nprobe_trades_recall_for_scanned_rows():
+    rows, queries = _corpus()
+    index = load_index_bytes(serialize_index([''] * len(rows), rows, ann_min_rows=0))
+    assert index.ann().nlist == ann_index.default_nlist(len(rows))
+    assert _recall(index, queries, nprobe=1) < _recall(index, queries, nprobe=8) <= 1.0
+    assert _recall(index, queries) >= 0.95
+    # probing every list is the exact search, scores included
+    for query in queries[:5]:
+        assert index.search(query, 5, nprobe=index.ann().nlist) == index.search(query, 5, nprobe=0)
+
+
+@pytest.mark.parametrize('quantization,rescore', [('int8', 'float32'), ('binary', None)])
+def test_quantized_indexes_scan_only_the_probed_lists(quantization, rescore):
+    rows, queries = _corpus()
+    index = load_index_bytes(serialize_index([''] * len(rows), rows, quantization=quantization,
+                                             rescore_dtype=rescore, ann_min_rows=0))
+    assert _recall(index, queries, nprobe=index.ann().nlist) == 1.0
+    assert _recall(index, queries) >= 0.9
+
+
+def test_reading_without_numpy(monkeypatch):
+    rows, queries = _corpus(n=1200)
+    blob = serialize_index([''] * len(rows), rows, quantization='int8', ann_min_rows=0, ann_nprobe=6)
+    expected = load_index_bytes(blob)
+    found = [[i for i, _ in expected.search(q, 3)] for q in queries]
+    candidates = [list(expected.ann_candidates(search_engine.unit_vector(q))) for q in queries[:5]]
+
+    for module in (ann_index, search_engine, vector_index):
+        monkeypatch.setattr(module, 'np', None)
+    index = load_index_bytes(blob)
+    assert [list(index.ann_candidates(search_engine.unit_vector(q))) for q in queries[:5]] == candidates
+    assert [[i for i, _ in index.search(q, 3)] for q in queries] == found
+
+    # without numpy nothing is clustered at ingestion
+    assert not load_index_bytes(serialize_index([''] * len(rows), rows, ann_min_rows=0)).has_ann
@@ -0,0 +1,83 @@
+"""
+Tests for the token-aware chunker
+Run with: python -m pytest test_chunker.py
+"""
+import random
+
+import chunker
+from chunker import estimate_tokens, iter_chunks
+
+
+def _pieces(text, rng, count):
+    cuts = sorted(rng.sample(range(1, len(text)), count))
+    return [text[a:b] for a, b in zip([0] + cuts, cuts + [len(text)])]
+
+
+def _random_text(rng, parts):
+    return ''.join(rng.choice([
+        'Câu số %d.' % i, ' Why %d?!' % i, '...', ' word' * rng.randint(1, 60), '\n', '\n\n', ' Dr. Smith',
+        ' giá 3.14 triệu', ' x' * rng.randint(0, 300), 'y' * rng.randint(0, 1500), '. ', ' v.v. ', '  ',
+    ]) for i in range(parts))
+
+
+def test_chunks_do_not_depend_on_piece_boundaries():
+    rng = random.Random(5)
+    for _ in range(20):
+        text = _random_text(rng, rng.randint(50, 1500))
+        whole = list(iter_chunks([text], 60, 15))
+        streamed = list(iter_chunks(_pieces(text, rng, rng.randint(1, 300)), 60, 15))
+        assert streamed == whole
+
+
+def test_chunks_are_bounded_slices_of_the_document():
+    rng = random.Random(7)
+    text = _random_text(rng, 3000)
+    chunks = list(iter_chunks(_pieces(text, rng, 200), 80, 20))
+    assert len(chunks) > 20
+    for chunk in chunks:
+        assert text[chunk['start']:chunk['end']] == chunk['page_content']
+        assert estimate_tokens(chunk['page_content']) <= chunk['tokens'] <= 80
+    # every non-space character is in some chunk
+    covered = bytearray(len(text))
+    for chunk in chunks:
+        covered[chunk['start']:chunk['end']] = b'\x01' * (chunk['end'] - chunk['start'])
+    assert all(covered[i] or text[i].isspace() for i in range(len(text)))
+
+
+def test_consecutive_chunks_overlap_by_whole_sentences():
+    text = ' '.join(f"Sentence number {i} has a few words." for i in range(200))
+    chunks = list(iter_chunks([text], 50, 20))
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert chunk['start'] < previous['end']
+        shared = text[chunk['start']:previous['end']]
+        assert shared.startswith('Sentence') and shared.endswith('.')
+        assert estimate_tokens(shared) <= 20
+
+    chunks = list(iter_chunks([text], 50, 0))
+    assert all(b['start'] > a['end'] for a, b in zip(chunks, chunks[1:]))
+
+
+def test_decimals_and_abbreviations_do_not_end_sentences():
+    text = "Giá là 3.14 triệu. Ông Dr. Smith đến TP. HCM lúc 9 giờ, mang theo sách, bút v.v. và quà. J. Doe hỏi."
+    sentences = [s.strip() for s, _ in chunker.iter_sentences([text])]
+    assert sentences == ["Giá là 3.14 triệu.", "Ông Dr. Smith đến TP. HCM lúc 9 giờ, mang theo sách, bút v.v. và quà.",
+                         "J. Doe hỏi."]
+    assert [s.strip() for s, _ in chunker.iter_sentences(["Một\n\nHai. ba. Bốn"])] == ["Một", "Hai. ba.", "Bốn"]
+
+
+def test_long_runs_without_punctuation_are_split():
+    text = 'word ' * 5000 + 'z' * 3000
+    chunks = list(iter_chunks(_pieces(text, random.Random(1), 50), 100, 10))
+    assert all(chunk['tokens'] <= 100 for chunk in chunks)
+    assert sum(c['page_content'].count('z') for c in chunks) == 3000
+
+
+def test_paged_chunks_know_their_pages():
+    pages = [f"Trang {n} nói về chủ đề {n}. " * (n + 3) for n in range(1, 7)]
+    chunks = list(iter_chunks(pages, 40, 0, paged=True))
+    starts = [sum(map(len, pages[:n])) for n in range(len(pages))]
+    for chunk in chunks:
+        expected = [n + 1 for n, s in enumerate(starts) if s < chunk['end'] and s + len(pages[n]) > chunk['start']]
+        assert chunk['pages'] == expected
+    assert any(len(chunk['pages']) > 1 for chunk in chunks)
+    assert 'pages' not in next(iter_chunks(pages, 40))
@@ -0,0 +1,89 @@
+"""
+Tests for collection questions routed by per-document centroids
+Run with: python -m pytest test_collection_search.py
+"""
+import math
+
+import numpy as np
+
+import collection_search
+import search_engine
+import vector_index
+from collection_search import CollectionStore, append_routing, centroid, route, routing_row
+from fakes import SessionTable, UploadS3
+from vector_index import load_index_bytes, serialize_index
+
+
+def _collection(documents=30, chunks=20, dim=16, seed=0):
+    """Chunk indexes whose embeddings cluster around one centre per document"""
+    rng = np.random.default_rng(seed)
+    indexes = {}
+    for d in range(documents):
+        rows = rng.normal(size=dim) + 0.3 * rng.normal(size=(chunks, dim))
+        texts = [f"Tài liệu {d} đoạn {c} mã DOC-{d}-{c}" for c in range(chunks)]
+        indexes[f'vector_stores/d{d}.idx'] = load_index_bytes(serialize_index(texts, rows.tolist(), lexical=True))
+    routing = None
+    for d, (key, index) in enumerate(indexes.items()):
+        document = {'document_id': f'd{d}', 'filename': f'doc{d}.txt', 'chunks_count': chunks, 'index_key': key}
+        routing = load_index_bytes(append_routing(routing, document, routing_row(index, document['filename'])))
+    return indexes, routing
+
+
+def test_centroid_is_the_normalised_mean_of_unit_rows(monkeypatch):
+    rows = [[3.0, 0.0], [0.0, 0.5], []]
+    index = load_index_bytes(serialize_index(['a', 'b', 'c'], rows))
+    expected = [math.sqrt(0.5), math.sqrt(0.5)]
+    assert np.allclose(centroid(index), expected)
+    for module in (collection_search, search_engine, vector_index):
+        monkeypatch.setattr(module, 'np', None)
+    assert np.allclose(centroid(index), expected)
+    assert centroid(load_index_bytes(serialize_index(['a'], [[]]))) is None
+
+
+def test_routing_rows_are_appended_in_document_order():
+    indexes, routing = _collection(documents=5)
+    assert len(routing) == 5 and routing.has_lexical
+    assert [d['document_id'] for d in routing.documents] == ['d0', 'd1', 'd2', 'd3', 'd4']
+    assert routing.document(3)['index_key'] == 'vector_stores/d3.idx'
+    assert routing.text(2).startswith('doc2.txt\nTài liệu 2 đoạn 0')
+    # each row is its document's centroid
+    for i, index in enumerate(indexes.values()):
+        assert np.allclose(routing.vector(i), centroid(index), atol=1e-6)
+
+
+def test_only_the_routed_documents_are_loaded_and_searched():
+    indexes, routing = _collection()
+    loads = []
+
+    def load(key):
+        loads.append(key)
+        return indexes[key]
+
+    target = indexes['vector_stores/d17.idx']
+    query = [x + 0.01 for x in target.vector(4)]
+    assert route(routing, 'DOC-17-4', query, 3)[0] == 17
+
+    hits = collection_search.search(routing, load, 'DOC-17-4', query, k=3, candidates=3)
+    assert len(loads) == 3 and 'vector_stores/d17.idx' in loads
+    document, index, row, _ = hits[0]
+    assert document['filename'] == 'doc17.txt' and index is target and row == 4
+
+    # a question that cannot be embedded is routed by the rows' text
+    loads.clear()
+    hits = collection_search.search(routing, load, 'tài liệu 23 đoạn 0', None, k=1, candidates=2)
+    assert loads[0] == 'vector_stores/d23.idx' and hits[0][0]['document_id'] == 'd23'
+
+
+def test_collections_are_created_by_their_first_document():
+    store = CollectionStore(SessionTable(), UploadS3(), 'b', clock=lambda: 1000)
+    indexes, _ = _collection(documents=3)
+    assert store.get('team') is None
+    for d, (key, index) in enumerate(indexes.items()):
+        document = {'document_id': f'd{d}', 'filename': f'doc{d}.txt', 'chunks_count': 20, 'index_key': key}
+        item = store.add('team', document, routing_row(index, document['filename']))
+    assert item['session_id'] == 'collection#team' and item['documents_count'] == 3
+    assert item['chunks_count'] == 60 and 'expires_at' not in item
+    # one routing index, the latest
+    assert [key for key in store.s3.objects] == [item['s3_key']]
+    assert store.add('team', dict(document, document_id='again'), ('x', None)) == item
+    assert len(store.routing(store.get('team'))) == 3
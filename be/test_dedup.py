@@ -0,0 +1,109 @@
+"""
+Tests for boilerplate and duplicate chunk removal
+Run with: python -m pytest test_dedup.py
+"""
+import random
+
+import dedup
+from dedup import dedup_chunks, simhash, strip_boilerplate
+from embedding_cache import EmbeddingCache
+from fakes import FakeBedrock
+from rag_bedrock import BedrockRAG
+
+HEADER = 'ACME Corp — Tài liệu nội bộ, không phát hành ra ngoài'
+DISCLAIMER = ('Thông tin trong tài liệu này chỉ mang tính tham khảo và có thể thay đổi mà không cần báo trước. '
+              'Công ty không chịu trách nhiệm về bất kỳ thiệt hại nào phát sinh từ việc sử dụng tài liệu.')
+
+
+def _sentences(rng, count):
+    return ' '.join(f"Điều {rng.randrange(1000)} quy định w{rng.randrange(10 ** 6)} và w{rng.randrange(10 ** 6)}."
+                    for _ in range(count))
+
+
+def _pages(count, seed=0):
+    rng = random.Random(seed)
+    return [f"{HEADER}\n{_sentences(rng, 12)}\n{40 + n}\n{_sentences(rng, 12)}\nTrang {n} / {count}\n"
+            for n in range(1, count + 1)]
+
+
+def test_recurring_lines_are_blanked_in_place():
+    pages = _pages(20)
+    stripped = list(strip_boilerplate(iter(pages)))
+    assert [len(p) for p in stripped] == [len(p) for p in pages]
+    for n, (page, clean) in enumerate(zip(pages, stripped), 1):
+        assert HEADER not in clean and 'Trang' not in clean
+        # a number inside the page is content, not a page number
+        assert f'\n{40 + n}\n' in clean
+        assert clean.split('\n')[1] == page.split('\n')[1]
+
+    # too few pages to call anything boilerplate; page numbers still go
+    short = list(strip_boilerplate(_pages(2)))
+    assert all(HEADER in page and 'Trang' not in page for page in short)
+
+
+def test_boilerplate_found_after_the_lookahead():
+    pages = [f"{_sentences(random.Random(n), 5)}\n" for n in range(30)]
+    pages = pages[:10] + [f"{HEADER}\n{page}" for page in pages[10:]]
+    stripped = list(strip_boilerplate(pages, lookahead=4))
+    # caught once it is on half of the pages read
+    assert sum(HEADER in page for page in stripped) <= 5 and HEADER not in stripped[-1]
+
+
+def test_exact_duplicates_are_dropped_with_their_positions():
+    chunks = [{'page_content': DISCLAIMER, 'start': 0, 'end': 10, 'pages': [1]},
+              {'page_content': 'Nội dung riêng của trang hai.', 'start': 10, 'end': 20, 'pages': [2]},
+              {'page_content': '  ' + DISCLAIMER.upper() + '\n', 'start': 20, 'end': 30, 'pages': [3]}]
+    kept = list(dedup_chunks(chunks))
+    assert [c['start'] for c in kept] == [0, 10]
+    assert kept[0]['positions'] == [{'start': 0, 'end': 10, 'pages': [1]}, {'start': 20, 'end': 30, 'pages': [3]}]
+    assert kept[1]['positions'] == [{'start': 10, 'end': 20, 'pages': [2]}]
+
+    # positions of a yielded chunk grow as later duplicates are dropped
+    stream = dedup_chunks(chunks)
+    first = next(stream)
+    assert len(first['positions']) == 1
+    list(stream)
+    assert len(first['positions']) == 2
+
+
+def test_near_duplicates_are_collapsed():
+    rng = random.Random(1)
+    # about the size of a default chunk, with one word changed
+    base = _sentences(rng, 25)
+    variant = base.replace('quy định', 'quy dinh', 1)
+    assert variant != base
+    other = _sentences(rng, 25)
+    words = dedup._WORD.findall(base.lower())
+    assert (simhash(words) ^ simhash(dedup._WORD.findall(variant.lower()))).bit_count() <= dedup.NEAR_DUPLICATE_BITS
+
+    kept = list(dedup_chunks([{'page_content': t, 'start': i, 'end': i + 1} for i, t in enumerate([base, other, variant])]))
+    assert [c['page_content'] for c in kept] == [base, other]
+    assert [p['start'] for p in kept[0]['positions']] == [0, 2]
+
+    # short chunks are only ever deduplicated exactly
+    short = [{'page_content': 'Điều 1. Phạm vi.'}, {'page_content': 'Điều 2. Phạm vi.'}]
+    assert len(list(dedup_chunks(short))) == 2
+
+
+def test_simhash_without_numpy(monkeypatch):
+    words = dedup._WORD.findall(_sentences(random.Random(2), 20).lower())
+    expected = simhash(words)
+    monkeypatch.setattr(dedup, 'np', None)
+    assert simhash(words) == expected
+
+
+def test_repeated_page_furniture_is_embedded_once():
+    rag = BedrockRAG(bedrock_runtime=FakeBedrock(), embedding_cache=EmbeddingCache())
+    pages = [page + '\n' + DISCLAIMER + '\n' for page in _pages(12)]
+    chunks = list(rag.iter_chunks(pages, paged=True))
+    texts = [c['page_content'] for c in chunks]
+    assert not any(HEADER in t for t in texts)
+    assert sum(DISCLAIMER in t for t in texts) <= 1
+
+    # every page is still represented by some kept chunk
+    covered = {page for c in chunks for p in c['positions'] for page in p['pages']}
+    assert covered == set(range(1, 13))
+    # boilerplate is blanked, not removed, so offsets still point into the extracted text
+    clean = ''.join(strip_boilerplate(pages))
+    assert len(clean) == sum(map(len, pages))
+    assert all(clean[c['start']:c['end']] == c['page_content'] for c in chunks)
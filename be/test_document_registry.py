@@ -0,0 +1,102 @@
+import hashlib
+
+import pytest
+
+import handler
+from document_registry import DocumentRegistry, checksum_to_hex, hex_to_checksum
+from embedding_cache import EmbeddingCache
+from fakes import FakeDocumentTable, ingest
+
+
+def test_registry_counts_references_and_ignores_replays():
+    registry = DocumentRegistry(FakeDocumentTable())
+    assert registry.acquire('doc', 's1') is None
+    assert registry.register('doc', 's1', 'vector_stores/s1.idx', 'a.txt', 3)['index_key'] == 'vector_stores/s1.idx'
+    assert registry.acquire('doc', 's2')['ref_count'] == 2
+
+    assert registry.release('doc', 's1') is None
+    assert registry.release('doc', 's1') is None  # replayed stream record
+    assert registry.release('doc', 's2') == 'vector_stores/s1.idx'
+    assert registry.acquire('doc', 's3') is None
+
+
+def test_losing_register_race_joins_the_winner():
+    registry = DocumentRegistry(FakeDocumentTable())
+    registry.register('doc', 's1', 'vector_stores/s1.idx', 'a.txt', 3)
+    record = registry.register('doc', 's2', 'vector_stores/s2.idx', 'a.txt', 3)
+    assert record['index_key'] == 'vector_stores/s1.idx' and record['sessions'] == {'s1', 's2'}
+
+
+def test_checksum_round_trip():
+    digest = hashlib.sha256(b'hello').hexdigest()
+    assert checksum_to_hex(hex_to_checksum(digest)) == digest
+    assert checksum_to_hex('abc-2') is None  # multipart composite checksum
+    with pytest.raises(ValueError):
+        hex_to_checksum('not-hex')
+
+
+def _upload(key):
+    job = ingest(key)
+    return (200 if job['status'] == 'succeeded' else 500), job
+
+
+def test_identical_upload_reuses_index(pipeline):
+    s3, sessions, bedrock = pipeline
+    document = b'First sentence here. Second sentence there. ' * 40
+    s3.objects['uploads/a/doc.txt'] = s3.objects['uploads/b/copy.txt'] = document
+
+    status, first = _upload('uploads/a/doc.txt')
+    assert status == 200 and 'deduplicated' not in first
+    calls = bedrock.calls
+
+    status, second = _upload('uploads/b/copy.txt')
+    assert status == 200 and second['deduplicated'] is True
+    assert second['chunks_count'] == first['chunks_count']
+    assert bedrock.calls == calls
+    a, b = sessions.items[first['session_id']], sessions.items[second['session_id']]
+    assert a['s3_key'] == b['s3_key'] and a['doc_key'] == b['doc_key']
+
+    # TTL deletes arrive on the stream; the index survives until the last one
+    def remove(session):
+        image = {k: {'S': v} for k, v in session.items() if isinstance(v, str)}
+        return {'eventName': 'REMOVE', 'dynamodb': {'OldImage': image, 'SequenceNumber': '1'}}
+
+    assert handler.cleanup({'Records': [remove(a)]}, None) == {'batchItemFailures': []}
+    assert a['s3_key'] in s3.objects
+    handler.cleanup({'Records': [remove(b), remove(b)]}, None)
+    assert a['s3_key'] not in s3.objects
+
+
+def test_identical_text_is_found_before_embedding(pipeline, monkeypatch):
+    s3, sessions, bedrock = pipeline
+    document = b'Sentence with its own number %d. ' * 200
+    s3.objects['uploads/a/doc.txt'] = s3.objects['uploads/b/copy.txt'] = document
+    _upload('uploads/a/doc.txt')
+    calls = bedrock.calls
+
+    # no checksum and a cold embedding cache: only the content hash can match
+    monkeypatch.setattr(handler.bedrock_rag, 'embedding_cache', EmbeddingCache())
+    status, body = _upload('uploads/b/copy.txt')
+    assert status == 200 and body['deduplicated'] is True
+    assert bedrock.calls == calls
+
+
+def test_verified_checksum_skips_download(pipeline):
+    s3, sessions, bedrock = pipeline
+    document = b'Only one sentence. '
+    s3.objects['uploads/a/doc.txt'] = s3.objects['uploads/b/doc.txt'] = document
+    s3.checksums['uploads/b/doc.txt'] = hex_to_checksum(hashlib.sha256(document).hexdigest())
+
+    _upload('uploads/a/doc.txt')
+    status, body = _upload('uploads/b/doc.txt')
+    assert status == 200 and body['deduplicated'] is True
+    assert s3.downloads == 1
+
+
+def test_different_settings_do_not_share(pipeline):
+    s3, sessions, bedrock = pipeline
+    s3.objects['uploads/a/doc.txt'] = b'Some text. More text. '
+    _upload('uploads/a/doc.txt')
+    handler.bedrock_rag.chunk_size = 400
+    status, body = _upload('uploads/a/doc.txt')
+    assert status == 200 and 'deduplicated' not in body
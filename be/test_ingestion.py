@@ -0,0 +1,563 @@
+import hashlib
+import json
+import random
+
+import pytest
+from boto3.dynamodb.types import TypeSerializer
+
+import handler
+import ingestion
+import rag_bedrock
+from document_registry import DocumentRegistry, hex_to_checksum
+from embedding_cache import EmbeddingCache
+from fakes import (NO_SLEEP, FakeBedrock, FakeDocumentTable, FakeJobTable, SessionTable, UploadS3, call, ingest,
+                   s3_event)
+from fanout import LocalQueue, SQSQueue
+from rag_bedrock import EMBED_PIPELINE_DEPTH, BedrockRAG
+from rate_control import RetryPolicy
+from tmp_cache import TmpCache
+
+
+DOCUMENT = b'First sentence here. Second sentence there. ' * 60
+
+
+def test_upload_enqueues_and_worker_completes(pipeline):
+    s3, sessions, bedrock = pipeline
+    s3.objects['uploads/ab/my doc.txt'] = DOCUMENT
+
+    status, job = call(handler.upload, s3_key='uploads/ab/my doc.txt')
+    assert status == 202 and job['status'] == 'queued' and bedrock.calls == 0
+    assert call(handler.upload, s3_key='uploads/ab/my doc.txt')[1]['job_id'] == job['job_id']
+
+    handler.ingest(s3_event('uploads/ab/my doc.txt'), None)
+    status, done = call(handler.status, job_id=job['job_id'])
+    assert done['status'] == 'succeeded' and done['filename'] == 'my doc.txt'
+    assert done['chunks_embedded'] == done['chunks_total'] == done['chunks_count']
+    assert sessions.items[done['session_id']]['chunks_count'] == done['chunks_count']
+
+    # a duplicate S3 event does not process the document again
+    calls = bedrock.calls
+    handler.ingest(s3_event('uploads/ab/my doc.txt'), None)
+    assert bedrock.calls == calls
+    assert call(handler.upload, s3_key='uploads/ab/my doc.txt')[0] == 200
+
+
+def test_worker_reads_each_upload_with_one_get(pipeline, monkeypatch):
+    s3, sessions, bedrock = pipeline
+    key = 'uploads/g/doc.txt'
+    s3.objects[key] = DOCUMENT
+    call(handler.upload, s3_key=key)
+
+    requests = []
+    for name in ('head_object', 'get_object'):
+        def counted(*args, _name=name, _call=getattr(s3, name), **kwargs):
+            requests.append((_name, kwargs.get('Key')))
+            return _call(*args, **kwargs)
+        monkeypatch.setattr(s3, name, counted)
+
+    handler.ingest(s3_event(key), None)
+    assert [r for r in requests if r[1] == key] == [('get_object', key)]
+    assert call(handler.status, job_id=ingestion.job_id_for(key))[1]['status'] == 'succeeded'
+
+
+def test_text_uploads_are_decoded_as_they_stream(pipeline, monkeypatch):
+    s3, sessions, bedrock = pipeline
+    key = 'uploads/t/log.txt'
+    s3.objects[key] = 'Dòng nhật ký số một. Dòng thứ hai! '.encode('utf-8') * 20000
+    # with a verified checksum there is nothing to hash before decoding
+    s3.checksums[key] = hex_to_checksum(hashlib.sha256(s3.objects[key]).hexdigest())
+    reads = []
+    get_object = s3.get_object
+
+    def recorded(**kwargs):
+        response = get_object(**kwargs)
+        if kwargs['Key'] == key:
+            read = response['Body'].read
+            response['Body'].read = lambda size=-1: reads.append(size) or read(size)
+        return response
+    monkeypatch.setattr(s3, 'get_object', recorded)
+
+    job = ingest(key)
+    assert job['status'] == 'succeeded' and len(reads) > 10
+    assert all(0 < size <= rag_bedrock.TEXT_BLOCK_BYTES for size in reads)
+
+    # text is capped separately from PDFs
+    size = 20 * 1024 * 1024
+    assert handler.validate_file('log.txt', 'text/plain', size)
+    with pytest.raises(ValueError):
+        handler.validate_file('doc.pdf', 'application/pdf', size)
+
+
+def test_ask_without_embedding_uses_keyword_index(pipeline, monkeypatch):
+    s3, sessions, bedrock = pipeline
+    key = 'uploads/k/contract.txt'
+    rng = random.Random(4)
+    clauses = [b'Clause w%d covers w%d. ' % (rng.randrange(10 ** 6), rng.randrange(10 ** 6)) for _ in range(300)]
+    clauses[150] = b'Invoice INV-2024/117 is payable within 45 days. '
+    s3.objects[key] = b''.join(clauses)
+    job = ingest(key)
+    assert handler.load_index_bytes(s3.objects[sessions.items[job['session_id']]['s3_key']]).has_lexical
+
+    prompts = []
+    monkeypatch.setattr(handler.bedrock_rag, 'get_titan_embedding', lambda text: None)
+    monkeypatch.setattr(handler.bedrock_rag, 'invoke_titan', lambda prompt: prompts.append(prompt) or 'ok')
+    status, body = call(handler.ask, session_id=job['session_id'], question='When is inv-2024/117 due?')
+    assert status == 200 and body['answer'] == 'ok'
+    # the chunk with the invoice number is the first context passage
+    assert 'INV-2024/117' in prompts[0].split('\n\n')[1]
+
+
+def test_hybrid_ask_finds_pasted_identifiers(pipeline, monkeypatch):
+    s3, sessions, bedrock = pipeline
+    key = 'uploads/h/contract.txt'
+    rng = random.Random(5)
+    clauses = [b'Clause w%d covers w%d. ' % (rng.randrange(10 ** 6), rng.randrange(10 ** 6)) for _ in range(300)]
+    clauses[200] = b'Error E-4031 means the meter was read twice. '
+    s3.objects[key] = b''.join(clauses)
+    job = ingest(key)
+
+    prompts = []
+    monkeypatch.setattr(handler.bedrock_rag, 'invoke_titan', lambda prompt: prompts.append(prompt) or 'ok')
+    monkeypatch.setattr(handler, 'RETRIEVAL_MODE', 'hybrid')
+    assert call(handler.ask, session_id=job['session_id'], question='What does e-4031 mean?')[0] == 200
+    # the only chunk with the code ranks first, ahead of the closest embeddings
+    assert 'E-4031' in prompts[0].split('\n\n')[1]
+
+
+def _clauses(seed, special=None, at=0, count=120):
+    rng = random.Random(seed)
+    clauses = [b'Clause w%d covers w%d. ' % (rng.randrange(10 ** 6), rng.randrange(10 ** 6)) for _ in range(count)]
+    if special:
+        clauses[at] = special
+    return b''.join(clauses)
+
+
+def test_documents_added_to_a_session_are_searched_together(pipeline, monkeypatch):
+    s3, sessions, bedrock = pipeline
+    s3.objects['uploads/m/terms.txt'] = _clauses(6, b'Refunds are issued within 14 days. ', 60)
+    first = ingest('uploads/m/terms.txt')
+    sid = first['session_id']
+    assert first['documents_count'] == 1
+
+    assert call(handler.presign, filename='b.txt', content_type='text/plain', session_id='gone')[0] == 404
+    key = handler.new_upload_key('manual.txt', sid)
+    assert ingestion.upload_session(key) == sid
+    s3.objects[key] = _clauses(7, b'Error E-4031 means the meter was read twice. ', 30)
+    calls = bedrock.calls
+    second = ingest(key)
+    assert second['status'] == 'succeeded' and second['session_id'] == sid
+    assert second['documents_count'] == 2 and second['document_id'] != sid
+    # only the new document was embedded
+    assert bedrock.calls - calls == second['chunks_count']
+
+    session = sessions.items[sid]
+    index = handler.load_index_bytes(s3.objects[session['s3_key']])
+    assert len(index) == first['chunks_count'] + second['chunks_count'] and index.has_lexical
+    assert [d['filename'] for d in index.documents] == ['terms.txt', 'manual.txt']
+
+    prompts = []
+    monkeypatch.setattr(handler.bedrock_rag, 'invoke_titan', lambda prompt: prompts.append(prompt) or 'ok')
+    status, body = call(handler.ask, session_id=sid, question='What does e-4031 mean?')
+    assert status == 200 and body['sources'][0]['filename'] == 'manual.txt'
+    assert prompts[0].split('\n\n')[1].startswith('[manual.txt] ')
+    status, body = call(handler.ask, session_id=sid, question='When are refunds issued?')
+    assert 'terms.txt' in {source['filename'] for source in body['sources']}
+
+    # the same content again is neither embedded nor added twice
+    calls = bedrock.calls
+    copy = handler.new_upload_key('copy.txt', sid)
+    s3.objects[copy] = s3.objects[key]
+    again = ingest(copy)
+    assert again['deduplicated'] is True and again['documents_count'] == 2
+    assert bedrock.calls == calls
+
+    # expiry releases every document and the merged index
+    indexes = [d['index_key'] for d in sessions.items[sid]['documents']] + [sessions.items[sid]['s3_key']]
+    serializer = TypeSerializer()
+    image = {k: serializer.serialize(v) for k, v in sessions.items.pop(sid).items()}
+    handler.cleanup({'Records': [{'eventName': 'REMOVE', 'dynamodb': {'OldImage': image}}]}, None)
+    assert not set(indexes) & set(s3.objects)
+
+
+def test_collection_questions_search_the_routed_documents(pipeline, monkeypatch):
+    s3, sessions, bedrock = pipeline
+    assert call(handler.presign, filename='a.txt', content_type='text/plain', collection_id='no/slash')[0] == 400
+    specials = [b'Refunds are issued within 14 days. ', b'Error E-4031 means the meter was read twice. ',
+                b'Invoice INV-2024/117 is payable within 45 days. ']
+    jobs = []
+    for n, special in enumerate(specials):
+        key = handler.new_upload_key(f'doc{n}.txt', collection_id='team')
+        assert ingestion.upload_session(key) == 'collection#team'
+        s3.objects[key] = _clauses(10 + n, special, 40)
+        jobs.append(ingest(key))
+    assert [job['documents_count'] for job in jobs] == [1, 2, 3]
+    assert all(job['collection_id'] == 'team' and 'session_id' not in job for job in jobs)
+
+    loads = []
+    load = handler.load_document_index
+    monkeypatch.setattr(handler, 'load_document_index', lambda key: loads.append(key) or load(key))
+    prompts = []
+    monkeypatch.setattr(handler.bedrock_rag, 'invoke_titan', lambda prompt: prompts.append(prompt) or 'ok')
+    monkeypatch.setattr(handler, 'COLLECTION_CANDIDATES', 3)
+    status, body = call(handler.ask, collection_id='team', question='What does e-4031 mean?')
+    assert status == 200 and body['sources'][0]['filename'] == 'doc1.txt' and len(loads) == 3
+    passage = prompts[0].split('\n\n')[1]
+    assert passage.startswith('[doc1.txt] ') and 'E-4031' in passage
+
+    # only the routed candidates are loaded
+    loads.clear()
+    monkeypatch.setattr(handler, 'COLLECTION_CANDIDATES', 1)
+    assert call(handler.ask, collection_id='team', question='When is INV-2024/117 due?')[0] == 200
+    assert len(loads) == 1
+    assert call(handler.ask, collection_id='nobody', question='Anything?')[0] == 404
+
+    # deleting the collection releases its documents and routing index
+    item = sessions.items.pop('collection#team')
+    serializer = TypeSerializer()
+    remove = {'eventName': 'REMOVE', 'dynamodb': {'OldImage': {k: serializer.serialize(v) for k, v in item.items()}}}
+    assert handler.cleanup({'Records': [remove, remove]}, None) == {'batchItemFailures': []}
+    assert not [key for key in s3.objects if key.startswith('vector_stores/')]
+
+
+def test_multipart_upload_is_validated_and_ingested(pipeline, monkeypatch):
+    s3 = pipeline[0]
+    monkeypatch.setattr(handler, 'MULTIPART_PART_SIZE', 1000)
+    content = ' '.join(f"Câu số {i} của tài liệu lớn." for i in range(300)).encode('utf-8')
+
+    status, upload = call(handler.multipart_create, filename='big.txt', content_type='text/plain',
+                          size=len(content))
+    assert status == 200 and upload['part_count'] == -(-len(content) // 1000)
+    mpu = {'s3_key': upload['s3_key'], 'upload_id': upload['upload_id']}
+    numbers = list(range(1, upload['part_count'] + 1))
+    status, presigned = call(handler.multipart_parts, part_numbers=numbers, **mpu)
+    assert status == 200 and sorted(presigned['urls']) == sorted(map(str, numbers))
+
+    # parts arrive in any order; a failed part is simply uploaded again
+    parts = []
+    for n in reversed(numbers):
+        url = presigned['urls'][str(n)]
+        s3.upload_part(url, b'garbage')
+        etag = s3.upload_part(url, content[(n - 1) * 1000:n * 1000])
+        parts.append({'part_number': n, 'etag': etag})
+    assert call(handler.multipart_complete, parts=parts, **mpu)[0] == 200
+    assert s3.objects[upload['s3_key']] == content
+
+    job = ingest(upload['s3_key'])
+    assert job['status'] == 'succeeded' and job['chunks_count'] > 1
+
+
+def test_multipart_complete_enforces_size_limit(pipeline, monkeypatch):
+    s3 = pipeline[0]
+    monkeypatch.setattr(handler, 'MAX_TEXT_FILE_SIZE', 10)
+    # the declared size can lie; the parts are what counts
+    upload = call(handler.multipart_create, filename='a.txt', content_type='text/plain', size=5)[1]
+    mpu = {'s3_key': upload['s3_key'], 'upload_id': upload['upload_id']}
+    url = call(handler.multipart_parts, part_numbers=[1], **mpu)[1]['urls']['1']
+    etag = s3.upload_part(url, b'x' * 11)
+
+    status, body = call(handler.multipart_complete, parts=[{'part_number': 1, 'etag': etag}], **mpu)
+    assert status == 400 and 'exceeds' in body['error']
+    assert not s3.multipart and upload['s3_key'] not in s3.objects
+    assert call(handler.multipart_complete, parts=[{'part_number': 1, 'etag': etag}], **mpu)[0] == 404
+    assert call(handler.multipart_abort, **mpu)[0] == 200
+
+    assert call(handler.multipart_create, filename='a.txt', content_type='text/plain', size=11)[0] == 400
+    assert call(handler.multipart_create, filename='a.exe', content_type='text/plain')[0] == 400
+
+
+def test_multipart_requests_are_checked(pipeline):
+    s3 = pipeline[0]
+    upload = call(handler.multipart_create, filename='a.pdf', content_type='application/pdf')[1]
+    assert 'part_count' not in upload
+    mpu = {'s3_key': upload['s3_key'], 'upload_id': upload['upload_id']}
+
+    assert call(handler.multipart_parts, part_numbers=[1], s3_key='sessions/x', upload_id='u')[0] == 400
+    assert call(handler.multipart_parts, part_numbers=[], **mpu)[0] == 400
+    assert call(handler.multipart_parts, part_numbers=list(range(1, 102)), **mpu)[0] == 400
+    assert call(handler.multipart_parts, part_numbers=[0], **mpu)[0] == 400
+
+    url = call(handler.multipart_parts, part_numbers=[1], **mpu)[1]['urls']['1']
+    etag = s3.upload_part(url, b'%PDF')
+    missing = [{'part_number': 1, 'etag': etag}, {'part_number': 2, 'etag': etag}]
+    status, body = call(handler.multipart_complete, parts=missing, **mpu)
+    assert status == 400 and '[2]' in body['error']
+    assert call(handler.multipart_abort, **mpu)[0] == 200
+    assert not s3.multipart
+
+
+def test_cancel_stops_embedding_between_batches(pipeline, monkeypatch):
+    s3, sessions, bedrock = pipeline
+    s3.objects['uploads/x/big.txt'] = b''.join(b'Sentence number %d. ' % i for i in range(2000))
+    job_id = call(handler.upload, s3_key='uploads/x/big.txt')[1]['job_id']
+
+    batches = []
+    embed_texts = handler.bedrock_rag.embed_texts
+
+    def embed_then_cancel(texts, max_workers=None):
+        batches.append(len(texts))
+        if len(batches) == 1:
+            call(handler.cancel, job_id=job_id)
+        return embed_texts(texts, max_workers)
+
+    monkeypatch.setattr(handler.bedrock_rag, 'embed_texts', embed_then_cancel)
+    monkeypatch.setattr(handler, 'ingestion_worker', lambda: ingestion.IngestionWorker(
+        s3=s3, bucket=None, sessions=sessions, registry=handler.document_registry, jobs=handler.jobs,
+        rag=handler.bedrock_rag, tmp_cache=handler.tmp_cache, validate=lambda *a: True,
+        embed_batch_size=4))
+
+    handler.ingest(s3_event('uploads/x/big.txt'), None)
+    job = call(handler.status, job_id=job_id)[1]
+    # batches already in flight behind the first one still finish, nothing after them starts
+    assert job['status'] == 'cancelled' and len(batches) <= 1 + EMBED_PIPELINE_DEPTH
+    assert job['chunks_embedded'] == 4 and not sessions.items
+
+
+def test_cancel_queued_job_is_never_processed(pipeline):
+    s3, sessions, bedrock = pipeline
+    s3.objects['uploads/q/doc.txt'] = DOCUMENT
+    job_id = call(handler.upload, s3_key='uploads/q/doc.txt')[1]['job_id']
+    assert call(handler.cancel, job_id=job_id)[1]['status'] == 'cancelled'
+    handler.ingest(s3_event('uploads/q/doc.txt'), None)
+    assert bedrock.calls == 0
+
+
+def test_failures_are_recorded_on_the_job(pipeline):
+    s3, sessions, bedrock = pipeline
+    s3.objects['uploads/e/empty.txt'] = b'   '
+    job = ingest('uploads/e/empty.txt')
+    assert job['status'] == 'failed' and 'empty' in job['error']
+    assert call(handler.status, job_id='missing')[0] == 404
+
+
+def test_expired_lease_can_be_reclaimed():
+    clock = [1000]
+    jobs = ingestion.JobStore(FakeJobTable(), clock=lambda: clock[0])
+    jobs.create('j', 'uploads/a.txt', 'a.txt')
+    assert jobs.claim('j', 'first')
+    assert jobs.claim('j', 'second') is None
+    clock[0] += ingestion.JOB_LEASE_SECONDS + 1
+    assert jobs.claim('j', 'second')
+    with pytest.raises(ingestion.JobLeaseLost):
+        jobs.report('j', 'first', stage='embedding')
+
+
+@pytest.fixture
+def fanout(pipeline, monkeypatch):
+    """Fan-out past the first 16 chunks (two local batches), with batches held until delivered"""
+    queue = LocalQueue()
+    monkeypatch.setattr(handler, 'ingest_queue', queue)
+    monkeypatch.setattr(handler, 'EMBED_BATCH_SIZE', 8)
+    monkeypatch.setattr(handler, 'FANOUT_MIN_CHUNKS', 10)
+    monkeypatch.setattr(handler, 'FANOUT_BATCH_SIZE', 8)
+    return pipeline + (queue,)
+
+
+BIG = b''.join(b'Sentence number %d is here. ' % i for i in range(1500))
+
+
+def _index_texts(s3, sessions, job):
+    index = handler.load_index_bytes(s3.objects[sessions.items[job['session_id']]['s3_key']])
+    return index.texts, [index.vector(i) for i in range(len(index))]
+
+
+def test_fanout_matches_single_invocation(fanout, monkeypatch):
+    s3, sessions, bedrock, queue = fanout
+    s3.objects['uploads/a/big.txt'] = s3.objects['uploads/b/big2.txt'] = BIG
+
+    job = ingest('uploads/a/big.txt')
+    assert job['status'] == 'running' and job['stage'] == 'embedding'
+    assert job['chunks_embedded'] == 16
+    assert queue.sent == (job['chunks_total'] - 16) // 8 + ((job['chunks_total'] - 16) % 8 > 0)
+
+    # out-of-order delivery with every message duplicated
+    messages = list(queue.messages) * 2
+    random.Random(7).shuffle(messages)
+    worker = handler.ingestion_worker()
+    finished = [worker.run_batch(message) for message in messages]
+    assert sum(f is not None for f in finished) == 1
+
+    job = call(handler.status, job_id=job['job_id'])[1]
+    assert job['status'] == 'succeeded' and job['chunks_embedded'] == job['chunks_total']
+    assert not [key for key in s3.objects if key.startswith('jobs/')]
+
+    # same document through the single-invocation path (fresh settings -> no dedup)
+    monkeypatch.setattr(handler, 'FANOUT_MIN_CHUNKS', 10 ** 9)
+    handler.bedrock_rag.chunk_overlap += 1
+    single = ingest('uploads/b/big2.txt')
+    assert _index_texts(s3, sessions, job) == _index_texts(s3, sessions, single)
+
+
+def test_fanout_cancel_drops_remaining_batches(fanout):
+    s3, sessions, bedrock, queue = fanout
+    s3.objects['uploads/c/big.txt'] = BIG
+    job = ingest('uploads/c/big.txt')
+    worker = handler.ingestion_worker()
+    queue.deliver(worker.run_batch, limit=2)
+    calls = bedrock.calls
+
+    call(handler.cancel, job_id=job['job_id'])
+    queue.deliver(worker.run_batch)
+    assert bedrock.calls == calls
+    assert call(handler.status, job_id=job['job_id'])[1]['status'] == 'cancelled'
+    assert not sessions.items and not [key for key in s3.objects if key.startswith('jobs/')]
+
+
+def test_throttled_batch_is_left_for_redelivery(fanout, monkeypatch):
+    s3, sessions, bedrock, queue = fanout
+    s3.objects['uploads/d/big.txt'] = BIG
+    ingest('uploads/d/big.txt')
+
+    def busy(texts, max_workers=None):
+        raise ingestion.BedrockBusyError('throttled')
+
+    message = queue.messages[0]
+    monkeypatch.setattr(handler.bedrock_rag, 'embed_texts', busy)
+    response = handler.embed_batch({'Records': [{'messageId': 'm1', 'body': json.dumps(message)}]}, None)
+    assert response == {'batchItemFailures': [{'itemIdentifier': 'm1'}]}
+
+
+class FlakySQS:
+    """send_message_batch stand-in failing the listed entry ids, one list per call"""
+
+    def __init__(self, *failures):
+        self.failures = list(failures)
+        self.sent = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        failed = self.failures.pop(0) if self.failures else []
+        self.sent.append([e['Id'] for e in Entries])
+        return {'Failed': [dict(f, Id=i) for i, f in failed]}
+
+
+def test_sqs_failures_are_retried_with_backoff_then_raised():
+    busy = {'Code': 'InternalError', 'SenderFault': False}
+    delays = []
+    policy = RetryPolicy(max_attempts=3, sleep=delays.append, rng=lambda: 1.0)
+    sqs = FlakySQS([('1', busy), ('3', busy)], [('3', busy)])
+    SQSQueue(sqs, 'q', policy).send_many([{'batch': i} for i in range(4)])
+    assert sqs.sent == [['0', '1', '2', '3'], ['1', '3'], ['3']]
+    assert delays == [policy.backoff(0), policy.backoff(1)]
+
+    sqs = FlakySQS(*[[('0', busy)]] * 3)
+    with pytest.raises(RuntimeError, match='after 3 attempts'):
+        SQSQueue(sqs, 'q', policy).send_many([{'batch': 0}])
+
+    # a message SQS will never take is not resent
+    sqs = FlakySQS([('0', {'Code': 'InvalidParameterValue', 'SenderFault': True})])
+    with pytest.raises(RuntimeError, match='InvalidParameterValue'):
+        SQSQueue(sqs, 'q', NO_SLEEP).send_many([{'batch': 0}])
+    assert len(sqs.sent) == 1
+
+
+class Killed(BaseException):
+    """Simulated Lambda timeout/crash: not an Exception, so nothing handles it"""
+
+
+class Killer:
+    def __init__(self, at=None):
+        self.at = at
+        self.ops = 0
+
+    def wrap(self, target):
+        killer = self
+
+        class Crashy:
+            def __getattr__(self, name):
+                attr = getattr(target, name)
+                if not callable(attr) or isinstance(attr, type):
+                    return attr
+
+                def call(*args, **kwargs):
+                    killer.ops += 1
+                    if killer.at is not None and killer.ops == killer.at:
+                        raise Killed(name)
+                    return attr(*args, **kwargs)
+                return call
+        return Crashy()
+
+
+class Stack:
+    """One deployment's durable state (S3 + tables) and a fake Bedrock"""
+
+    def __init__(self, tmp_path):
+        self.s3, self.sessions, self.bedrock = UploadS3(), SessionTable(), FakeBedrock()
+        self.job_table, self.doc_table = FakeJobTable(), FakeDocumentTable()
+        self.tmp_path = tmp_path
+        self.extractions = 0
+        self.now = 1_000_000
+
+    def worker(self, killer):
+        """A fresh container: empty memory caches, every call may be the last"""
+        rag = BedrockRAG(bedrock_runtime=killer.wrap(self.bedrock), retry_policy=NO_SLEEP,
+                         embedding_cache=EmbeddingCache())
+        extract = rag.iter_pages
+
+        def counted_extract(source, progress=None, filename=None):
+            self.extractions += 1
+            return extract(source, progress, filename)
+        rag.iter_pages = counted_extract
+
+        return ingestion.IngestionWorker(
+            s3=killer.wrap(self.s3), bucket='b', sessions=killer.wrap(self.sessions),
+            registry=DocumentRegistry(killer.wrap(self.doc_table)),
+            jobs=ingestion.JobStore(killer.wrap(self.job_table), clock=lambda: self.now),
+            rag=rag, tmp_cache=TmpCache(str(self.tmp_path / 'cache')), validate=lambda *a: True,
+            embed_batch_size=4)
+
+    def index(self, job):
+        index = handler.load_index_bytes(self.s3.objects[self.sessions.items[job['session_id']]['s3_key']])
+        return index.texts, [index.vector(i) for i in range(len(index))]
+
+
+RESUMABLE = b''.join(b'Resumable sentence %d. ' % i for i in range(700))
+
+
+def _start(stack):
+    stack.s3.objects['uploads/r/doc.txt'] = RESUMABLE
+    jobs = ingestion.JobStore(stack.job_table, clock=lambda: stack.now)
+    return jobs.create(ingestion.job_id_for('uploads/r/doc.txt'), 'uploads/r/doc.txt', 'doc.txt')['job_id']
+
+
+def test_killed_runs_resume_from_last_checkpoint(tmp_path):
+    reference = Stack(tmp_path / 'reference')
+    counter = Killer()
+    expected = reference.worker(counter).run(_start(reference), owner='request-1')
+    assert expected['status'] == 'succeeded' and int(expected['batches_total']) > 3
+    expected_index = reference.index(expected)
+
+    # kill the run at every single S3/DynamoDB/Bedrock call it makes
+    for kill_at in range(1, counter.ops):
+        stack = Stack(tmp_path / f'kill-{kill_at}')
+        job_id = _start(stack)
+        with pytest.raises(Killed):
+            stack.worker(Killer(at=kill_at)).run(job_id, owner='request-1')
+        planned = stack.job_table.items[job_id].get('planned')
+
+        # Lambda's automatic retry of the same request resumes straight away
+        job = stack.worker(Killer()).run(job_id, owner='request-1')
+        assert job['status'] == 'succeeded', kill_at
+        assert stack.index(job) == expected_index
+        assert int(job['chunks_embedded']) == int(job['chunks_total'])
+
+        # at most the batches in flight are embedded twice, and a planned
+        # document is never extracted again
+        assert stack.bedrock.calls <= reference.bedrock.calls + 4 * (1 + EMBED_PIPELINE_DEPTH), kill_at
+        assert stack.extractions == 1 if planned else stack.extractions <= 2
+        assert not [key for key in stack.s3.objects if key.startswith('jobs/')]
+        assert len(stack.sessions.items) == 1
+        assert [doc['ref_count'] for doc in stack.doc_table.items.values()] == [1]
+
+
+def test_dead_workers_job_is_taken_over_after_lease(tmp_path):
+    stack = Stack(tmp_path)
+    job_id = _start(stack)
+    with pytest.raises(Killed):
+        stack.worker(Killer(at=40)).run(job_id, owner='request-1')
+
+    # a different request cannot take a live lease ...
+    assert stack.worker(Killer()).run(job_id, owner='request-2')['status'] == 'running'
+    # ... but can once it has expired
+    stack.now += ingestion.JOB_LEASE_SECONDS + 1
+    job = stack.worker(Killer()).run(job_id, owner='request-2')
+    assert job['status'] == 'succeeded' and stack.extractions <= 2
+
@@ -0,0 +1,80 @@
+"""
+Tests for the BM25 keyword index
+Run with: python -m pytest test_lexical_index.py
+"""
+import json
+
+import lexical_index
+from fakes import FakeBedrock
+from lexical_index import LexicalIndex, fold, tokenize
+from rag_bedrock import BedrockRAG
+from vector_index import serialize_index, load_index, load_index_bytes
+
+TEXTS = [
+    'Hợp đồng số HD-2023/045 quy định thời hạn thanh toán là 30 ngày.',
+    'Bên B chịu trách nhiệm bảo hành sản phẩm trong 12 tháng.',
+    'Thanh toán được thực hiện bằng chuyển khoản. Thanh toán trễ bị phạt 0.05% mỗi ngày.',
+    'Phụ lục A liệt kê danh mục thiết bị giao hàng.',
+]
+
+
+def test_tokens_are_folded_and_identifiers_kept_whole():
+    assert fold('Hợp Đồng ĐIỆN tử') == 'hop dong dien tu'
+    tokens = tokenize('Mã lỗi E_42 trong HD-2023/045.')
+    assert {'ma', 'loi', 'e', '42', 'e_42', 'hd', '2023', '045', 'hd-2023/045'} <= set(tokens)
+    assert 'hd-2023/045.' not in tokens
+
+
+def test_bm25_ranks_by_term_rarity_and_frequency():
+    index = LexicalIndex.build(TEXTS)
+    # "thanh toán" twice in chunk 2, once in chunk 0
+    assert [doc for doc, _ in index.search('thanh toan', 2)] == [2, 0]
+    # a rare term outweighs a common one
+    assert index.search('thanh toán bảo hành', 1)[0][0] == 1
+    assert index.search('HD-2023/045', 1)[0][0] == 0
+    assert index.search('không có từ nào khớp') == []
+    assert index.search('') == []
+
+    scores = index.scores('giao hàng')
+    assert set(scores) == {3} and scores[3] > 0
+
+
+def test_ties_keep_document_order():
+    index = LexicalIndex.build(['alpha beta', 'gamma', 'alpha beta', 'alpha beta'])
+    assert index.search('alpha', 3) == sorted(index.search('alpha', 3), key=lambda item: item[0])
+
+
+def test_index_is_stored_with_the_vectors(tmp_path):
+    embeddings = [[float(n), 1.0] for n in range(len(TEXTS))]
+    path = tmp_path / 'doc.idx'
+    path.write_bytes(serialize_index(TEXTS, embeddings, lexical=True))
+
+    index = load_index(str(path))
+    assert index.has_lexical
+    expected = LexicalIndex.build(TEXTS)
+    for query in ('thanh toán', 'bảo hành 12 tháng', 'HD-2023/045', 'phụ lục'):
+        assert index.lexical_search(query, 4) == expected.search(query, 4)
+    index.close()
+
+
+def test_indexes_without_one_build_it_on_first_use(monkeypatch):
+    plain = load_index_bytes(serialize_index(TEXTS, [[1.0]] * len(TEXTS)))
+    assert not plain.has_lexical
+    assert plain.lexical_search('bảo hành', 1)[0][0] == 1
+
+    legacy = load_index_bytes(json.dumps({'texts': TEXTS, 'embeddings': [[1.0]] * len(TEXTS)}).encode())
+    assert legacy.lexical_search('HD-2023/045', 1)[0][0] == 0
+
+    # an index written by another tokenizer version is not trusted
+    stored = serialize_index(TEXTS, [[1.0]] * len(TEXTS), lexical=True)
+    monkeypatch.setattr(lexical_index, 'TOKENIZER_VERSION', 'fold-0')
+    assert not load_index_bytes(stored).has_lexical
+
+
+def test_fallback_search_without_embeddings():
+    rag = BedrockRAG(bedrock_runtime=FakeBedrock())
+    chunks = [{'page_content': text} for text in TEXTS]
+    store = {'chunks': chunks, 'texts': TEXTS, 'embeddings': []}
+    assert rag.fallback_search(store, 'thời hạn thanh toán', 2) == [chunks[0], chunks[2]]
+    assert 'lexical' in store
+    assert rag.fallback_search(store, 'xyz', 2) == []
@@ -0,0 +1,59 @@
+"""
+Tests for the extracted-page cache
+Run with: python -m pytest test_page_cache.py
+"""
+import hashlib
+
+import handler
+from bench_pdf_extract import write_synthetic_pdf
+from document_registry import hex_to_checksum
+from fakes import UploadS3, ingest
+from page_cache import PageCache, PageRecorder, page_cache_key
+
+
+def test_recorded_pages_round_trip():
+    cache = PageCache(UploadS3(), 'b')
+    pages = ['Trang một có dấu.\n', '', 'Page three.\n']
+    recorder = PageRecorder()
+    assert list(recorder.record(pages)) == pages
+    assert cache.put('abc', recorder)
+
+    seen = []
+    assert list(cache.get('abc', progress=lambda *a: seen.append(a))) == pages
+    assert seen == [(1, 3), (2, 3), (3, 3)]
+    assert cache.get('other') is None
+
+
+def test_partial_extraction_is_not_cached():
+    s3 = UploadS3()
+    recorder = PageRecorder()
+    pages = recorder.record(iter(['one\n', 'two\n']))
+    next(pages)
+    assert not PageCache(s3, 'b').put('abc', recorder)
+    assert page_cache_key('abc') not in s3.objects
+
+
+def test_rechunking_starts_from_cached_pages(pipeline, tmp_path, monkeypatch):
+    s3, sessions, bedrock = pipeline
+    path = tmp_path / 'doc.pdf'
+    write_synthetic_pdf(str(path), pages=6, lines_per_page=30)
+    data = path.read_bytes()
+    s3.objects['uploads/a/doc.pdf'] = s3.objects['uploads/b/doc.pdf'] = data
+    s3.checksums['uploads/b/doc.pdf'] = hex_to_checksum(hashlib.sha256(data).hexdigest())
+
+    extractions = []
+    iter_pages = handler.bedrock_rag.iter_pages
+    monkeypatch.setattr(handler.bedrock_rag, 'iter_pages',
+                        lambda *a, **kw: extractions.append(a) or iter_pages(*a, **kw))
+
+    first = ingest('uploads/a/doc.pdf')
+    assert first['status'] == 'succeeded' and len(extractions) == 1
+    assert page_cache_key(hashlib.sha256(data).hexdigest()) in s3.objects
+
+    # new chunking: a new index, built from the cached pages without reading the PDF
+    handler.bedrock_rag.chunk_size = 100
+    downloads = s3.downloads
+    second = ingest('uploads/b/doc.pdf')
+    assert second['status'] == 'succeeded' and 'deduplicated' not in second
+    assert second['pages_total'] == 6 and second['chunks_count'] > first['chunks_count']
+    assert len(extractions) == 1 and s3.downloads == downloads
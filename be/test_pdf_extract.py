@@ -0,0 +1,46 @@
+"""
+Tests for parallel PDF page extraction
+Run with: python -m pytest test_pdf_extract.py
+"""
+import pytest
+
+import pdf_extract
+from bench_pdf_extract import write_synthetic_pdf
+
+
+@pytest.fixture(scope='module')
+def pdf(tmp_path_factory):
+    path = tmp_path_factory.mktemp('pdf') / 'doc.pdf'
+    write_synthetic_pdf(str(path), pages=21, lines_per_page=5)
+    return str(path)
+
+
+def test_parallel_extraction_keeps_page_order(pdf):
+    serial = list(pdf_extract.iter_pdf_pages(pdf, processes=1))
+    assert len(serial) == 21 and serial[20].startswith('Page 21.')
+
+    calls = []
+    parallel = list(pdf_extract.iter_pdf_pages(pdf, progress=lambda *a: calls.append(a), processes=3,
+                                               min_pages=0, block_pages=2))
+    assert parallel == serial
+    assert calls == [(n, 21) for n in range(1, 22)]
+
+
+def test_small_documents_stay_serial(pdf, monkeypatch):
+    def no_processes(*args):
+        raise AssertionError('started worker processes')
+
+    monkeypatch.setattr(pdf_extract, '_iter_parallel', no_processes)
+    assert len(list(pdf_extract.iter_pdf_pages(pdf, processes=4, min_pages=64))) == 21
+
+
+def test_consumer_can_stop_early(pdf):
+    pages = pdf_extract.iter_pdf_pages(pdf, processes=2, min_pages=0, block_pages=1)
+    assert next(pages).startswith('Page 1.')
+    pages.close()  # joins or terminates the workers
+
+
+def test_worker_errors_surface(tmp_path):
+    pages = pdf_extract._iter_parallel(str(tmp_path / 'missing.pdf'), 4, 2, 2)
+    with pytest.raises(RuntimeError, match='PDF extraction failed'):
+        list(pages)
@@ -0,0 +1,225 @@
+"""
+Tests for BedrockRAG ingestion helpers (no AWS access needed)
+Run with: python -m pytest test_rag_bedrock.py
+"""
+import io
+import random
+
+import pytest
+from botocore.exceptions import ClientError
+
+import rag_bedrock
+from embedding_cache import DynamoDBEmbeddingStore, EmbeddingCache, LocalEmbeddingStore, cache_key, pack_embedding
+from fakes import NO_SLEEP, FakeBedrock
+from rag_bedrock import BedrockRAG
+from rate_control import AIMDController, BedrockBusyError, RetryPolicy, classify_error
+
+
+def _client_error(code, status=400):
+    return ClientError({'Error': {'Code': code, 'Message': code},
+                        'ResponseMetadata': {'HTTPStatusCode': status}}, 'InvokeModel')
+
+
+def test_embed_texts_keeps_order_and_bounds_concurrency():
+    client = FakeBedrock(latency=0.01)
+    rag = BedrockRAG(bedrock_runtime=client, embed_concurrency=4, embed_max_concurrency=4)
+    texts = ['a' * n for n in range(1, 41)]
+
+    embeddings = rag.embed_texts(texts)
+
+    assert [e[0] for e in embeddings] == [float(n) for n in range(1, 41)]
+    assert 1 < client.peak <= 4
+
+
+def test_embed_texts_serial_and_failed_chunks():
+    rag = BedrockRAG(bedrock_runtime=FakeBedrock(), embed_concurrency=1)
+    assert rag.embed_texts(['ab', '  ', 'c']) == [[2.0, 1.0], None, [1.0, 1.0]]
+
+
+def test_classify_error():
+    assert classify_error(_client_error('ThrottlingException')) == 'throttle'
+    assert classify_error(_client_error('Whatever', 429)) == 'throttle'
+    assert classify_error(_client_error('ModelTimeoutException', 408)) == 'transient'
+    assert classify_error(_client_error('InternalServerException', 500)) == 'transient'
+    assert classify_error(_client_error('ValidationException')) == 'fatal'
+    assert classify_error(KeyError('embedding')) == 'fatal'
+
+
+def test_aimd_additive_increase_multiplicative_decrease():
+    now = [0.0]
+    controller = AIMDController(initial=8, maximum=16, cooldown=1.0, clock=lambda: now[0])
+    for _ in range(8):
+        controller.on_success()
+    assert 8.9 < controller.limit < 9.0
+
+    before = controller.limit
+    controller.on_throttle()
+    controller.on_throttle()  # same congestion event: only one decrease
+    assert controller.limit == pytest.approx(before / 2)
+    now[0] += 2
+    controller.on_throttle()
+    assert controller.limit < 2.3
+    for _ in range(50):
+        controller.on_throttle()
+        now[0] += 2
+    assert controller.limit == 1
+
+
+def test_throttles_are_retried_not_stored_as_empty():
+    client = FakeBedrock(failures=[_client_error('ThrottlingException')] * 3)
+    rag = BedrockRAG(bedrock_runtime=client, retry_policy=NO_SLEEP)
+    assert rag.get_titan_embedding('abc') == [3.0, 1.0]
+    assert client.calls == 4
+    assert rag.controller('amazon.titan-embed-text-v1').throttles == 3
+
+
+def test_persistent_throttling_raises_busy():
+    client = FakeBedrock(failures=[_client_error('ThrottlingException')] * 100)
+    rag = BedrockRAG(bedrock_runtime=client, retry_policy=RetryPolicy(max_attempts=3, sleep=lambda s: None))
+    with pytest.raises(BedrockBusyError):
+        rag.embed_texts(['a', 'b', 'c'])
+    with pytest.raises(BedrockBusyError):
+        rag.invoke_titan('hello')
+
+
+def test_bad_input_is_not_retried():
+    client = FakeBedrock(failures=[_client_error('ValidationException')])
+    rag = BedrockRAG(bedrock_runtime=client, retry_policy=NO_SLEEP)
+    assert rag.get_titan_embedding('abc') is None
+    assert client.calls == 1
+
+
+def test_embeddings_are_shared_across_sessions_via_durable_cache():
+    durable = LocalEmbeddingStore()
+    texts = ['Điều 1. Phạm vi', 'Điều 2. Đối tượng', 'Điều 1. Phạm vi']
+
+    first = FakeBedrock()
+    rag = BedrockRAG(bedrock_runtime=first, embedding_cache=EmbeddingCache(durable))
+    embeddings = rag.embed_texts(texts)
+    assert first.calls == 2  # the repeated chunk is embedded once
+    assert embeddings[0] == embeddings[2]
+
+    # a cold container (empty memory tier) re-uploading the same document
+    second = FakeBedrock()
+    rag = BedrockRAG(bedrock_runtime=second, embedding_cache=EmbeddingCache(durable))
+    assert rag.embed_texts(['Điều 1.  Phạm vi ', 'Điều 2. Đối tượng']) == embeddings[:2]
+    assert second.calls == 0
+    assert rag.embedding_cache.stats() == {
+        'memory_hits': 0, 'durable_hits': 2, 'misses': 0, 'hit_rate': 1.0}
+
+    # question embeddings skip the cache entirely
+    assert rag.get_titan_embedding('Điều 2. Đối tượng') == embeddings[1]
+    assert second.calls == 1 and rag.embedding_cache.stats()['memory_hits'] == 0
+
+
+def test_cache_key_depends_on_model_and_normalised_text():
+    assert cache_key('m', 'a  b\n') == cache_key('m', 'a b')
+    assert cache_key('m', 'a b') != cache_key('other', 'a b')
+
+
+def test_durable_failures_do_not_break_embedding():
+    class Broken:
+        def get_many(self, keys):
+            raise RuntimeError('dynamodb down')
+
+        def put_many(self, entries):
+            raise RuntimeError('dynamodb down')
+
+    rag = BedrockRAG(bedrock_runtime=FakeBedrock(), embedding_cache=EmbeddingCache(Broken()))
+    assert rag.embed_texts(['abc']) == [[3.0, 1.0]]
+
+
+def test_unprocessed_keys_are_retried_with_backoff_then_missed():
+    class ThrottledDynamoDB:
+        """Serves one key per batch_get_item and leaves the rest unprocessed"""
+
+        def __init__(self, items):
+            self.items = items
+            self.calls = 0
+
+        def Table(self, name):
+            return None
+
+        def batch_get_item(self, RequestItems):
+            self.calls += 1
+            request = RequestItems['t']
+            first, rest = request['Keys'][0], request['Keys'][1:]
+            unprocessed = {'t': dict(request, Keys=rest)} if rest else {}
+            return {'Responses': {'t': [self.items[first['cache_key']]]}, 'UnprocessedKeys': unprocessed}
+
+    items = {k: {'cache_key': k, 'embedding': pack_embedding([float(i)])} for i, k in enumerate('abcdef')}
+    delays = []
+    policy = RetryPolicy(max_attempts=3, sleep=delays.append, rng=lambda: 1.0)
+    dynamodb = ThrottledDynamoDB(items)
+    store = DynamoDBEmbeddingStore(dynamodb, 't', retry_policy=policy)
+    assert store.get_many('ab') == {'a': [0.0], 'b': [1.0]}
+    assert dynamodb.calls == 2 and delays == [policy.backoff(0)]
+
+    # still throttled after max_attempts reads: the rest are misses
+    assert sorted(store.get_many('abcdef')) == ['a', 'b', 'c']
+    assert dynamodb.calls == 5 and delays[1:] == [policy.backoff(0), policy.backoff(1)]
+
+
+def test_streaming_chunks_match_whole_text_split():
+    rag = BedrockRAG(bedrock_runtime=FakeBedrock(), embedding_cache=EmbeddingCache())
+    rng = random.Random(3)
+
+    def words(n):
+        return ''.join(' w%d' % rng.randrange(10 ** 6) for _ in range(n))
+
+    text = ''.join(rng.choice(['Câu số %d' % i, 'Why %d?!' % i, '...', words(rng.randint(1, 60)), '\n'])
+                   for i in range(3000))
+    expected = rag._split_text(text)
+    assert len(expected) > 10
+
+    # sentences and runs of '.' split across arbitrary page/block boundaries
+    cuts = sorted(rng.sample(range(1, len(text)), 400))
+    pieces = [text[a:b] for a, b in zip([0] + cuts, cuts + [len(text)])]
+    assert list(rag.iter_chunks(pieces)) == expected
+    assert all(text[c['start']:c['end']] == c['page_content'] for c in expected)
+
+
+def test_text_files_are_read_in_blocks(tmp_path, monkeypatch):
+    monkeypatch.setattr(rag_bedrock, 'TEXT_BLOCK_BYTES', 100)
+    path = tmp_path / 'doc.txt'
+    text = 'Một câu tiếng Việt có dấu. ' * 500
+    path.write_text(text, encoding='utf-8')
+    rag = BedrockRAG(bedrock_runtime=FakeBedrock(), embedding_cache=EmbeddingCache())
+
+    pieces = list(rag.iter_pages(str(path)))
+    assert len(pieces) == -(-len(text.encode('utf-8')) // 100) and ''.join(pieces) == text
+    assert rag.load_and_split_document(str(path)) == rag._split_text(text)
+
+
+def test_multibyte_characters_split_across_blocks():
+    text = 'Tiếng Việt có dấu: ạ ệ ữ ỹ. Emoji 📄 cũng vậy! ' * 50
+    data = text.encode('utf-8')
+    for block_bytes in range(1, 8):
+        assert ''.join(rag_bedrock.iter_text_blocks(data, block_bytes)) == text
+        assert ''.join(rag_bedrock.iter_text_blocks(io.BytesIO(data), block_bytes)) == text
+    with pytest.raises(UnicodeDecodeError):
+        list(rag_bedrock.iter_text_blocks(data[:-2] + b'\xff', 16))
+
+
+def test_embedding_overlaps_with_extraction():
+    rag = BedrockRAG(bedrock_runtime=FakeBedrock(latency=0.02), retry_policy=NO_SLEEP,
+                     embedding_cache=EmbeddingCache())
+    produced = []
+
+    def batches():
+        for n in range(6):
+            produced.append(n)
+            yield [f'batch {n} chunk {i}' for i in range(3)]
+
+    seen = []
+    for n, (texts, embeddings) in enumerate(rag.embed_batches(batches(), max_pending=2, skip=lambda n: n == 1)):
+        # later batches were already extracted (and submitted) when this one came back
+        seen.append(len(produced) - n)
+        assert texts[0].startswith(f'batch {n} ')
+        if n == 1:
+            assert embeddings is None
+        else:
+            assert embeddings == [[float(len(text)), 1.0] for text in texts]
+    assert n == 5 and max(seen) >= 2
+    # bounded window: never more than max_pending batches ahead of the consumer
+    assert max(seen) <= 3
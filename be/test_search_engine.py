@@ -0,0 +1,146 @@
+"""
+Tests for the shared vector search engine
+Run with: python -m pytest test_search_engine.py
+"""
+import math
+import random
+import threading
+import time
+
+import pytest
+
+import search_engine
+import vector_index
+from rag_bedrock import BedrockRAG
+from search_engine import VectorSet, fuse, hybrid_search, top_k
+from vector_index import serialize_index, load_index_bytes
+
+
+# The ranking code this engine replaced, kept verbatim as the reference
+def _old_cosine(a, b):
+    if not a or not b:
+        return -1
+    dot = sum(x*y for x,y in zip(a,b))
+    norm_a = math.sqrt(sum(x*x for x in a))
+    norm_b = math.sqrt(sum(x*x for x in b))
+    if norm_a==0 or norm_b==0:
+        return -1
+    return dot/(norm_a*norm_b)
+
+
+def _old_ranking(query, embeddings, k):
+    scores = [(i, _old_cosine(query, emb)) for i, emb in enumerate(embeddings)]
+    scores = sorted(scores, key=lambda x: x[1], reverse=True)
+    return [i for i, _ in scores[:k]]
+
+
+def _corpus(seed, n=200, dim=24):
+    rng = random.Random(seed)
+    embeddings = [[rng.gauss(0, 1) for _ in range(dim)] for _ in range(n)]
+    for i in rng.sample(range(n), 5):
+        embeddings[i] = []  # failed embeddings score -1
+    embeddings[11] = list(embeddings[12] or [1.0] * dim)  # exact tie
+    return embeddings, [rng.gauss(0, 1) for _ in range(dim)]
+
+
+@pytest.fixture(params=['numpy', 'python'])
+def backend(request, monkeypatch):
+    if request.param == 'python':
+        monkeypatch.setattr(search_engine, 'np', None)
+        monkeypatch.setattr(vector_index, 'np', None)
+    return request.param
+
+
+def test_top_k_matches_stable_sort(backend):
+    rng = random.Random(3)
+    scores = [rng.choice([-1, 0.25, 0.5, 0.75, rng.random()]) for _ in range(300)]
+    for k in (1, 3, 10, 299, 300, 500):
+        expected = sorted(enumerate(scores), key=lambda x: x[1], reverse=True)[:k]
+        assert top_k(scores, k) == expected
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_index_ranking_identical_to_old_loop(backend, seed):
+    embeddings, query = _corpus(seed)
+    index = load_index_bytes(serialize_index([''] * len(embeddings), embeddings))
+    for k in (3, 10):
+        got = [i for i, _ in search_engine.search(index, query, k)]
+        assert got == _old_ranking(query, embeddings, k)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_vector_set_ranking_identical_to_old_loop(backend, seed):
+    embeddings, query = _corpus(seed)
+    got = [i for i, _ in search_engine.search(VectorSet(embeddings), query, 3)]
+    assert got == _old_ranking(query, embeddings, 3)
+
+    # a query of the wrong size scores everything -1, i.e. original order
+    got = [i for i, _ in search_engine.search(VectorSet(embeddings), query[:5], 3)]
+    assert got == [0, 1, 2]
+
+
+def test_float16_rows_are_scored_block_by_block(monkeypatch):
+    np = pytest.importorskip('numpy')
+    embeddings, query = _corpus(7, n=50)
+    index = load_index_bytes(serialize_index([''] * len(embeddings), embeddings, quantization='float16'))
+    whole = [i for i, _ in search_engine.search(index, query, 10)]
+    monkeypatch.setattr(search_engine, 'SCORE_BLOCK_ROWS', 8)
+    assert [i for i, _ in search_engine.search(index, query, 10)] == whole
+    rows = index.matrix()
+    q = np.asarray(search_engine.unit_vector(query), dtype=np.float32)
+    assert np.allclose(search_engine._matvec(rows, q), rows.astype(np.float32) @ q)
+
+
+def test_similarity_search_uses_engine(backend):
+    embeddings, query = _corpus(0, n=30)
+    rag = BedrockRAG()
+    rag.get_titan_embedding = lambda text: query
+    chunks = [{'page_content': f'chunk {i}'} for i in range(len(embeddings))]
+    store = {
+        'chunks': chunks,
+        'texts': [c['page_content'] for c in chunks],
+        'embeddings': embeddings,
+        'vectors': VectorSet(embeddings),
+    }
+
+    expected = [chunks[i] for i in _old_ranking(query, embeddings, 3)
+                if _old_cosine(query, embeddings[i]) > 0]
+    assert rag.similarity_search(store, 'q') == expected
+    del store['vectors']
+    assert rag.similarity_search(store, 'q') == expected
+
+
+def test_fuse_adds_reciprocal_ranks():
+    vector = [(4, 0.9), (1, 0.8), (7, 0.1)]
+    keywords = [(1, 12.0), (9, 3.0)]
+    fused = fuse([vector, keywords], k=4, rrf_k=60)
+    assert [row for row, _ in fused] == [1, 4, 9, 7]
+    assert fused[0][1] == pytest.approx(1 / 62 + 1 / 61)
+
+    # weights shift the balance, ties go to the lower row
+    assert fuse([vector, keywords], k=1, weights=[1.0, 3.0])[0][0] == 1
+    assert fuse([vector, keywords], k=1, weights=[3.0, 0.0])[0][0] == 4
+    assert fuse([[(5, 1.0)], [(2, 1.0)]], k=2) == [(2, 1 / 61), (5, 1 / 61)]
+    assert fuse([[], []]) == []
+
+
+def test_hybrid_search_runs_both_searches_at_once():
+    threads = set()
+
+    def searcher(ranking):
+        def search(n):
+            threads.add(threading.get_ident())
+            time.sleep(0.2)
+            return ranking[:n]
+        return search
+
+    start = time.perf_counter()
+    fused = hybrid_search(searcher([(3, 0.9), (0, 0.5)]), searcher([(0, 7.0), (8, 1.0)]), k=2)
+    assert time.perf_counter() - start < 0.35
+    assert len(threads) == 2 and [row for row, _ in fused] == [0, 3]
+
+    def unused(n):
+        raise AssertionError("a search with weight 0 must not run")
+
+    assert hybrid_search(searcher([(3, 0.9)]), unused, k=1, weights=(1.0, 0.0)) == [(3, 1 / 61)]
+    assert hybrid_search(unused, searcher([(8, 1.0)]), k=1, weights=(0.0, 2.0)) == [(8, 2 / 61)]
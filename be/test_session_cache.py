@@ -0,0 +1,191 @@
+"""
+Tests for the warm session/index cache
+Run with: python -m pytest test_session_cache.py
+"""
+import io
+import os
+
+import pytest
+from botocore.exceptions import ClientError
+
+import handler
+from session_cache import SessionCache, ENTRY_OVERHEAD
+from tmp_cache import TmpCache
+from vector_index import serialize_index
+
+
+class FakeIndex:
+    def __init__(self, nbytes):
+        self.nbytes = nbytes
+
+
+class Clock:
+    def __init__(self, now=1_000_000):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def _session(expires_at=2_000_000):
+    return {'session_id': 's', 's3_key': 'vector_stores/s.idx', 'expires_at': expires_at}
+
+
+def test_lru_evicts_least_recently_used_within_budget():
+    cache = SessionCache(3 * (100 + ENTRY_OVERHEAD), clock=Clock())
+    for sid in 'abc':
+        cache.put(sid, _session(), FakeIndex(100), 'k', 'e')
+    cache.get('a')
+    cache.put('d', _session(), FakeIndex(100), 'k', 'e')
+    assert 'b' not in cache and {'a', 'c', 'd'} <= set(cache._entries)
+    assert cache.current_bytes <= cache.max_bytes
+
+
+def test_lfu_evicts_least_frequently_used():
+    cache = SessionCache(2 * (100 + ENTRY_OVERHEAD), policy='lfu', clock=Clock())
+    cache.put('a', _session(), FakeIndex(100), 'k', 'e')
+    cache.put('b', _session(), FakeIndex(100), 'k', 'e')
+    for _ in range(3):
+        cache.get('a')
+    cache.get('b')
+    cache.put('c', _session(), FakeIndex(100), 'k', 'e')
+    assert 'a' in cache and 'b' not in cache
+
+
+def test_expired_sessions_are_not_served():
+    clock = Clock()
+    cache = SessionCache(10 ** 6, clock=clock)
+    cache.put('a', _session(expires_at=clock.now + 10), FakeIndex(10), 'k', 'e')
+    assert cache.get('a') is not None
+    clock.now += 11
+    assert cache.get('a') is None and len(cache) == 0
+
+
+def test_oversized_entries_are_not_cached():
+    cache = SessionCache(1000, clock=Clock())
+    cache.put('a', _session(), FakeIndex(10 ** 6), 'k', 'e')
+    assert len(cache) == 0
+
+
+class FakeTable:
+    def __init__(self, item):
+        self.item = item
+        self.calls = 0
+
+    def get_item(self, Key):
+        self.calls += 1
+        return {'Item': self.item} if self.item else {}
+
+
+class FakeS3:
+    def __init__(self, body, etag='"v1"'):
+        self.body, self.etag = body, etag
+        self.calls = []
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        self.calls.append(IfNoneMatch)
+        if IfNoneMatch == self.etag:
+            raise ClientError({'Error': {'Code': '304', 'Message': 'Not Modified'},
+                               'ResponseMetadata': {'HTTPStatusCode': 304}}, 'GetObject')
+        return {'Body': io.BytesIO(self.body), 'ETag': self.etag, 'ContentLength': len(self.body)}
+
+
+@pytest.fixture
+def warm(monkeypatch, tmp_path):
+    clock = Clock(now=handler.datetime.now().timestamp())
+    session = _session(expires_at=int(clock.now) + 3600)
+    fakes = FakeTable(session), FakeS3(serialize_index(['a', 'b'], [[1.0, 0.0], [0.0, 1.0]]))
+    monkeypatch.setattr(handler, 'table', fakes[0])
+    monkeypatch.setattr(handler, 's3', fakes[1])
+    monkeypatch.setattr(handler, 'session_cache', SessionCache(10 ** 8, revalidate_after=60, clock=clock))
+    monkeypatch.setattr(handler, 'tmp_cache', TmpCache(str(tmp_path), quota_bytes=10 ** 6))
+    return clock, fakes
+
+
+def test_repeat_questions_skip_round_trips(warm):
+    clock, (table, s3) = warm
+    session, index = handler.load_session_index('s')
+    assert index.texts == ['a', 'b']
+    for _ in range(5):
+        assert handler.load_session_index('s')[1] is index
+    assert table.calls == 1 and s3.calls == [None]
+
+
+def test_stale_entry_revalidates_with_etag(warm):
+    clock, (table, s3) = warm
+    _, index = handler.load_session_index('s')
+    clock.now += 61
+    assert handler.load_session_index('s')[1] is index
+    # the record is read again: adding a document moves the session to another index
+    assert s3.calls == [None, '"v1"'] and table.calls == 2
+
+    clock.now += 61
+    s3.etag, s3.body = '"v2"', serialize_index(['c'], [[1.0, 1.0]])
+    _, fresh = handler.load_session_index('s')
+    assert fresh.texts == ['c']
+
+
+def test_stale_entry_follows_the_record_to_a_new_index(warm):
+    clock, (table, s3) = warm
+    handler.load_session_index('s')
+    table.item = dict(table.item, s3_key='vector_stores/sessions/s/2-abc.idx')
+    s3.etag, s3.body = '"m"', serialize_index(['a', 'b', 'c'], [[1.0, 0.0], [0.0, 1.0], [1.0, 1.0]])
+    clock.now += 61
+    session, index = handler.load_session_index('s')
+    assert session['s3_key'].endswith('2-abc.idx') and index.texts == ['a', 'b', 'c']
+    assert s3.calls[-1] is None  # a different key is downloaded, not revalidated
+
+
+def test_expired_session_record_is_rejected(warm):
+    clock, (table, s3) = warm
+    table.item['expires_at'] = int(clock.now) - 1
+    assert handler.load_session_index('s') == (None, None)
+
+
+def test_cold_container_serves_index_from_tmp(warm, monkeypatch):
+    clock, (table, s3) = warm
+    handler.load_session_index('s')
+    # a new invocation without the in-memory entry, same /tmp
+    monkeypatch.setattr(handler, 'session_cache', SessionCache(10 ** 8, clock=clock))
+    _, index = handler.load_session_index('s')
+    assert index.texts == ['a', 'b']
+    assert s3.calls == [None, '"v1"']
+
+
+def test_tmp_cache_keys_by_etag_and_keeps_latest(tmp_path):
+    cache = TmpCache(str(tmp_path), quota_bytes=10 ** 6)
+    first = cache.put_bytes('vector_stores/a.idx', '"1"', b'one')
+    assert cache.get('vector_stores/a.idx', '"1"') == first
+    assert cache.lookup('vector_stores/a.idx') == (first, '"1"')
+
+    second = cache.put_bytes('vector_stores/a.idx', '"2"', b'two')
+    assert cache.get('vector_stores/a.idx', '"1"') is None
+    assert cache.lookup('vector_stores/a.idx') == (second, '"2"')
+    assert cache.lookup('vector_stores/b.idx') == (None, None)
+
+
+def test_tmp_cache_evicts_stale_large_files_first(tmp_path):
+    clock = Clock()
+    cache = TmpCache(str(tmp_path), quota_bytes=1000, clock=clock)
+    cache.put_bytes('old-big', 'e', b'x' * 400)
+    cache.put_bytes('old-small', 'e', b'x' * 100)
+    clock.now += 100
+    cache.put_bytes('recent', 'e', b'x' * 300)
+    clock.now += 1
+    cache.put_bytes('new', 'e', b'x' * 400)
+
+    assert cache.get('old-big', 'e') is None
+    assert cache.get('old-small', 'e') and cache.get('recent', 'e') and cache.get('new', 'e')
+    assert cache.usage() <= 1000
+    assert cache.put_bytes('huge', 'e', b'x' * 2000) is None
+
+
+def test_scratch_paths_are_unique_and_swept(tmp_path):
+    clock = Clock()
+    cache = TmpCache(str(tmp_path), clock=clock)
+    a, b = cache.scratch_path('report.pdf'), cache.scratch_path('report.pdf')
+    assert a != b and a.endswith('report.pdf')
+    open(a, 'w').close()
+    os.utime(a, (clock.now - 1000, clock.now - 1000))
+    cache.sweep_scratch()
+    assert not os.path.exists(a)
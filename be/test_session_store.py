@@ -0,0 +1,85 @@
+"""
+Tests for multi-document sessions
+Run with: python -m pytest test_session_store.py
+"""
+import pytest
+
+from fakes import SessionTable, UploadS3
+from session_store import MERGED_INDEX_PREFIX, SessionStore, is_merged_index, session_documents
+
+
+def _document(name, chunks=2, doc_key=None):
+    document = {'document_id': name, 'filename': f'{name}.txt', 'chunks_count': chunks,
+                'index_key': f'vector_stores/{name}.idx'}
+    if doc_key:
+        document['doc_key'] = doc_key
+    return document
+
+
+def _store(now=1000.0):
+    clock = [now]
+    store = SessionStore(SessionTable(), UploadS3(), 'b', ttl_hours=1, clock=lambda: clock[0])
+    return store, clock
+
+
+def _build(documents, metadata):
+    return repr((documents, metadata)).encode()
+
+
+def test_documents_are_appended_behind_one_merged_index():
+    store, _ = _store()
+    first = store.create('s', _document('s', doc_key='k1'))
+    assert first['s3_key'] == 'vector_stores/s.idx' and first['doc_key'] == 'k1'
+
+    built = []
+    item = store.add('s', _document('d2', chunks=3), lambda docs, meta: built.append(meta) or b'merged')
+    assert [d['document_id'] for d in session_documents(item)] == ['s', 'd2']
+    assert is_merged_index(item['s3_key']) and store.s3.objects[item['s3_key']] == b'merged'
+    assert item['chunks_count'] == 5 and 'doc_key' not in item
+    assert built[0]['documents'][1] == {'document_id': 'd2', 'filename': 'd2.txt', 'start': 2, 'count': 3}
+
+    # the previous merged index is replaced; adding a held document again is a no-op
+    third = store.add('s', _document('d3'), _build)
+    assert item['s3_key'] not in store.s3.objects and third['documents_version'] == 3
+    assert store.add('s', _document('d3'), _build) == third
+    assert len([key for key in store.s3.objects if key.startswith(MERGED_INDEX_PREFIX)]) == 1
+
+
+def test_concurrent_additions_rebuild_on_the_winner():
+    store, _ = _store()
+    store.create('s', _document('s'))
+    attempts = []
+
+    def build(documents, metadata):
+        attempts.append([d['document_id'] for d in documents])
+        if len(attempts) == 1:
+            # another worker lands its document while this merge is running
+            store.add('s', _document('other'), _build)
+        return _build(documents, metadata)
+
+    item = store.add('s', _document('mine'), build)
+    assert attempts == [['s', 'mine'], ['s', 'other', 'mine']]
+    assert [d['document_id'] for d in item['documents']] == ['s', 'other', 'mine']
+    # only the winning merged index is left
+    merged = [key for key in store.s3.objects if key.startswith(MERGED_INDEX_PREFIX)]
+    assert merged == [item['s3_key']]
+
+
+def test_sessions_written_before_documents_read_as_one():
+    store, _ = _store()
+    store.table.items['old'] = {'session_id': 'old', 'filename': 'a.pdf', 'chunks_count': 4,
+                                's3_key': 'vector_stores/old.idx', 'doc_key': 'k', 'expires_at': 10 ** 10}
+    assert session_documents(store.get('old')) == [
+        {'document_id': 'old', 'filename': 'a.pdf', 'chunks_count': 4, 'index_key': 'vector_stores/old.idx',
+         'doc_key': 'k'}]
+    item = store.add('old', _document('new'), _build)
+    assert item['documents_version'] == 1 and len(item['documents']) == 2
+
+
+def test_expired_sessions_take_no_documents():
+    store, clock = _store()
+    store.create('s', _document('s'))
+    clock[0] += 2 * 3600
+    assert store.get('s') is None
+    with pytest.raises(ValueError):
+        store.add('s', _document('late'), _build)
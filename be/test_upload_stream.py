@@ -0,0 +1,61 @@
+"""
+Tests for reading uploads from a single S3 GET
+Run with: python -m pytest test_upload_stream.py
+"""
+import hashlib
+import io
+import os
+
+import pytest
+
+from bench_pdf_extract import write_synthetic_pdf
+from embedding_cache import EmbeddingCache
+from fakes import FakeBedrock
+from rag_bedrock import BedrockRAG
+from tmp_cache import TmpCache
+from upload_stream import read_upload
+
+
+def _response(data):
+    return {'Body': io.BytesIO(data), 'ContentLength': len(data), 'ContentType': 'text/plain'}
+
+
+def test_small_uploads_stay_in_memory(tmp_path):
+    cache = TmpCache(str(tmp_path))
+    data = 'Một câu. '.encode('utf-8') * 100
+    upload = read_upload(_response(data), 'a.txt', cache, spill_bytes=10 ** 6)
+    assert not upload.spilled and upload.source == data
+    assert upload.sha256 == hashlib.sha256(data).hexdigest()
+    assert not os.listdir(cache.scratch_dir)
+
+
+def test_large_uploads_spill_to_scratch(tmp_path):
+    cache = TmpCache(str(tmp_path))
+    data = os.urandom(3 * 1024 * 1024 + 5)
+    upload = read_upload(_response(data), 'big.txt', cache, spill_bytes=1024)
+    assert upload.spilled and upload.size == len(data)
+    assert upload.sha256 == hashlib.sha256(data).hexdigest()
+    with open(upload.source, 'rb') as f:
+        assert f.read() == data
+    upload.close()
+    assert not os.listdir(cache.scratch_dir)
+
+
+def test_bytes_and_files_extract_the_same(tmp_path):
+    rag = BedrockRAG(bedrock_runtime=FakeBedrock(), embedding_cache=EmbeddingCache())
+    pdf = tmp_path / 'doc.pdf'
+    write_synthetic_pdf(str(pdf), pages=5, lines_per_page=20)
+    text = tmp_path / 'doc.txt'
+    text.write_text('Đây là câu thứ nhất. Câu thứ hai! ' * 200, encoding='utf-8')
+
+    for path in (pdf, text):
+        from_file = list(rag.iter_document_chunks(str(path)))
+        assert from_file
+        assert list(rag.iter_document_chunks(path.read_bytes(), filename=path.name)) == from_file
+
+    # bytes and streams carry no name to tell a PDF from text by
+    for source in (text.read_bytes(), io.BytesIO(text.read_bytes())):
+        with pytest.raises(ValueError):
+            rag.iter_document_chunks(source)
+        with pytest.raises(ValueError):
+            next(rag.iter_pages(source))
@@ -0,0 +1,135 @@
+"""
+Tests for the binary vector index format
+Run with: python -m pytest test_vector_index.py
+"""
+import json
+import math
+import random
+
+import search_engine
+import vector_index
+from vector_index import serialize_index, load_index, load_index_bytes
+
+
+def _cosine(a, b):
+    if not a or not b:
+        return -1
+    dot = sum(x * y for x, y in zip(a, b))
+    norm_a = math.sqrt(sum(x * x for x in a))
+    norm_b = math.sqrt(sum(x * x for x in b))
+    if norm_a == 0 or norm_b == 0:
+        return -1
+    return dot / (norm_a * norm_b)
+
+
+def _without_numpy(monkeypatch):
+    monkeypatch.setattr(vector_index, 'np', None)
+    monkeypatch.setattr(search_engine, 'np', None)
+
+
+def _sample(n=20, dim=16, seed=7):
+    rng = random.Random(seed)
+    texts = [f"Đoạn {i}: nội dung thử nghiệm {rng.random()}" for i in range(n)]
+    embeddings = [[rng.uniform(-1, 1) for _ in range(dim)] for _ in range(n)]
+    return texts, embeddings
+
+
+def test_roundtrip_from_file(tmp_path):
+    texts, embeddings = _sample()
+    embeddings[3] = []  # failed embedding
+    path = tmp_path / "index.bin"
+    path.write_bytes(serialize_index(texts, embeddings, {'filename': 'a.pdf'}))
+
+    with load_index(str(path)) as index:
+        assert len(index) == len(texts)
+        assert index.dim == 16
+        assert index.metadata['filename'] == 'a.pdf'
+        assert index.texts == texts
+        assert index.vector(3) == [0.0] * 16
+        assert math.isclose(index.vector(0)[5], embeddings[0][5], rel_tol=1e-6)
+
+
+def test_legacy_json_index(tmp_path):
+    texts, embeddings = _sample(n=5)
+    path = tmp_path / "legacy.json"
+    path.write_text(json.dumps({
+        'session_id': 'abc', 'filename': 'a.txt', 'chunks_count': 5,
+        'texts': texts, 'embeddings': embeddings,
+    }))
+
+    index = load_index(str(path))
+    assert index.texts == texts
+    assert index.metadata['session_id'] == 'abc'
+
+    index = load_index_bytes(path.read_bytes())
+    assert index.count == 5
+
+
+def test_exact_scores_match_python(monkeypatch):
+    texts, embeddings = _sample()
+    embeddings[4] = []
+    query = embeddings[0][:]
+    expected = [_cosine(query, e) for e in embeddings]
+
+    q_unit = search_engine.unit_vector(query)
+
+    index = load_index_bytes(serialize_index(texts, embeddings))
+    for got, want in zip(index.exact_scores(q_unit), expected):
+        assert math.isclose(got, want, abs_tol=1e-5)
+
+    _without_numpy(monkeypatch)
+    for got, want in zip(index.exact_scores(q_unit), expected):
+        assert math.isclose(got, want, abs_tol=1e-5)
+
+
+def _top(index, query, k):
+    return [i for i, _ in index.search(query, k)]
+
+
+def test_quantized_indexes_rescore_to_exact_ranking(monkeypatch):
+    texts, embeddings = _sample(n=60, dim=32)
+    query = [x + 0.05 for x in embeddings[10]]
+    exact = sorted(range(60), key=lambda i: _cosine(query, embeddings[i]), reverse=True)[:5]
+
+    for use_numpy in (True, False):
+        if not use_numpy:
+            _without_numpy(monkeypatch)
+        for mode in ('none', 'float16', 'int8', 'binary'):
+            index = load_index_bytes(serialize_index(texts, embeddings, quantization=mode))
+            assert index.quantization == mode
+            assert _top(index, query, 5) == exact, (mode, use_numpy)
+
+
+def test_codes_only_index_is_smaller_and_still_finds_match():
+    texts, embeddings = _sample(n=60, dim=64)
+    full = serialize_index(texts, embeddings)
+    binary = serialize_index(texts, embeddings, quantization='binary', rescore_dtype=None)
+    assert len(binary) < len(full) / 2
+
+    index = load_index_bytes(binary)
+    assert not index.has_vectors
+    assert _top(index, embeddings[7], 1) == [7]
+
+
+def test_merged_index_copies_rows_and_maps_them_to_documents():
+    texts, embeddings = _sample(n=30)
+    embeddings[12] = []
+    parts = [(texts[:10], embeddings[:10]), (texts[10:], embeddings[10:])]
+    documents = [{'filename': 'a.txt', 'start': 0, 'count': 10}, {'filename': 'b.pdf', 'start': 10, 'count': 20}]
+
+    for mode in ('none', 'int8'):
+        expected = load_index_bytes(serialize_index(texts, embeddings, quantization=mode))
+        indexes = [load_index_bytes(serialize_index(t, e, quantization=mode)) for t, e in parts]
+        merged = load_index_bytes(vector_index.merge_indexes(
+            indexes, {'documents': documents}, quantization=mode, lexical=True))
+        assert merged.texts == texts and merged.has_lexical
+        assert merged.norms()[12] == 0
+        assert merged.search(embeddings[15], 5) == expected.search(embeddings[15], 5)
+        assert merged.document(9)['filename'] == 'a.txt' and merged.document(10)['filename'] == 'b.pdf'
+
+    # indexes written with other settings are converted from their float rows
+    indexes = [load_index_bytes(serialize_index(t, e, quantization='float16')) for t, e in parts]
+    merged = load_index_bytes(vector_index.merge_indexes(indexes, quantization='binary'))
+    assert merged.quantization == 'binary' and _top(merged, embeddings[7], 1) == [7]
+    # a single-document index is its own only document
+    assert indexes[0].documents == [{'filename': None, 'start': 0, 'count': 10}]
@@ -0,0 +1,193 @@
+"""Managed /tmp cache for Lambda's ephemeral disk.
+
+Two kinds of files live under the cache root:
+
+* cached indexes, stored as ``<sha1(key)>.<sha1(etag)>.idx`` so a warm
+  container can look an S3 object up by key and revalidate the ETag it
+  already has on disk instead of downloading the index again;
+* scratch files (uploads being processed) with unique names, so two
+  uploads of ``report.pdf`` never collide.
+
+The cache keeps itself under ``quota_bytes``. When space is needed, files
+are evicted by ``idle seconds * size``, so large files that nobody has read
+recently go first. Files that are still memory-mapped stay valid after
+eviction because unlinking does not unmap them. Scratch files left behind
+by a crashed invocation are swept once they are older than the Lambda
+timeout.
+"""
+import hashlib
+import io
+import logging
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ROOT = os.path.join(tempfile.gettempdir(), 'docqa-cache')
+SCRATCH_MAX_AGE = 900  # Lambda timeout; anything older is orphaned
+_COPY_BUFFER = 1024 * 1024
+
+
+def _digest(value):
+    return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+
+class TmpCache:
+    """Quota-bounded cache of index files plus unique scratch paths"""
+
+    def __init__(self, root=DEFAULT_ROOT, quota_bytes=256 * 1024 * 1024, clock=time.time):
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.clock = clock
+        self.index_dir = os.path.join(root, 'indexes')
+        self.scratch_dir = os.path.join(root, 'scratch')
+        os.makedirs(self.index_dir, exist_ok=True)
+        os.makedirs(self.scratch_dir, exist_ok=True)
+        self.sweep_scratch()
+
+    # -- cached indexes -------------------------------------------------
+
+    def _index_path(self, key, etag):
+        return os.path.join(self.index_dir, f"{_digest(key)}.{_digest(etag)}.idx")
+
+    def _touch(self, path):
+        now = self.clock()
+        os.utime(path, (now, now))
+
+    def get(self, key, etag):
+        """Path of the cached copy of ``key`` at ``etag``, or None"""
+        path = self._index_path(key, etag)
+        if not os.path.exists(path):
+            return None
+        self._touch(path)
+        return path
+
+    def lookup(self, key):
+        """(path, etag) of the most recent cached copy of ``key``, or (None, None)"""
+        prefix = _digest(key) + '.'
+        best = None
+        for name in os.listdir(self.index_dir):
+            if name.startswith(prefix) and name.endswith('.idx'):
+                path = os.path.join(self.index_dir, name)
+                try:
+                    mtime = os.stat(path).st_mtime
+                except OSError:
+                    continue  # evicted by a concurrent load
+                if best is None or mtime > best[0]:
+                    best = (mtime, path)
+        if best is None:
+            return None, None
+        etag_path = best[1] + '.etag'
+        try:
+            with open(etag_path, 'r', encoding='utf-8') as f:
+                etag = f.read()
+        except OSError:
+            return None, None
+        self._touch(best[1])
+        return best[1], etag
+
+    def put_stream(self, key, etag, stream, size=None):
+        """Write ``stream`` as the cached copy of ``key`` at ``etag``.
+
+        Returns the path, or None when the object cannot fit in the quota.
+        Older versions of the same key are dropped.
+        """
+        if size is not None and size > self.quota_bytes:
+            return None
+        self.make_room(size or 0)
+
+        path = self._index_path(key, etag)
+        partial = f"{path}.{uuid.uuid4().hex}.part"
+        try:
+            with open(partial, 'wb') as f:
+                shutil.copyfileobj(stream, f, _COPY_BUFFER)
+            with open(path + '.etag', 'w', encoding='utf-8') as f:
+                f.write(etag)
+            os.replace(partial, path)
+            self._touch(path)
+        except OSError as e:
+            logger.warning(f"Failed to cache {key} on disk: {e}")
+            self._unlink(partial)
+            return None
+
+        prefix = _digest(key) + '.'
+        for name in os.listdir(self.index_dir):
+            other = os.path.join(self.index_dir, name)
+            if name.startswith(prefix) and name.endswith('.idx') and other != path:
+                self._remove_index(other)
+        self.make_room(0, keep=path)
+        return path
+
+    def put_bytes(self, key, etag, data):
+        return self.put_stream(key, etag, io.BytesIO(data), size=len(data))
+
+    def _remove_index(self, path):
+        self._unlink(path)
+        self._unlink(path + '.etag')
+
+    # -- scratch files --------------------------------------------------
+
+    def scratch_path(self, filename):
+        """Unique scratch path that keeps ``filename``'s extension"""
+        self.make_room(0)
+        safe_name = os.path.basename(filename) or 'upload'
+        return os.path.join(self.scratch_dir, f"{uuid.uuid4().hex}-{safe_name}")
+
+    def release(self, path):
+        self._unlink(path)
+
+    def sweep_scratch(self, max_age=SCRATCH_MAX_AGE):
+        cutoff = self.clock() - max_age
+        for name in os.listdir(self.scratch_dir):
+            path = os.path.join(self.scratch_dir, name)
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    self._unlink(path)
+            except OSError:
+                pass
+
+    # -- quota ----------------------------------------------------------
+
+    def _files(self):
+        files = []
+        for directory in (self.index_dir, self.scratch_dir):
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((path, st.st_size, st.st_mtime))
+        return files
+
+    def usage(self):
+        return sum(size for _, size, _ in self._files())
+
+    def make_room(self, needed, keep=None):
+        """Evict cached indexes (except ``keep``) until ``needed`` more bytes fit"""
+        files = self._files()
+        used = sum(size for _, size, _ in files)
+        if used + needed <= self.quota_bytes:
+            return
+
+        now = self.clock()
+        # scratch files belong to the running invocation and are never evicted
+        candidates = [f for f in files
+                      if f[0].startswith(self.index_dir) and f[0].endswith('.idx') and f[0] != keep]
+        candidates.sort(key=lambda f: (now - f[2] + 1) * f[1], reverse=True)
+        for path, size, _ in candidates:
+            if used + needed <= self.quota_bytes:
+                break
+            self._remove_index(path)
+            used -= size
+            logger.info(f"Evicted {os.path.basename(path)} ({size} bytes) from /tmp cache")
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
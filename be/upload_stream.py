@@ -0,0 +1,71 @@
+"""Uploaded documents read from a single S3 GET.
+
+The worker used to ``head_object`` (type, size, checksum), then
+``download_file`` to /tmp, then reopen the file to hash and parse it: two
+requests plus a full disk write and read per document. Now one GET with
+``ChecksumMode`` returns the same metadata as the HEAD. It is validated
+before the body is read, so a rejected or deduplicated upload costs no
+transfer. Text files with that checksum are decoded straight off the
+response body. PDFs need random access, and uploads without a checksum
+must be hashed before they are split or embedded, so their body is hashed
+while it is read and kept as bytes. Bodies over ``spill_bytes`` are
+streamed to a scratch file instead, which keeps memory bounded.
+"""
+import hashlib
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Uploads larger than this are spilled to /tmp instead of held in memory
+UPLOAD_SPILL_BYTES = int(os.environ.get('UPLOAD_SPILL_BYTES', 32 * 1024 * 1024))
+_READ_BUFFER = 1024 * 1024
+
+
+class Upload:
+    """Content of an uploaded object; ``source`` is bytes or a scratch file path"""
+
+    def __init__(self, source, sha256, size, tmp_cache=None):
+        self.source = source
+        self.sha256 = sha256
+        self.size = size
+        self._tmp_cache = tmp_cache
+
+    @property
+    def spilled(self):
+        return isinstance(self.source, str)
+
+    def close(self):
+        if self.spilled and self._tmp_cache is not None:
+            self._tmp_cache.release(self.source)
+        self.source = None
+
+
+def get_upload(s3, bucket, key):
+    """GET an uploaded object with its checksum; the body is read later (``read_upload``)"""
+    return s3.get_object(Bucket=bucket, Key=key, ChecksumMode='ENABLED')
+
+
+def read_upload(response, filename, tmp_cache, spill_bytes=UPLOAD_SPILL_BYTES):
+    """Read and hash the body of ``get_upload``'s response"""
+    body = response['Body']
+    try:
+        if response['ContentLength'] <= spill_bytes:
+            data = body.read()
+            return Upload(data, hashlib.sha256(data).hexdigest(), len(data))
+
+        path = tmp_cache.scratch_path(filename)
+        digest, size = hashlib.sha256(), 0
+        try:
+            with open(path, 'wb') as f:
+                for block in iter(lambda: body.read(_READ_BUFFER), b''):
+                    digest.update(block)
+                    f.write(block)
+                    size += len(block)
+        except BaseException:
+            tmp_cache.release(path)
+            raise
+        logger.info(f"Spilled {filename} ({size} bytes) to {path}")
+        return Upload(path, digest.hexdigest(), size, tmp_cache)
+    finally:
+        body.close()
@@ -0,0 +1,571 @@
+"""Binary session index format.
+
+An index file is laid out as (all integers little-endian):
+
+    magic     8 bytes   b"DQAVIDX\\0"
+    version   uint32
+    hdr_len   uint32
+    header    hdr_len bytes of UTF-8 JSON (metadata + section table)
+    padding   up to the next 64-byte boundary
+    sections  each one 64-byte aligned, offsets relative to the data start
+
+Sections:
+
+    vectors       float32/float16 matrix, count x dim, row-major (v2: rows
+                  are L2-normalised, the original lengths live in ``norms``)
+    norms         float32, count; 0 marks a missing/failed embedding (v2)
+    codes         quantized rows used for the coarse scan (v2, optional):
+                  int8 count x dim, or 1-bit signs packed count x ceil(dim/8)
+    scales        float32 per-row dequantization scale for int8 codes (v2)
+    text_offsets  uint64, count + 1 byte offsets into ``texts``
+    texts         UTF-8 chunk texts, concatenated
+    lex_*         BM25 inverted index over the texts (optional, see
+                  lexical_index); rebuilt from ``texts`` when absent
+    ivf_*         IVF lists for approximate search (optional, large
+                  indexes only, see ann_index)
+
+The quantization mode is recorded in the header. With ``int8``/``binary``
+the coarse codes are scanned first and a shortlist is rescored against
+``vectors``; ``vectors`` may be dropped entirely (``rescore_dtype=None``)
+to get the smallest possible index at the cost of recall.
+
+The sections are read straight out of a memory map, so scoring a question
+never materialises the embeddings as Python floats; the scoring itself
+lives in search_engine. Version 1 files and
+old ``vector_stores/*.json`` indexes are still accepted by the loaders.
+"""
+import bisect
+import json
+import math
+import mmap
+import struct
+
+import ann_index
+import lexical_index
+import search_engine
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy is in requirements.txt
+    np = None
+
+MAGIC = b"DQAVIDX\x00"
+FORMAT_VERSION = 2
+ALIGNMENT = 64
+CONTENT_TYPE = 'application/octet-stream'
+
+QUANTIZATION_MODES = ('none', 'float16', 'int8', 'binary')
+VECTOR_DTYPES = ('float32', 'float16')
+
+_PREAMBLE = struct.Struct('<8sII')
+_STRUCT_CODES = {'float32': ('f', 4), 'float16': ('e', 2)}
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _embedding_dim(embeddings):
+    return max((len(e) for e in embeddings if e), default=0)
+
+
+def _pack(fmt, values):
+    return struct.pack(f'<{len(values)}{fmt}', *values)
+
+
+def _normalize_rows(embeddings, dim):
+    """Return (unit rows, norms); missing/bad rows become zeros with norm 0"""
+    zero_row = [0.0] * dim
+    rows = [e if e and len(e) == dim else zero_row for e in embeddings]
+    if np is not None:
+        matrix = np.asarray(rows, dtype=np.float64).reshape(len(rows), dim)
+        norms = np.linalg.norm(matrix, axis=1)
+        safe = np.where(norms > 0, norms, 1.0)
+        return matrix / safe[:, None], norms
+
+    unit_rows, norms = [], []
+    for row in rows:
+        norm = math.sqrt(sum(x * x for x in row))
+        norms.append(norm)
+        unit_rows.append([x / norm for x in row] if norm else zero_row)
+    return unit_rows, norms
+
+
+def _encode_vectors(unit_rows, dtype):
+    if np is not None:
+        return np.asarray(unit_rows, dtype='<f4' if dtype == 'float32' else '<f2').tobytes()
+    fmt = _STRUCT_CODES[dtype][0]
+    return b''.join(_pack(fmt, row) for row in unit_rows)
+
+
+def _encode_norms(norms):
+    if np is not None:
+        return np.asarray(norms, dtype='<f4').tobytes()
+    return _pack('f', norms)
+
+
+def _encode_int8(unit_rows):
+    """Symmetric per-row int8 quantization: row ~= codes * scale"""
+    if np is not None:
+        rows = np.asarray(unit_rows, dtype=np.float32)
+        peak = np.abs(rows).max(axis=1) if rows.size else np.zeros(len(rows), np.float32)
+        scales = (peak / 127.0).astype('<f4')
+        safe = np.where(scales > 0, scales, 1.0)
+        codes = np.clip(np.rint(rows / safe[:, None]), -127, 127).astype(np.int8)
+        return codes.tobytes(), scales.tobytes()
+
+    codes, scales = bytearray(), []
+    for row in unit_rows:
+        peak = max((abs(x) for x in row), default=0.0)
+        scale = peak / 127.0
+        scales.append(scale)
+        codes += _pack('b', [max(-127, min(127, round(x / scale))) if scale else 0 for x in row])
+    return bytes(codes), _pack('f', scales)
+
+
+def _sign_bits(row):
+    """Pack the sign of each component (1 for >= 0), MSB first like numpy.packbits"""
+    out = bytearray((len(row) + 7) // 8)
+    for j, x in enumerate(row):
+        if x >= 0:
+            out[j >> 3] |= 0x80 >> (j & 7)
+    return bytes(out)
+
+
+def _encode_binary(unit_rows):
+    if np is not None:
+        rows = np.asarray(unit_rows, dtype=np.float32)
+        return np.packbits(rows >= 0, axis=1).tobytes()
+    return b''.join(_sign_bits(row) for row in unit_rows)
+
+
+def _pack_texts(texts):
+    encoded = [t.encode('utf-8') for t in texts]
+    offsets = [0]
+    for blob in encoded:
+        offsets.append(offsets[-1] + len(blob))
+    return _pack('Q', offsets), b''.join(encoded)
+
+
+def _vector_dtype(quantization, rescore_dtype):
+    if quantization == 'none':
+        return 'float32'
+    if quantization == 'float16':
+        return 'float16'
+    return rescore_dtype
+
+
+def serialize_index(texts, embeddings, metadata=None, quantization='none', rescore_dtype='float32',
+                    lexical=False, ann_min_rows=None, ann_nlist=None, ann_nprobe=ann_index.DEFAULT_NPROBE):
+    """Serialize chunk texts + embeddings into the binary index format.
+
+    ``quantization`` is one of QUANTIZATION_MODES. For ``int8``/``binary``,
+    ``rescore_dtype`` selects the precision of the rows kept for exact
+    rescoring (``float32``, ``float16`` or None to keep only the codes).
+    ``lexical`` adds the BM25 keyword index sections. Indexes of at least
+    ``ann_min_rows`` rows also get IVF lists (``ann_nlist`` of them, None
+    for about sqrt(rows)) probed ``ann_nprobe`` at a time by default.
+    """
+    if len(texts) != len(embeddings):
+        raise ValueError("texts and embeddings must have the same length")
+    if quantization not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization mode: {quantization}")
+    if rescore_dtype is not None and rescore_dtype not in VECTOR_DTYPES:
+        raise ValueError(f"Unknown rescore dtype: {rescore_dtype}")
+
+    dim = _embedding_dim(embeddings)
+    unit_rows, norms = _normalize_rows(embeddings, dim)
+
+    vector_dtype = _vector_dtype(quantization, rescore_dtype)
+    payloads = [('norms', {'dtype': 'float32'}, _encode_norms(norms))]
+    if vector_dtype:
+        payloads.append(('vectors', {'dtype': vector_dtype, 'normalized': True},
+                         _encode_vectors(unit_rows, vector_dtype)))
+    if quantization == 'int8':
+        codes, scales = _encode_int8(unit_rows)
+        payloads.append(('codes', {'dtype': 'int8'}, codes))
+        payloads.append(('scales', {'dtype': 'float32'}, scales))
+    elif quantization == 'binary':
+        payloads.append(('codes', {'dtype': 'bits'}, _encode_binary(unit_rows)))
+
+    if ann_min_rows is not None:
+        payloads += _ann_payloads(unit_rows, norms, ann_min_rows, ann_nlist, ann_nprobe)
+    payloads += _text_payloads(texts, lexical)
+    return _assemble(payloads, len(texts), dim, quantization, metadata)
+
+
+def _ann_payloads(unit_rows, norms, min_rows, nlist, nprobe):
+    if np is None or sum(1 for n in norms if n) < max(min_rows, 1):
+        return []
+    info, sections = ann_index.encode(unit_rows, norms, nlist, nprobe)
+    return [(name, info if name == 'ivf_centroids' else {}, data) for name, data in sections.items()]
+
+
+def _text_payloads(texts, lexical):
+    text_offsets, text_blob = _pack_texts(texts)
+    payloads = [('text_offsets', {'dtype': 'uint64'}, text_offsets),
+                ('texts', {'encoding': 'utf-8'}, text_blob)]
+    if lexical:
+        info, sections = lexical_index.encode(texts)
+        payloads += [(name, info if name == 'lex_terms' else {}, data) for name, data in sections.items()]
+    return payloads
+
+
+def _assemble(payloads, count, dim, quantization, metadata):
+    sections = {}
+    offset = 0
+    for name, info, data in payloads:
+        offset = _align(offset)
+        sections[name] = dict(info, offset=offset, length=len(data))
+        offset += len(data)
+
+    header = json.dumps({
+        'count': count,
+        'dim': dim,
+        'quantization': quantization,
+        'metadata': metadata or {},
+        'sections': sections,
+    }, ensure_ascii=False).encode('utf-8')
+
+    out = bytearray(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+    out += header
+    data_start = _align(len(out))
+    for name, _, data in payloads:
+        out += b'\x00' * (data_start + sections[name]['offset'] - len(out))
+        out += data
+    return bytes(out)
+
+
+# sections holding one fixed-size record per row, copied as is by merge_indexes
+_ROW_SECTIONS = ('norms', 'vectors', 'codes', 'scales')
+
+
+def _layout(index):
+    sections = {name: index._sections[name].get('dtype') for name in _ROW_SECTIONS if name in index._sections}
+    return index.quantization, index._normalized or not index.has_vectors, sections
+
+
+def _target_layout(quantization, rescore_dtype):
+    """What ``_layout`` gives for an index written by serialize_index with these settings"""
+    sections = {'norms': 'float32'}
+    vector_dtype = _vector_dtype(quantization, rescore_dtype)
+    if vector_dtype:
+        sections['vectors'] = vector_dtype
+    if quantization == 'int8':
+        sections.update(codes='int8', scales='float32')
+    elif quantization == 'binary':
+        sections['codes'] = 'bits'
+    return quantization, True, sections
+
+
+def merge_indexes(indexes, metadata=None, quantization='none', rescore_dtype='float32', lexical=False,
+                  ann_min_rows=None, ann_nlist=None, ann_nprobe=ann_index.DEFAULT_NPROBE):
+    """One index holding the rows of ``indexes`` in order, without re-embedding.
+
+    When every index has the layout ``serialize_index`` gives these settings,
+    the stored rows are copied byte for byte; otherwise they are rebuilt
+    from each index's float vectors. The keyword and IVF sections are
+    rebuilt over the merged rows. Raises ValueError when the indexes come
+    from different embedding models (dimensions) or one has no float rows
+    to convert.
+    """
+    dims = {index.dim for index in indexes if index.dim}
+    if len(dims) > 1:
+        raise ValueError(f"Cannot merge indexes of different dimensions: {sorted(dims)}")
+    texts = [text for index in indexes for text in index.texts]
+    target = _target_layout(quantization, rescore_dtype)
+    if not dims or any(_layout(index) != target for index in indexes):
+        if not all(index.has_vectors for index in indexes):
+            raise ValueError("Indexes without float vectors can only be merged as stored")
+        embeddings = [index.vector(i) if index.norms()[i] else [] for index in indexes for i in range(len(index))]
+        return serialize_index(texts, embeddings, metadata, quantization, rescore_dtype, lexical,
+                               ann_min_rows, ann_nlist, ann_nprobe)
+
+    dim = dims.pop()
+    payloads = [(name, {key: value for key, value in indexes[0]._sections[name].items()
+                        if key not in ('offset', 'length')},
+                 b''.join(bytes(index._section(name)) for index in indexes))
+                for name in _ROW_SECTIONS if name in indexes[0]._sections]
+    if ann_min_rows is not None and indexes[0].has_vectors and np is not None:
+        norms = np.concatenate([np.asarray(index.norms(), dtype=np.float32) for index in indexes])
+        unit_rows = np.concatenate([np.asarray(index.matrix(), dtype=np.float32) for index in indexes])
+        payloads += _ann_payloads(unit_rows, norms, ann_min_rows, ann_nlist, ann_nprobe)
+    payloads += _text_payloads(texts, lexical)
+    return _assemble(payloads, len(texts), dim, quantization, metadata)
+
+
+def is_binary_index(data):
+    return bytes(data[:len(MAGIC)]) == MAGIC
+
+
+def _popcount_table():
+    return np.array([bin(i).count('1') for i in range(256)], dtype=np.uint16)
+
+
+class VectorIndex:
+    """Read-only view over a serialized index (bytes or a memory map)"""
+
+    _POPCOUNT = None
+
+    def __init__(self, buffer, owner=None):
+        magic, version, header_len = _PREAMBLE.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a DocQA vector index")
+        if version > FORMAT_VERSION:
+            raise ValueError(f"Unsupported index format version: {version}")
+
+        header_end = _PREAMBLE.size + header_len
+        header = json.loads(bytes(buffer[_PREAMBLE.size:header_end]).decode('utf-8'))
+
+        self.version = version
+        self.count = header['count']
+        self.dim = header['dim']
+        self.quantization = header.get('quantization', 'none')
+        self.metadata = header.get('metadata', {})
+        self._sections = header['sections']
+        self._data_start = _align(header_end)
+        self._buffer = buffer
+        self._owner = owner
+        self._view = memoryview(buffer)
+
+        offsets = self._section('text_offsets')
+        self._text_offsets = struct.unpack_from(f'<{self.count + 1}Q', offsets)
+        self._texts = self._section('texts')
+        self._norms = None
+        self._lexical = None
+        self._ann = None
+
+    def _section(self, name):
+        info = self._sections[name]
+        start = self._data_start + info['offset']
+        return self._view[start:start + info['length']]
+
+    def _array(self, name, dtype, count):
+        info = self._sections[name]
+        return np.frombuffer(self._buffer, dtype=dtype, count=count,
+                             offset=self._data_start + info['offset'])
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def has_vectors(self):
+        return 'vectors' in self._sections
+
+    @property
+    def nbytes(self):
+        return len(self._view)
+
+    def text(self, i):
+        start, end = self._text_offsets[i], self._text_offsets[i + 1]
+        return bytes(self._texts[start:end]).decode('utf-8')
+
+    @property
+    def texts(self):
+        return [self.text(i) for i in range(self.count)]
+
+    @property
+    def documents(self):
+        """The documents the rows come from, in row order: ``{"filename", "start", "count", ...}``"""
+        documents = self.metadata.get('documents')
+        if not documents:
+            documents = [{'filename': self.metadata.get('filename'), 'start': 0, 'count': self.count}]
+        return documents
+
+    def document(self, i):
+        """The ``documents`` entry of row ``i``"""
+        documents = self.documents
+        return documents[bisect.bisect_right([d['start'] for d in documents], i) - 1]
+
+    @property
+    def has_lexical(self):
+        info = self._sections.get('lex_terms')
+        return info is not None and info.get('tokenizer') == lexical_index.TOKENIZER_VERSION
+
+    def lexical(self):
+        """The BM25 keyword index (built from the texts if the file has none, or an older tokenizer's)"""
+        if self._lexical is None:
+            if self.has_lexical:
+                self._lexical = lexical_index.LexicalIndex(
+                    self._sections['lex_terms'], {name: self._section(name) for name in lexical_index.SECTIONS})
+            else:
+                self._lexical = lexical_index.LexicalIndex.build(self.texts)
+        return self._lexical
+
+    @property
+    def has_ann(self):
+        return 'ivf_centroids' in self._sections
+
+    def ann(self):
+        """The IVF lists (None for indexes searched exactly)"""
+        if self._ann is None and self.has_ann:
+            self._ann = ann_index.IVFIndex(self._sections['ivf_centroids'],
+                                           {name: self._section(name) for name in ann_index.SECTIONS}, self.dim)
+        return self._ann
+
+    def ann_candidates(self, q_unit, nprobe=None):
+        """Rows in the ``nprobe`` IVF lists closest to a unit query, ascending"""
+        return self.ann().candidates(q_unit, nprobe)
+
+    def lexical_search(self, query, k=3):
+        """Top ``k`` (row, BM25 score) pairs for the words of ``query``, best first"""
+        return self.lexical().search(query, k)
+
+    def norms(self):
+        """Original embedding lengths (0 for missing embeddings)"""
+        if self._norms is None:
+            if 'norms' in self._sections:
+                if np is not None:
+                    self._norms = self._array('norms', '<f4', self.count)
+                else:
+                    self._norms = struct.unpack_from(f'<{self.count}f', self._section('norms'))
+            elif np is not None:
+                self._norms = np.linalg.norm(self.matrix(), axis=1)
+            else:
+                self._norms = [math.sqrt(sum(x * x for x in self._row(i))) for i in range(self.count)]
+        return self._norms
+
+    @property
+    def _normalized(self):
+        return self._sections.get('vectors', {}).get('normalized', False)
+
+    def matrix(self):
+        """Stored rows as a (count, dim) array backed by the buffer"""
+        if np is None:
+            raise RuntimeError("numpy is required for matrix access")
+        dtype = '<f4' if self._sections['vectors']['dtype'] == 'float32' else '<f2'
+        return self._array('vectors', dtype, self.count * self.dim).reshape(self.count, self.dim)
+
+    def _row(self, i):
+        fmt, width = _STRUCT_CODES[self._sections['vectors']['dtype']]
+        section = self._section('vectors')
+        return struct.unpack(f'<{self.dim}{fmt}', section[i * self.dim * width:(i + 1) * self.dim * width])
+
+    def vector(self, i):
+        """Embedding ``i`` at stored precision, in its original scale"""
+        row = self._row(i)
+        if not self._normalized:
+            return list(row)
+        norm = self.norms()[i]
+        return [float(x) * float(norm) for x in row]
+
+    def _rows(self):
+        if np is not None:
+            return self.matrix()
+        return _RowView(self)
+
+    def exact_scores(self, q_unit, rows=None):
+        """Exact cosine scores for a unit query (all rows, or ``rows``)"""
+        if not self.has_vectors:
+            return [-1] * (self.count if rows is None else len(rows))
+        return search_engine.dot_scores(self._rows(), self.norms(), q_unit,
+                                        normalized=self._normalized, subset=rows)
+
+    def coarse_scores(self, q_unit, rows=None):
+        """Approximate cosine scores for a unit query from the quantized codes (all rows, or ``rows``)"""
+        norms = self.norms()
+        order = range(self.count) if rows is None else rows
+
+        if self.quantization == 'int8':
+            if np is not None:
+                codes = self._array('codes', np.int8, self.count * self.dim).reshape(self.count, self.dim)
+                scales = self._array('scales', '<f4', self.count)
+                norms = np.asarray(norms)
+                if rows is not None:
+                    idx = np.asarray(rows, dtype=np.int64)
+                    codes, scales, norms = codes[idx], scales[idx], norms[idx]
+                scores = (codes @ np.asarray(q_unit, dtype=np.float32)) * scales
+                return np.where(norms > 0, scores, -1.0)
+            codes = self._section('codes').cast('b')
+            scales = struct.unpack_from(f'<{self.count}f', self._section('scales'))
+            scores = []
+            for i in order:
+                row = codes[i * self.dim:(i + 1) * self.dim]
+                dot = sum(c * x for c, x in zip(row, q_unit))
+                scores.append(dot * scales[i] if norms[i] else -1)
+            return scores
+
+        # binary: Hamming distance between sign patterns, mapped back to an
+        # angle estimate so the scores stay comparable with exact cosines
+        width = (self.dim + 7) // 8
+        if np is not None:
+            if VectorIndex._POPCOUNT is None:
+                VectorIndex._POPCOUNT = _popcount_table()
+            codes = self._array('codes', np.uint8, self.count * width).reshape(self.count, width)
+            norms = np.asarray(norms)
+            if rows is not None:
+                idx = np.asarray(rows, dtype=np.int64)
+                codes, norms = codes[idx], norms[idx]
+            q_bits = np.packbits(np.asarray(q_unit) >= 0)
+            distance = VectorIndex._POPCOUNT[np.bitwise_xor(codes, q_bits)].sum(axis=1)
+            scores = np.cos(np.pi * distance / self.dim)
+            return np.where(norms > 0, scores, -1.0)
+        section = self._section('codes')
+        q_bits = int.from_bytes(_sign_bits(q_unit), 'big')
+        scores = []
+        for i in order:
+            if not norms[i]:
+                scores.append(-1)
+                continue
+            row = int.from_bytes(section[i * width:(i + 1) * width], 'big')
+            scores.append(math.cos(math.pi * (row ^ q_bits).bit_count() / self.dim))
+        return scores
+
+    def search(self, query, k=3, rescore_factor=search_engine.RESCORE_FACTOR, nprobe=None):
+        """Top ``k`` (row, score) pairs for ``query``, best first"""
+        return search_engine.search(self, query, k, rescore_factor, nprobe)
+
+    def close(self):
+        self._view = self._texts = self._norms = self._lexical = self._ann = None
+        if self._owner is not None:
+            try:
+                self._owner.close()
+            except BufferError:
+                # numpy views handed out by matrix() still reference the map;
+                # it is unmapped once they are garbage collected.
+                pass
+            self._owner = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _RowView:
+    """Lazy row access for the pure-Python scoring path"""
+
+    def __init__(self, index):
+        self._index = index
+
+    def __len__(self):
+        return self._index.count
+
+    def __getitem__(self, i):
+        return self._index._row(i)
+
+
+def _from_legacy_json(obj):
+    texts = obj.get('texts', [])
+    embeddings = obj.get('embeddings', [])
+    metadata = {k: v for k, v in obj.items() if k not in ('texts', 'embeddings')}
+    return VectorIndex(serialize_index(texts, embeddings, metadata))
+
+
+def load_index_bytes(data):
+    """Load an index from bytes (binary format or legacy JSON)"""
+    if is_binary_index(data):
+        return VectorIndex(data)
+    return _from_legacy_json(json.loads(bytes(data).decode('utf-8')))
+
+
+def load_index(path):
+    """Memory-map an index file from disk (binary format or legacy JSON)"""
+    with open(path, 'rb') as f:
+        head = f.read(len(MAGIC))
+        if head != MAGIC:
+            f.seek(0)
+            return _from_legacy_json(json.load(f))
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return VectorIndex(mapped, owner=mapped)
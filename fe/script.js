@@ -1,8 +1,14 @@
 // Configuration
 const API_BASE_URL = 'https://xy4iztykoa.execute-api.us-east-1.amazonaws.com/dev';
+// File lớn hơn ngưỡng này được upload theo từng phần (multipart)
+const MULTIPART_THRESHOLD = 16 * 1024 * 1024;
+const MULTIPART_CONCURRENCY = 4;
+const MULTIPART_URLS_PER_CALL = 100; // khớp MULTIPART_MAX_URLS ở backend
+const MULTIPART_PART_ATTEMPTS = 3;
 
 // State
 let currentSessionId = null;
+let currentJobId = null;
 let isProcessing = false;
 
 // DOM Elements
@@ -64,35 +70,25 @@ async function handleFileUpload() {
         return;
     }
     
-    if (file.size > 10 * 1024 * 1024) { // 10MB
-        showUploadStatus('File quá lớn (tối đa 10MB)', 'error');
+    // TXT được đọc dạng stream nên cho phép lớn hơn PDF (khớp MAX_TEXT_FILE_SIZE ở backend)
+    const isText = file.name.toLowerCase().endsWith('.txt');
+    const maxMB = isText ? 32 : 10;
+    if (file.size > maxMB * 1024 * 1024) {
+        showUploadStatus(`File quá lớn (tối đa ${maxMB}MB)`, 'error');
         return;
     }
     
+    // Huỷ job cũ chưa xong để không tốn Bedrock cho tài liệu bị bỏ
+    await cancelCurrentJob();
+
     // Presign + direct S3 upload flow
     showUploadStatus('Yêu cầu presigned URL...', 'processing');
     setUIEnabled(false);
     try {
-        const presignRes = await fetch(`${API_BASE_URL}/presign`, {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ filename: file.name, content_type: file.type })
-        });
-        const presignJson = await presignRes.json();
-        if (!presignRes.ok) throw new Error(presignJson.error || 'Presign failed');
-
-        const { upload_url, s3_key } = presignJson;
-
-        showUploadStatus('Đang upload trực tiếp lên S3...', 'processing');
-
-        // Upload file to presigned URL (PUT)
-        const putRes = await fetch(upload_url, {
-            method: 'PUT',
-            // headers: {'Content-Type': file.type} <-- Không nên đặt Content-Type nếu upload_url đã chứa nó
-            body: file
-        });
-
-        if (!putRes.ok) throw new Error('S3 upload failed');
+        // File lớn: multipart upload, các phần lỗi được gửi lại riêng lẻ
+        const s3_key = file.size > MULTIPART_THRESHOLD
+            ? await multipartUpload(file)
+            : await singleUpload(file);
 
         // Tell backend to process the uploaded S3 key
         showUploadStatus('Đang xử lý tài liệu trên backend...', 'processing');
@@ -105,9 +101,14 @@ async function handleFileUpload() {
         const procJson = await procRes.json();
         if (!procRes.ok) throw new Error(procJson.error || 'Processing failed');
 
-        currentSessionId = procJson.session_id;
-        showUploadStatus(`✅ Đã upload: ${procJson.filename} (${procJson.chunks_count} đoạn)`, 'success');
-        addMessage(`Tôi đã xử lý xong file "${procJson.filename}". Bạn có thể hỏi về nội dung trong file!`, 'assistant');
+        // Backend xử lý bất đồng bộ: theo dõi job cho tới khi xong
+        const job = await waitForJob(procJson);
+
+        currentSessionId = job.session_id;
+        const reused = job.deduplicated ? ', dùng lại index có sẵn' : '';
+        const documents = job.documents_count > 1 ? `, phiên có ${job.documents_count} tài liệu` : '';
+        showUploadStatus(`✅ Đã upload: ${job.filename} (${job.chunks_count} đoạn${reused}${documents})`, 'success');
+        addMessage(`Tôi đã xử lý xong file "${job.filename}". Bạn có thể hỏi về nội dung trong file!`, 'assistant');
         setUIEnabled(true);
 
     } catch (error) {
@@ -142,7 +143,10 @@ async function sendQuestion() {
         
         if (response.ok) {
             removeTypingIndicator();
-            addMessage(result.answer, 'assistant');
+            // Tên các file chứa đoạn văn được dùng để trả lời
+            const sources = [...new Set((result.sources || []).map(s => s.filename).filter(Boolean))];
+            addMessage(sources.length ? `${result.answer}<br><em>Nguồn: ${sources.join(', ')}</em>` : result.answer,
+                       'assistant');
         } else {
             throw new Error(result.error || 'Ask failed');
         }
@@ -222,4 +226,166 @@ function setUIEnabled(enabled) {
 }
 
 // Initialize app
-document.addEventListener('DOMContentLoaded', init);
\ No newline at end of file
+document.addEventListener('DOMContentLoaded', init);
+
+async function singleUpload(file) {
+    // SHA-256 của file: S3 kiểm tra khi PUT, backend dùng để tái sử dụng index của file trùng
+    const sha256 = await sha256Hex(file);
+
+    const presignRes = await fetch(`${API_BASE_URL}/presign`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        // Có session_id: file được thêm vào phiên hiện tại thay vì mở phiên mới
+        body: JSON.stringify({ filename: file.name, content_type: file.type, sha256, session_id: currentSessionId })
+    });
+    const presignJson = await presignRes.json();
+    if (!presignRes.ok) throw new Error(presignJson.error || 'Presign failed');
+
+    const { upload_url, s3_key, checksum_sha256 } = presignJson;
+
+    showUploadStatus('Đang upload trực tiếp lên S3...', 'processing');
+
+    // Upload file to presigned URL (PUT)
+    const putRes = await fetch(upload_url, {
+        method: 'PUT',
+        headers: checksum_sha256 ? { 'x-amz-checksum-sha256': checksum_sha256 } : {},
+        // headers: {'Content-Type': file.type} <-- Không nên đặt Content-Type nếu upload_url đã chứa nó
+        body: file
+    });
+
+    if (!putRes.ok) throw new Error('S3 upload failed');
+    return s3_key;
+}
+
+async function postJson(path, payload, failure) {
+    const res = await fetch(`${API_BASE_URL}${path}`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify(payload)
+    });
+    const json = await res.json();
+    if (!res.ok) throw new Error(json.error || failure);
+    return json;
+}
+
+async function multipartUpload(file) {
+    // Không tính SHA-256 trước: backend băm nội dung khi đọc file
+    const { s3_key, upload_id, part_size } = await postJson('/multipart/create',
+        { filename: file.name, content_type: file.type, size: file.size, session_id: currentSessionId },
+        'Multipart create failed');
+    const upload = { s3_key, upload_id };
+    const partCount = Math.max(1, Math.ceil(file.size / part_size));
+
+    try {
+        const urls = {};
+        for (let first = 1; first <= partCount; first += MULTIPART_URLS_PER_CALL) {
+            const part_numbers = [];
+            for (let n = first; n < first + MULTIPART_URLS_PER_CALL && n <= partCount; n++) part_numbers.push(n);
+            const res = await postJson('/multipart/parts', { ...upload, part_numbers }, 'Multipart presign failed');
+            Object.assign(urls, res.urls);
+        }
+
+        const parts = [];
+        let next = 1, done = 0;
+        const worker = async () => {
+            while (next <= partCount) {
+                const n = next++;
+                const blob = file.slice((n - 1) * part_size, n * part_size);
+                parts.push({ part_number: n, etag: await uploadPart(urls[n], blob) });
+                done++;
+                showUploadStatus(`Đang upload lên S3 (${done}/${partCount} phần)...`, 'processing');
+            }
+        };
+        showUploadStatus(`Đang upload lên S3 (0/${partCount} phần)...`, 'processing');
+        await Promise.all(Array.from({ length: Math.min(MULTIPART_CONCURRENCY, partCount) }, worker));
+
+        await postJson('/multipart/complete', { ...upload, parts }, 'Multipart complete failed');
+        return s3_key;
+    } catch (error) {
+        // Xoá các phần đã upload; lifecycle rule của bucket dọn nốt nếu lệnh này cũng lỗi
+        postJson('/multipart/abort', upload, 'Multipart abort failed').catch(() => {});
+        throw error;
+    }
+}
+
+async function uploadPart(url, blob) {
+    for (let attempt = 1; ; attempt++) {
+        try {
+            const res = await fetch(url, { method: 'PUT', body: blob });
+            if (!res.ok) throw new Error(`S3 part upload failed (${res.status})`);
+            const etag = res.headers.get('ETag');
+            if (!etag) throw new Error('ETag không đọc được (kiểm tra ExposedHeaders trong CORS của bucket)');
+            return etag;
+        } catch (error) {
+            if (attempt >= MULTIPART_PART_ATTEMPTS) throw error;
+            await new Promise(resolve => setTimeout(resolve, 500 * 2 ** attempt));
+        }
+    }
+}
+
+async function sha256Hex(file) {
+    if (!window.crypto || !crypto.subtle) return null;
+    const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+    return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+}
+
+function describeJob(job) {
+    switch (job.stage) {
+        case 'extracting': {
+            // embedding chạy song song với trích xuất
+            const parts = [];
+            if (job.pages_total) parts.push(`${job.pages_extracted || 0}/${job.pages_total} trang`);
+            if (job.chunks_embedded) parts.push(`${job.chunks_embedded} đoạn đã embed`);
+            return parts.length
+                ? `Đang trích xuất văn bản (${parts.join(', ')})...`
+                : 'Đang trích xuất văn bản...';
+        }
+        case 'embedding':
+            return `Đang tạo embedding (${job.chunks_embedded || 0}/${job.chunks_total} đoạn)...`;
+        case 'indexing':
+            return 'Đang ghi index...';
+        default:
+            return 'Đang chờ xử lý tài liệu...';
+    }
+}
+
+async function waitForJob(job) {
+    currentJobId = job.job_id;
+    try {
+        while (job.status === 'queued' || job.status === 'running') {
+            showUploadStatus(describeJob(job), 'processing');
+            await new Promise(resolve => setTimeout(resolve, 2000));
+            const res = await fetch(`${API_BASE_URL}/status`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ job_id: job.job_id })
+            });
+            const json = await res.json();
+            if (!res.ok) throw new Error(json.error || 'Status failed');
+            job = json;
+        }
+    } finally {
+        currentJobId = null;
+    }
+    if (job.status === 'cancelled') throw new Error('Đã huỷ xử lý tài liệu');
+    if (job.status !== 'succeeded') throw new Error(job.error || 'Processing failed');
+    return job;
+}
+
+async function cancelCurrentJob() {
+    if (!currentJobId) return;
+    const jobId = currentJobId;
+    currentJobId = null;
+    try {
+        await fetch(`${API_BASE_URL}/cancel`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ job_id: jobId }),
+            keepalive: true
+        });
+    } catch (error) {
+        console.error('Cancel error:', error);
+    }
+}
+
+window.addEventListener('pagehide', cancelCurrentJob);